@@ -19,9 +19,14 @@ import requests_cache
 activelyUpdatingAVUs = False
 
 
-def set_json_to_obj(ctx, object_name, object_type, json_namespace, json_string):
+def set_json_to_obj(ctx, object_name, object_type, json_namespace, json_string, sync=False):
     """This rule stores a given json string as AVU's to an object.
 
+    By default all AVUs in the JSON namespace are removed and the AVUs for the
+    given JSON are added one by one. In synchronisation mode (sync=True), the
+    existing AVUs in the namespace are compared with the AVUs for the given
+    JSON, and only the differences are applied, in one atomic operation.
+
     :param ctx:            iRODS context
     :param object_name:    The object name (/nlmumc/P000000003, /nlmumc/projects/metadata.xml, user@mail.com, demoResc)
     :param object_type:    The object type
@@ -31,6 +36,7 @@ def set_json_to_obj(ctx, object_name, object_type, json_namespace, json_string):
                              -u for user
     :param json_namespace: The JSON namespace according to https://github.com/MaastrichtUniversity/irods_avu_json.
     :param json_string:    The JSON string {"k1":"v1","k2":{"k3":"v2","k4":"v3"},"k5":["v4","v5"],"k6":[{"k7":"v6","k8":"v7"}]}
+    :param sync:           Only apply differences with the existing AVUs in the namespace
 
     :returns: None
     """
@@ -62,20 +68,65 @@ def set_json_to_obj(ctx, object_name, object_type, json_namespace, json_string):
     global activelyUpdatingAVUs
     activelyUpdatingAVUs = True
 
-    ret_val = ctx.msi_rmw_avu(object_type, object_name, "%", "%", json_namespace + "_%")
-    if ret_val['status'] is False and ret_val['code'] != -819000:
-        return
+    if sync:
+        avu = jsonavu.json2avu(data, json_namespace)
+        sync_avus_to_obj(ctx, object_name, object_type, json_namespace, avu)
+    else:
+        ret_val = ctx.msi_rmw_avu(object_type, object_name, "%", "%", json_namespace + "_%")
+        if ret_val['status'] is False and ret_val['code'] != -819000:
+            return
 
-    avu = jsonavu.json2avu(data, json_namespace)
+        avu = jsonavu.json2avu(data, json_namespace)
 
-    for i in avu:
-        ctx.msi_add_avu(object_type, object_name, i["a"], i["v"], i["u"])
+        for i in avu:
+            ctx.msi_add_avu(object_type, object_name, i["a"], i["v"], i["u"])
 
     # Set global variable activelyUpdatingAVUs to false. At this point we are done updating AVU and want
     # to enable some of the checks.
     activelyUpdatingAVUs = False
 
 
+def sync_avus_to_obj(ctx, object_name, object_type, json_namespace, avu):
+    """Synchronise the AVUs in a JSON namespace of an object with the given AVUs.
+
+    Only AVUs that are not present yet are added, and only AVUs that are no
+    longer present are removed. All changes are applied in a single atomic
+    metadata operation, so the object never lacks metadata in between.
+
+    :param ctx:            iRODS context
+    :param object_name:    The object name (/nlmumc/P000000003, /nlmumc/projects/metadata.xml, user@mail.com, demoResc)
+    :param object_type:    The object type (-d, -R, -C or -u)
+    :param json_namespace: The JSON namespace according to https://github.com/MaastrichtUniversity/irods_avu_json.
+    :param avu:            List of AVU dicts as returned by jsonavu.json2avu
+    """
+    def text(x):
+        # Compare catalog values (UTF-8 encoded) with generated values (unicode) as unicode.
+        return x.decode('utf-8') if isinstance(x, bytes) else u'{}'.format(x)
+
+    fields = get_fields_for_type(ctx, object_type, object_name)
+    rows = genquery.row_iterator([fields['a'], fields['v'], fields['u']],
+                                 fields['WHERE'] + " AND %s like '%s_%%'" % (fields['u'], json_namespace),
+                                 genquery.AS_LIST, ctx)
+
+    existing = set((text(a), text(v), text(u)) for a, v, u in rows)
+    wanted = set((text(i["a"]), text(i["v"]), text(i["u"])) for i in avu)
+
+    operations = ([{"operation": "remove", "attribute": a, "value": v, "units": u} for a, v, u in sorted(existing - wanted)]
+                  + [{"operation": "add", "attribute": a, "value": v, "units": u} for a, v, u in sorted(wanted - existing)])
+
+    if len(operations) == 0:
+        return
+
+    entity_types = {'-d': 'data_object', '-c': 'collection', '-r': 'resource', '-u': 'user'}
+    request = {"entity_name": object_name,
+               "entity_type": entity_types[object_type.lower()],
+               "operations": operations}
+
+    ret_val = ctx.msi_atomic_apply_metadata_operations(json.dumps(request), "")
+    if ret_val['status'] is False:
+        ctx.msiExit("-1101000", "JSON AVUs could not be synchronised: " + str(ret_val['arguments'][1]))
+
+
 def get_fields_for_type(ctx, object_type, object_name):
     """Helper function to convert iRODS object type to the corresponding field names in GenQuery.
 
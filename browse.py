@@ -1,19 +1,46 @@
 # -*- coding: utf-8 -*-
 """Functions for listing collection information."""
 
-__copyright__ = 'Copyright (c) 2019-2022, Utrecht University'
+__copyright__ = 'Copyright (c) 2019-2023, Utrecht University'
 __license__   = 'GPLv3, see LICENSE'
 
 import re
 from collections import OrderedDict
 
+import genquery
 from genquery import AS_DICT, Query
 
 from util import *
 
 __all__ = ['api_browse_folder',
            'api_browse_collections',
-           'api_search']
+           'api_search',
+           'rule_search_index_rebuild']
+
+INDEXED_SEARCH_TYPES = {'filename': ('data', 'name'),
+                        'folder':   ('coll', 'name'),
+                        'metadata': ('coll', 'metadata')}
+"""Search types answered from the local search index: kind of entries and field searched."""
+
+_readable_homes = cache.Cache(max_age=60, max_size=100)
+"""Per-client cache of the home collections the client can read."""
+
+
+def _space_patterns(ctx, space):
+    """Get GLOB patterns of subcollections to include in and exclude from listings of a space.
+
+    :param ctx:   Combined type of a callback and rei struct
+    :param space: Space the listed collection is in
+
+    :returns: Tuple of include patterns (or None) and exclude patterns
+    """
+    zone = user.zone(ctx)
+    if space == str(pathutil.Space.RESEARCH):
+        return None, ['/{}/home/vault-*'.format(zone), '/{}/home/grp-vault-*'.format(zone)]
+    elif space == str(pathutil.Space.VAULT):
+        return ['/{}/home/*vault-*'.format(zone)], []
+    else:
+        return None, []
 
 
 @api.make()
@@ -36,87 +63,30 @@ def api_browse_folder(ctx,
 
     :returns: Dict with paginated collection contents
     """
-    def transform(row):
-        # Remove ORDER_BY etc. wrappers from column names.
-        x = {re.sub('.*\((.*)\)', '\\1', k): v for k, v in row.items()}
-        if 'DATA_NAME' in x and 'META_DATA_ATTR_VALUE' in x:
-            return {x['DATA_NAME']: x['META_DATA_ATTR_VALUE']}
-        elif 'DATA_NAME' in x:
-            return {'name':        x['DATA_NAME'],
-                    'type':        'data',
-                    'size':        int(x['DATA_SIZE']),
-                    'modify_time': int(x['DATA_MODIFY_TIME']),
-                    'state':       'REG'}
-        else:
-            return {'name':        x['COLL_NAME'].split('/')[-1],
-                    'type':        'coll',
-                    'modify_time': int(x['COLL_MODIFY_TIME'])}
-
-    if sort_on == 'modified':
-        # FIXME: Sorting on modify date is borked: There appears to be no
-        # reliable way to filter out replicas this way - multiple entries for
-        # the same file may be returned when replication takes place on a
-        # minute boundary, for example.
-        # We would want to take the max modify time *per* data name.
-        # (or not? replication may take place a long time after a modification,
-        #  resulting in a 'too new' date)
-        ccols = ['COLL_NAME', 'ORDER(COLL_MODIFY_TIME)']
-        dcols = ['DATA_NAME', 'MIN(DATA_CREATE_TIME)', 'ORDER(DATA_MODIFY_TIME)', 'DATA_SIZE']
-    elif sort_on == 'size':
-        ccols = ['COLL_NAME', 'COLL_MODIFY_TIME']
-        dcols = ['DATA_NAME', 'MIN(DATA_CREATE_TIME)', 'MAX(DATA_MODIFY_TIME)', 'ORDER(DATA_SIZE)']
-    else:
-        ccols = ['ORDER(COLL_NAME)', 'COLL_MODIFY_TIME']
-        dcols = ['ORDER(DATA_NAME)', 'MIN(DATA_CREATE_TIME)', 'MAX(DATA_MODIFY_TIME)', 'DATA_SIZE']
-
-    if sort_order == 'desc':
-        ccols = [x.replace('ORDER(', 'ORDER_DESC(') for x in ccols]
-        dcols = [x.replace('ORDER(', 'ORDER_DESC(') for x in dcols]
+    include, exclude = _space_patterns(ctx, space)
+    total, items = collection.listing(ctx, coll, sort_on, sort_order, offset, limit,
+                                      include=include, exclude=exclude)
 
-    zone = user.zone(ctx)
-
-    # We make offset/limit act on two queries at once, placing qdata right after qcoll.
-    if space == str(pathutil.Space.RESEARCH):
-        qcoll = Query(ctx, ccols,
-                      "COLL_PARENT_NAME = '{}' AND COLL_NAME not like '/{}/home/vault-%' AND COLL_NAME not like '/{}/home/grp-vault-%'".format(coll, zone, zone),
-                      offset=offset, limit=limit, output=AS_DICT)
-    elif space == str(pathutil.Space.VAULT):
-        qcoll = Query(ctx, ccols,
-                      "COLL_PARENT_NAME = '{}' AND COLL_NAME like '/{}/home/%vault-%'".format(coll, zone),
-                      offset=offset, limit=limit, output=AS_DICT)
-    else:
-        qcoll = Query(ctx, ccols, "COLL_PARENT_NAME = '{}'".format(coll),
-                      offset=offset, limit=limit, output=AS_DICT)
-
-    colls = map(transform, list(qcoll))
-
-    qdata = Query(ctx, dcols, "COLL_NAME = '{}'".format(coll),
-                  offset=max(0, offset - qcoll.total_rows()), limit=limit - len(colls), output=AS_DICT)
-    datas = map(transform, list(qdata))
-
-    if len(colls) + len(datas) == 0:
+    if total == 0:
         # No results at all?
         # Make sure the collection actually exists.
         if not collection.exists(ctx, coll):
             return api.Error('nonexistent', 'The given path does not exist')
         # (checking this beforehand would waste a query in the most common situation)
 
-    if config.enable_tape_archive:
-        # Retrieve tape archive state for data objects.
-        state_cols = ['DATA_NAME', 'META_DATA_ATTR_VALUE']
-        qstate = Query(ctx, state_cols, "COLL_NAME = '{}' AND META_DATA_ATTR_NAME = '{}'".format(coll, "org_tape_archive_state"),
-                       offset=max(0, offset - qcoll.total_rows()), limit=limit - len(colls), output=AS_DICT)
-        state = map(transform, list(qstate))
+    datas = [x for x in items if x['type'] == 'data']
+    for d in datas:
+        d['state'] = 'REG'
 
+    if config.enable_tape_archive and len(datas) > 0:
+        # Retrieve tape archive state for data objects.
+        state = dict(Query(ctx, ['DATA_NAME', 'META_DATA_ATTR_VALUE'],
+                           "COLL_NAME = '{}' AND META_DATA_ATTR_NAME = '{}'".format(coll, "org_tape_archive_state")))
         for d in datas:
-            name = d['name']
-            if any(name in s for s in state):
-                for s in state:
-                    if name in s:
-                        d.update({'state': s[name]})
+            d['state'] = state.get(d['name'], d['state'])
 
-    return OrderedDict([('total', qcoll.total_rows() + qdata.total_rows()),
-                        ('items', colls + datas)])
+    return OrderedDict([('total', total),
+                        ('items', items)])
 
 
 @api.make()
@@ -142,62 +112,18 @@ def api_browse_collections(ctx,
 
     :returns: Dict with paginated collection contents
     """
-    def transform(row):
-        # Remove ORDER_BY etc. wrappers from column names.
-        x = {re.sub('.*\((.*)\)', '\\1', k): v for k, v in row.items()}
-
-        if 'DATA_NAME' in x:
-            return {'name':        x['DATA_NAME'],
-                    'type':        'data',
-                    'size':        int(x['DATA_SIZE']),
-                    'modify_time': int(x['DATA_MODIFY_TIME'])}
-        else:
-            return {'name':        x['COLL_NAME'].split('/')[-1],
-                    'type':        'coll',
-                    'modify_time': int(x['COLL_MODIFY_TIME'])}
-
-    if sort_on == 'modified':
-        # FIXME: Sorting on modify date is borked: There appears to be no
-        # reliable way to filter out replicas this way - multiple entries for
-        # the same file may be returned when replication takes place on a
-        # minute boundary, for example.
-        # We would want to take the max modify time *per* data name.
-        # (or not? replication may take place a long time after a modification,
-        #  resulting in a 'too new' date)
-        ccols = ['COLL_NAME', 'ORDER(COLL_MODIFY_TIME)']
-    elif sort_on == 'size':
-        ccols = ['COLL_NAME', 'COLL_MODIFY_TIME']
-    else:
-        ccols = ['ORDER(COLL_NAME)', 'COLL_MODIFY_TIME']
-
-    if sort_order == 'desc':
-        ccols = [x.replace('ORDER(', 'ORDER_DESC(') for x in ccols]
-
-    zone = user.zone(ctx)
-
-    # We make offset/limit act on two queries at once, placing qdata right after qcoll.
-    if space == str(pathutil.Space.RESEARCH):
-        qcoll = Query(ctx, ccols,
-                      "COLL_PARENT_NAME = '{}' AND COLL_NAME not like '/{}/home/vault-%' AND COLL_NAME not like '/{}/home/grp-vault-%'".format(coll, zone, zone),
-                      offset=offset, limit=limit, output=AS_DICT)
-    elif space == str(pathutil.Space.VAULT):
-        qcoll = Query(ctx, ccols,
-                      "COLL_PARENT_NAME = '{}' AND COLL_NAME like '/{}/home/%vault-%'".format(coll, zone),
-                      offset=offset, limit=limit, output=AS_DICT)
-    else:
-        qcoll = Query(ctx, ccols, "COLL_PARENT_NAME = '{}'".format(coll),
-                      offset=offset, limit=limit, output=AS_DICT)
+    include, exclude = _space_patterns(ctx, space)
+    total, colls = collection.listing(ctx, coll, sort_on, sort_order, offset, limit,
+                                      data=False, include=include, exclude=exclude)
 
-    colls = map(transform, list(qcoll))
-
-    if len(colls) == 0:
+    if total == 0:
         # No results at all?
         # Make sure the collection actually exists.
         if not collection.exists(ctx, coll):
             return api.Error('nonexistent', 'The given path does not exist')
         # (checking this beforehand would waste a query in the most common situation)
 
-    return OrderedDict([('total', qcoll.total_rows()),
+    return OrderedDict([('total', total),
                         ('items', colls)])
 
 
@@ -211,6 +137,14 @@ def api_search(ctx,
                limit=10):
     """Get paginated search results, including size/modify date/location information.
 
+    Searches by file name, folder name and metadata are answered from the
+    local search index once it is built (see util/search.py). Search terms
+    then match words in names and metadata by prefix ('exp dat' matches
+    'experiment-data.csv'), rather than any part of a name or metadata value.
+    Only the results on the requested page are checked for access, so the
+    total of an indexed search is approximate: it may include results that
+    the client cannot read.
+
     :param ctx:           Combined type of a callback and rei struct
     :param search_string: String used to search
     :param search_type:   Search type ('filename', 'folder', 'metadata', 'status')
@@ -221,6 +155,14 @@ def api_search(ctx,
 
     :returns: Dict with paginated search results
     """
+    if search_type in INDEXED_SEARCH_TYPES:
+        kind, field = INDEXED_SEARCH_TYPES[search_type]
+        found = search.search(kind, field, search_string, _homes(ctx), sort_order, offset, limit)
+        if found is not None:
+            total, paths = found
+            return OrderedDict([('total', total),
+                                ('items', _search_results(ctx, kind, paths))])
+
     def transform(row):
         # Remove ORDER_BY etc. wrappers from column names.
         x = {re.sub('.*\((.*)\)', '\\1', k): v for k, v in row.items()}
@@ -290,3 +232,92 @@ def api_search(ctx,
 
     return OrderedDict([('total', qdata.total_rows()),
                         ('items', datas)])
+
+
+def _homes(ctx):
+    """Get the names of the home collections (e.g. 'research-x') readable by the client.
+
+    Home collections are readable by the members of the groups they belong to
+    (and by the datamanagers of their category), so this narrows down search
+    results by group membership before their own access is checked.
+    """
+    home = '/{}/home'.format(user.zone(ctx))
+    return _readable_homes.get(user.full_name(ctx),
+                               lambda: [pathutil.basename(row[0])
+                                        for row in genquery.row_iterator("COLL_NAME",
+                                                                         "COLL_PARENT_NAME = '{}'".format(home),
+                                                                         genquery.AS_LIST, ctx)])
+
+
+def _search_results(ctx, kind, paths):
+    """Look up size and modify time of search results in the catalog.
+
+    The catalog only returns collections and data objects that the client can
+    read, so results that do not exist anymore or are not readable by the
+    client are left out.
+
+    :param ctx:   Combined type of a callback and rei struct
+    :param kind:  Kind of results ('coll' or 'data')
+    :param paths: Paths of the results on the requested page
+
+    :returns: List of search results readable by the client, in the order of paths
+    """
+    items = []
+    if kind == 'data' and len(paths) > 0:
+        colls = sorted(set(pathutil.chop(p)[0] for p in paths))
+        names = sorted(set(pathutil.chop(p)[1] for p in paths))
+        found = {(coll, name): (modify_time, size) for coll, name, modify_time, size in genquery.row_iterator(
+                 "COLL_NAME, DATA_NAME, MAX(DATA_MODIFY_TIME), MAX(DATA_SIZE)",
+                 "COLL_NAME in ({}) AND DATA_NAME in ({})".format(', '.join("'{}'".format(c) for c in colls),
+                                                                  ', '.join("'{}'".format(n) for n in names)),
+                 genquery.AS_LIST, ctx)}
+        for path in paths:
+            if pathutil.chop(path) in found:
+                modify_time, size = found[pathutil.chop(path)]
+                items.append({'name':        path.split('/home', 1)[1],
+                              'type':        'data',
+                              'size':        int(size),
+                              'modify_time': int(modify_time)})
+    elif len(paths) > 0:
+        found = dict(genquery.row_iterator("COLL_NAME, MAX(COLL_MODIFY_TIME)",
+                                           "COLL_NAME in ({})".format(', '.join("'{}'".format(p) for p in paths)),
+                                           genquery.AS_LIST, ctx))
+        for path in paths:
+            if path in found:
+                items.append({'name':        path.split('/home', 1)[1],
+                              'type':        'coll',
+                              'modify_time': int(found[path])})
+
+    return items
+
+
+@rule.make(inputs=[], outputs=[0])
+def rule_search_index_rebuild(ctx):
+    """Rebuild the local search index of this server from the catalog.
+
+    :param ctx: Combined type of a callback and rei struct
+
+    :returns: Status message
+    """
+    if user.user_type(ctx) != 'rodsadmin':
+        return 'Insufficient permissions - should only be called by rodsadmin'
+
+    home = '/{}/home'.format(user.zone(ctx))
+
+    # Read everything before writing, to keep the index locked as short as possible.
+    colls = [row[0] for row in genquery.row_iterator("COLL_NAME",
+                                                     "COLL_NAME like '{}/%'".format(home),
+                                                     genquery.AS_LIST, ctx)]
+    data_objects = ['{}/{}'.format(*row) for row in genquery.row_iterator("COLL_NAME, DATA_NAME",
+                                                                          "COLL_NAME like '{}/%'".format(home),
+                                                                          genquery.AS_LIST, ctx)]
+    metadata = {}
+    for coll, value in genquery.row_iterator("COLL_NAME, META_COLL_ATTR_VALUE",
+                                             "COLL_NAME like '{}/%' AND META_COLL_ATTR_UNITS like '{}_%'"
+                                             .format(home, constants.UUUSERMETADATAROOT),
+                                             genquery.AS_LIST, ctx):
+        metadata.setdefault(coll, []).append(value)
+
+    count = search.rebuild(colls, data_objects, metadata)
+    log.write(ctx, 'Search index rebuilt', entries=count)
+    return 'Search index rebuilt: {} collections and data objects indexed'.format(count)
@@ -1,7 +1,12 @@
 # -*- coding: utf-8 -*-
-"""Functions for token management."""
+"""Functions for token management.
 
-__copyright__ = 'Copyright (c) 2021, Utrecht University'
+Tokens are stored in an SQLCipher database. Opening the database with its key
+is deliberately expensive, so a keyed connection is opened once per agent and
+reused by later calls.
+"""
+
+__copyright__ = 'Copyright (c) 2021-2023, Utrecht University'
 __license__   = 'GPLv3, see LICENSE'
 
 import os
@@ -41,25 +46,16 @@ def api_token_generate(ctx, label=None):
     gen_time = datetime.now()
     token_lifetime = timedelta(hours=config.token_lifetime)
     exp_time = gen_time + token_lifetime
-    conn = sqlite3.connect(config.token_database)
-    result = None
 
     try:
-        with conn:
-            conn.execute("PRAGMA key='%s'" % (config.token_database_password))
-            conn.execute('''INSERT INTO tokens VALUES (?, ?, ?, ?, ?)''', (user_id, label, token, gen_time, exp_time))
-            result = token
+        store_token(user_id, label, token, gen_time, exp_time)
     except sqlite3.IntegrityError:
-        result = api.Error('TokenExistsError', 'Token with this label already exists')
+        return api.Error('TokenExistsError', 'Token with this label already exists')
     except Exception:
         print_exc()
-        result = api.Error('DatabaseError', 'Error occurred while writing to database')
-
-    # Connection object used as context manager only commits or rollbacks transactions,
-    # so the connection object should be closed manually
-    conn.close()
+        return api.Error('DatabaseError', 'Error occurred while writing to database')
 
-    return result
+    return token
 
 
 @api.make()
@@ -75,25 +71,17 @@ def api_token_load(ctx):
         return api.Error('DatabaseError', 'Internal error: token database unavailable')
 
     user_id = user.name(ctx)
-    conn = sqlite3.connect(config.token_database)
     result = []
 
     try:
-        with conn:
-            conn.execute("PRAGMA key='%s'" % (config.token_database_password))
-            for row in conn.execute('''SELECT label, exp_time FROM tokens WHERE user=:user_id AND exp_time > :now''',
-                                    {"user_id": user_id, "now": datetime.now()}):
-                exp_time = datetime.strptime(row[1], '%Y-%m-%d %H:%M:%S.%f')
-                exp_time = exp_time.strftime('%Y-%m-%d %H:%M:%S')
-                result.append({"label": row[0], "exp_time": exp_time})
+        for label, exp_time in user_tokens(user_id, datetime.now()):
+            exp_time = datetime.strptime(exp_time, '%Y-%m-%d %H:%M:%S.%f')
+            exp_time = exp_time.strftime('%Y-%m-%d %H:%M:%S')
+            result.append({"label": label, "exp_time": exp_time})
     except Exception:
         print_exc()
         result = api.Error('DatabaseError', 'Error occurred while reading database')
 
-    # Connection object used as context manager only commits or rollbacks transactions,
-    # so the connection object should be closed manually
-    conn.close()
-
     return result
 
 
@@ -110,28 +98,21 @@ def api_token_delete(ctx, label):
         return api.Error('DatabaseError', 'Internal error: token database unavailable')
 
     user_id = user.name(ctx)
-    conn = sqlite3.connect(config.token_database)
-    result = None
 
     try:
-        with conn:
-            conn.execute("PRAGMA key='%s'" % (config.token_database_password))
-            conn.execute('''DELETE FROM tokens WHERE user = ? AND label = ?''', (user_id, label))
-            result = api.Result.ok()
+        delete_token(user_id, label)
     except Exception:
         print_exc()
-        result = api.Error('DatabaseError', 'Error during deletion from database')
+        return api.Error('DatabaseError', 'Error during deletion from database')
 
-    # Connection object used as context manager only commits or rollbacks transactions,
-    # so the connection object should be closed manually
-    conn.close()
+    return api.Result.ok()
 
-    return result
 
+def get_all_tokens(ctx, before=None):
+    """Retrieve all valid tokens, or only those expiring before a given time.
 
-def get_all_tokens(ctx):
-    """Retrieve all valid tokens.
-    :param ctx: Combined type of a callback and rei struct
+    :param ctx:    Combined type of a callback and rei struct
+    :param before: Only retrieve tokens expiring before this time (datetime, optional)
 
     :returns: Valid tokens
     """
@@ -142,22 +123,14 @@ def get_all_tokens(ctx):
     if not token_database_initialized():
         return []
 
-    conn = sqlite3.connect(config.token_database)
     result = []
     try:
-        with conn:
-            conn.execute("PRAGMA key='%s'" % (config.token_database_password))
-            for row in conn.execute('''SELECT user, label, exp_time FROM tokens WHERE exp_time > :now''',
-                                    {"now": datetime.now()}):
-                result.append({"user": row[0], "label": row[1], "exp_time": row[2]})
+        for row in valid_tokens(datetime.now(), before):
+            result.append({"user": row[0], "label": row[1], "exp_time": row[2]})
     except Exception:
         print_exc()
         result = api.Error('DatabaseError', 'Error occurred while reading database')
 
-    # Connection object used as context manager only commits or rollbacks transactions,
-    # so the connection object should be closed manually
-    conn.close()
-
     return result
 
 
@@ -167,3 +140,101 @@ def token_database_initialized():
     :returns: Boolean value
     """
     return os.path.isfile(config.token_database)
+
+
+# Token store {{{
+
+_store = {}  # Connection of this agent, with the database file and key it was opened with.
+
+
+def _connection():
+    """Get a keyed connection to the token database, reusing the connection of this agent.
+
+    Indexes for lookups by user and expiry time are created when the
+    connection is opened. A new connection is opened when the database file
+    was replaced (e.g. restored from a backup) since the connection was
+    opened.
+
+    :returns: Database connection
+    """
+    try:
+        st = os.stat(config.token_database)
+        identity = (st.st_dev, st.st_ino)
+    except OSError:
+        identity = None
+
+    key = (config.token_database, config.token_database_password, identity)
+    if _store.get('key') != key:
+        _disconnect()
+        conn = sqlite3.connect(config.token_database)
+        conn.execute("PRAGMA key='%s'" % (config.token_database_password))
+        with conn:
+            conn.execute('CREATE INDEX IF NOT EXISTS tokens_exp_time ON tokens (exp_time)')
+            conn.execute('CREATE INDEX IF NOT EXISTS tokens_user_exp_time ON tokens (user, exp_time)')
+        _store['conn'] = conn
+        _store['key'] = key
+    return _store['conn']
+
+
+def _disconnect():
+    """Close the connection to the token database of this agent, if any."""
+    conn = _store.pop('conn', None)
+    _store.pop('key', None)
+    if conn is not None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+def _execute(statement, parameters):
+    """Execute a statement on the token database in a transaction.
+
+    After database errors other than constraint violations, the connection is
+    closed so that the next statement opens a new one (e.g. after the
+    database file was replaced).
+
+    :param statement:  SQL statement
+    :param parameters: Statement parameters
+
+    :returns: Result rows
+    """
+    try:
+        conn = _connection()
+        with conn:
+            return conn.execute(statement, parameters).fetchall()
+    except sqlite3.IntegrityError:
+        raise
+    except Exception:
+        _disconnect()
+        raise
+
+
+def store_token(user_id, label, token, gen_time, exp_time):
+    """Store a new token.
+
+    :raises sqlite3.IntegrityError: User already has a token with this label
+    """
+    _execute('INSERT INTO tokens VALUES (?, ?, ?, ?, ?)', (user_id, label, token, gen_time, exp_time))
+
+
+def delete_token(user_id, label):
+    """Delete a token of a user."""
+    _execute('DELETE FROM tokens WHERE user = ? AND label = ?', (user_id, label))
+
+
+def user_tokens(user_id, now):
+    """Get label and expiry time of the valid tokens of a user."""
+    return _execute('SELECT label, exp_time FROM tokens WHERE user = :user_id AND exp_time > :now',
+                    {"user_id": user_id, "now": now})
+
+
+def valid_tokens(now, before=None):
+    """Get user, label and expiry time of all valid tokens, or of those expiring before a given time."""
+    if before is None:
+        return _execute('SELECT user, label, exp_time FROM tokens WHERE exp_time > :now',
+                        {"now": now})
+    return _execute('SELECT user, label, exp_time FROM tokens WHERE exp_time > :now AND exp_time < :before',
+                    {"now": now, "before": before})
+
+# }}}
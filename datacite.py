@@ -1,7 +1,13 @@
 # -*- coding: utf-8 -*-
-"""Functions for communicating with DataCite and some utilities."""
+"""Functions for communicating with DataCite and some utilities.
 
-__copyright__ = 'Copyright (c) 2019-2022, Utrecht University'
+Requests are sent over an HTTP session that is kept per agent, so that
+connections to the DataCite API are reused by following requests. The API
+endpoint is taken from config.datacite_rest_api_url, which can point to a
+local stand-in for testing.
+"""
+
+__copyright__ = 'Copyright (c) 2019-2023, Utrecht University'
 __license__ = 'GPLv3, see LICENSE'
 
 import random
@@ -11,14 +17,23 @@ import requests
 
 from util import *
 
+_sessions = {}  # Session of this agent, created on first use.
+
+
+def _session():
+    """Get an HTTP session for the configured DataCite API, reusing the session of this agent."""
+    if 'datacite' not in _sessions:
+        session = requests.Session()
+        session.auth = (config.datacite_username, config.datacite_password)
+        session.headers.update({'Content-Type': 'application/json', 'charset': 'UTF-8'})
+        _sessions['datacite'] = session
+    return _sessions['datacite']
+
 
 def metadata_post(ctx, payload):
     """Register DOI metadata with DataCite."""
     url = "{}/dois".format(config.datacite_rest_api_url)
-    auth = (config.datacite_username, config.datacite_password)
-    headers = {'Content-Type': 'application/json', 'charset': 'UTF-8'}
-
-    response = requests.post(url, auth=auth, data=payload, headers=headers, timeout=30)
+    response = _session().post(url, data=payload, timeout=30)
 
     return response.status_code
 
@@ -26,10 +41,7 @@ def metadata_post(ctx, payload):
 def metadata_put(ctx, doi, payload):
     """Update metadata with DataCite."""
     url = "{}/dois/{}".format(config.datacite_rest_api_url, doi)
-    auth = (config.datacite_username, config.datacite_password)
-    headers = {'Content-Type': 'application/json', 'charset': 'UTF-8'}
-
-    response = requests.put(url, auth=auth, data=payload, headers=headers, timeout=30)
+    response = _session().put(url, data=payload, timeout=30)
 
     return response.status_code
 
@@ -37,10 +49,7 @@ def metadata_put(ctx, doi, payload):
 def metadata_get(ctx, doi):
     """Check with DataCite if DOI is available."""
     url = "{}/dois/{}".format(config.datacite_rest_api_url, doi)
-    auth = (config.datacite_username, config.datacite_password)
-    headers = {'Content-Type': 'application/json', 'charset': 'UTF-8'}
-
-    response = requests.get(url, auth=auth, headers=headers, timeout=30)
+    response = _session().get(url, timeout=30)
 
     return response.status_code
 
@@ -1,10 +1,11 @@
 # -*- coding: utf-8 -*-
 """Functions to handle data requests."""
 
-__copyright__ = 'Copyright (c) 2019-2022, Utrecht University'
+__copyright__ = 'Copyright (c) 2019-2023, Utrecht University'
 __license__   = 'GPLv3, see LICENSE'
 __author__    = ('Lazlo Westerhof, Jelmer Zondergeld')
 
+import copy
 import json
 import re
 import time
@@ -347,6 +348,7 @@ def metadata_set(ctx, request_id, key, value):
 
     # Trigger the processing of delayed rules
     ctx.adminDatarequestActions()
+    metadata_changed(ctx)
 
 
 def generate_request_id(ctx):
@@ -558,6 +560,61 @@ def api_datarequest_schema_get(ctx, schema_name):
     return datarequest_schema_get(ctx, schema_name)
 
 
+# Registry of datarequest schemas loaded by this agent:
+# schema collection => (stamp, dict with schema and UI schema, compiled validator)
+_schemas = {}
+
+
+def schema_stamp(ctx, schema_coll):
+    """Get the checksums, sizes and modification times of the files of a datarequest schema.
+
+    :param ctx:         Combined type of a callback and rei struct
+    :param schema_coll: Collection of the schema
+
+    :returns: Tuple identifying the current contents of the schema collection
+    """
+    iter = row_iterator(
+        "DATA_NAME, DATA_CHECKSUM, DATA_SIZE, DATA_MODIFY_TIME",
+        "COLL_NAME = '{}'".format(schema_coll),
+        AS_LIST, ctx)
+    return tuple(sorted(tuple(row) for row in iter))
+
+
+def schema_load(ctx, schema_name):
+    """Get a datarequest schema from the registry of this agent.
+
+    The schema is (re)loaded when the files in its collection changed, and
+    checked for validity before it is registered.
+
+    :param ctx:         Combined type of a callback and rei struct
+    :param schema_name: Name of schema
+
+    :raises error.UUFileNotExistError:   Schema or UI schema does not exist
+    :raises error.UUJsonValidationError: Schema or UI schema is invalid
+
+    :returns: Tuple of dict with schema and UI schema, and compiled validator for the schema
+    """
+    schema_coll = "/{}{}/{}".format(user.zone(ctx), SCHEMACOLLECTION, schema_name)
+    stamp = schema_stamp(ctx, schema_coll)
+
+    if schema_coll not in _schemas or _schemas[schema_coll][0] != stamp:
+        try:
+            schema = jsonutil.read(ctx, "{}/{}".format(schema_coll, SCHEMA + JSON_EXT))
+            uischema = jsonutil.read(ctx, "{}/{}".format(schema_coll, UISCHEMA + JSON_EXT))
+            jsonschema.Draft7Validator.check_schema(schema)
+        except (jsonutil.ParseError, jsonschema.SchemaError) as e:
+            log.write(ctx, "Invalid datarequest schema <{}>: {}".format(schema_coll, e))
+            raise error.UUJsonValidationError('Invalid schema {}'.format(schema_name))
+
+        if not isinstance(uischema, dict):
+            log.write(ctx, "Invalid datarequest UI schema <{}>".format(schema_coll))
+            raise error.UUJsonValidationError('Invalid UI schema {}'.format(schema_name))
+
+        _schemas[schema_coll] = (stamp, {"schema": schema, "uischema": uischema}, jsonschema.Draft7Validator(schema))
+
+    return _schemas[schema_coll][1:]
+
+
 def datarequest_schema_get(ctx, schema_name):
     """Get schema and UI schema of a datarequest form
 
@@ -566,20 +623,15 @@ def datarequest_schema_get(ctx, schema_name):
 
     :returns: Dict with schema and UI schema
     """
-    # Define paths to schema and uischema
-    coll_path = "/{}{}".format(user.zone(ctx), SCHEMACOLLECTION)
-    schema_path = "{}/{}/{}".format(coll_path, schema_name, SCHEMA + JSON_EXT)
-    uischema_path = "{}/{}/{}".format(coll_path, schema_name, UISCHEMA + JSON_EXT)
-
-    # Retrieve and read schema and uischema
     try:
-        schema = jsonutil.read(ctx, schema_path)
-        uischema = jsonutil.read(ctx, uischema_path)
+        schemas, _ = schema_load(ctx, schema_name)
     except error.UUFileNotExistError:
         return api.Error("file_read_error", "Could not read schema because it doesn't exist.")
+    except error.UUJsonValidationError:
+        return api.Error("file_read_error", "Could not read schema because it is invalid.")
 
-    # Return JSON with schema and uischema
-    return {"schema": schema, "uischema": uischema}
+    # Return JSON with schema and uischema (a copy, callers may alter it)
+    return copy.deepcopy(schemas)
 
 
 @api.make()
@@ -669,14 +721,16 @@ def datarequest_data_valid(ctx, data, schema_name=False, schema=False):
                          "No schema specified (neither a schema name nor a schema was given).")
 
     try:
-        schema = datarequest_schema_get(ctx, schema_name)['schema'] if schema_name else schema
-
-        validator = jsonschema.Draft7Validator(schema)
+        if schema_name:
+            # Use the compiled validator of the registered schema.
+            _, validator = schema_load(ctx, schema_name)
+        else:
+            validator = jsonschema.Draft7Validator(schema)
 
         errors = list(validator.iter_errors(data))
 
         return len(errors) == 0
-    except error.UUJsonValidationError:
+    except (error.UUFileNotExistError, error.UUJsonValidationError):
         # File may be missing or not valid JSON
         return api.Error("validation_error",
                          "{} form data could not be validated against its schema.".format(schema_name))
@@ -700,6 +754,93 @@ def rule_datarequest_review_period_expiration_check(ctx):
         datarequest_process_expired_review_periods(ctx, [result['COLL_NAME'].split('/')[-1] for result in list(qcoll)])
 
 
+# Summaries of all data requests visible to a user, for browsing. Cached per
+# user and summary stamp (see _summaries_stamp()), so that metadata changes
+# made through any server are noticed. Changes made through this server drop
+# the cache right away (see metadata_changed()).
+_summaries = cache.Cache('datarequest_summaries', max_age=300, max_size=10)
+
+SUMMARY_ATTRIBUTES = ['status', 'title', 'owner', 'assignedForReview', 'reviewedBy']
+"""Data request attributes kept in data request summaries."""
+
+ARCHIVED_STATUSES = [status.PRELIMINARY_REJECT.value, status.REJECTED_AFTER_DATAMANAGER_REVIEW.value,
+                     status.REJECTED.value, status.RESUBMITTED.value, status.DATA_READY.value]
+"""Statuses of data requests that are shown as archived."""
+
+
+def metadata_changed(ctx):
+    """Drop the cached data request summaries after a change of data request metadata.
+
+    :param ctx: Combined type of a callback and rei struct
+    """
+    _summaries.invalidate()
+
+
+def _summaries_stamp(ctx, coll):
+    """Get a stamp that changes whenever the summaries of data requests change.
+
+    The stamp is read from the catalog: it consists of the number of summary
+    attributes and the time of the latest change of any of them.
+
+    :param ctx:  Combined type of a callback and rei struct
+    :param coll: Data request collection
+
+    :returns: Stamp, or None if summaries changed too recently to be cached
+    """
+    row = Query(ctx, "COUNT(META_DATA_ATTR_ID), MAX(META_DATA_MODIFY_TIME)",
+                "COLL_PARENT_NAME = '{}' AND DATA_NAME = '{}' AND META_DATA_ATTR_NAME in ('{}')"
+                .format(coll, DATAREQUEST + JSON_EXT, "', '".join(SUMMARY_ATTRIBUTES))).first()
+    count, modify_time = row if row is not None else ('0', '')
+
+    # Modify times have a resolution of a second: more changes may follow
+    # within the same second without changing the stamp.
+    if modify_time and int(modify_time) >= int(time.time()) - 1:
+        return None
+
+    return count, modify_time
+
+
+def summaries_get(ctx):
+    """Get summaries of all data requests visible to the client user.
+
+    Summaries are loaded with a single query, and cached per agent until
+    data request metadata changes.
+
+    :param ctx: Combined type of a callback and rei struct
+
+    :returns: List of dicts with id, owner name, creation time and the SUMMARY_ATTRIBUTES of every data request
+    """
+    coll = "/{}/{}".format(user.zone(ctx), DRCOLLECTION)
+
+    def load():
+        summaries = OrderedDict()
+        iter = row_iterator(
+            "COLL_NAME, COLL_CREATE_TIME, COLL_OWNER_NAME, META_DATA_ATTR_NAME, META_DATA_ATTR_VALUE",
+            "COLL_PARENT_NAME = '{}' AND DATA_NAME = '{}' AND META_DATA_ATTR_NAME in ('{}')"
+            .format(coll, DATAREQUEST + JSON_EXT, "', '".join(SUMMARY_ATTRIBUTES)),
+            AS_LIST, ctx)
+
+        for coll_name, create_time, owner_name, attr, value in iter:
+            if coll_name not in summaries:
+                summaries[coll_name] = {'id':                coll_name.split('/')[-1],
+                                        'name':              owner_name,
+                                        'create_time':       int(create_time),
+                                        'assignedForReview': [],
+                                        'reviewedBy':        []}
+            if attr in ['assignedForReview', 'reviewedBy']:
+                summaries[coll_name][attr].append(value)
+            else:
+                summaries[coll_name][attr] = value
+
+        return summaries.values()
+
+    stamp = _summaries_stamp(ctx, coll)
+    if stamp is None:
+        return load()
+
+    return _summaries.get((user.full_name(ctx), stamp), load)
+
+
 ###################################################
 #          Datarequest workflow API calls         #
 ###################################################
@@ -727,29 +868,31 @@ def api_datarequest_browse(ctx, sort_on='name', sort_order='asc', offset=0, limi
 
     dac_member = user.is_member_of(ctx, GROUP_DAC)
     coll       = "/{}/{}".format(user.zone(ctx), DRCOLLECTION)
+    username   = user.name(ctx)
 
-    def transform(row):
-        # Remove ORDER_BY etc. wrappers from column names.
-        x = {re.sub('.*\((.*)\)', '\\1', k): v for k, v in row.items()}
-
-        return {'id':          x['COLL_NAME'].split('/')[-1],
-                'name':        x['COLL_OWNER_NAME'],
-                'create_time': int(x['COLL_CREATE_TIME']),
-                'status':      x['META_DATA_ATTR_VALUE']}
-
-    def transform_title(row):
-        # Remove ORDER_BY etc. wrappers from column names.
-        x = {re.sub('.*\((.*)\)', '\\1', k): v for k, v in row.items()}
-
-        return {'id':          x['COLL_NAME'].split('/')[-1],
-                'title':       x['META_DATA_ATTR_VALUE']}
-
-    def transform_status(row):
-        # Remove ORDER_BY etc. wrappers from column names.
-        x = {re.sub('.*\((.*)\)', '\\1', k): v for k, v in row.items()}
+    # Set filter
+    def selected(x):
+        # a) Normal case
+        if not dac_member and not archived:
+            return x.get('status') not in ARCHIVED_STATUSES
+        # b) Archive case
+        elif not dac_member and archived:
+            return x.get('status') in ARCHIVED_STATUSES
+        # c1) DAC reviewable requests case
+        elif dac_member and not dacrequests and not archived:
+            return username in x['assignedForReview']
+        # c2) DAC own requests case
+        elif dac_member and dacrequests and not archived:
+            return x.get('owner') == username
+        # c3) DAC reviewed requests
+        elif dac_member and not dacrequests and archived:
+            return username in x['reviewedBy']
+        # c4) DAC own archived requests
+        else:
+            return x.get('owner') == username and x.get('status') in ARCHIVED_STATUSES
 
-        return {'id':          x['COLL_NAME'].split('/')[-1],
-                'status':      x['META_DATA_ATTR_VALUE']}
+    # Data requests without status are not listed.
+    datarequests = [x for x in summaries_get(ctx) if 'status' in x and selected(x)]
 
     if sort_on == 'modified':
         # FIXME: Sorting on modify date is borked: There appears to be no
@@ -759,74 +902,24 @@ def api_datarequest_browse(ctx, sort_on='name', sort_order='asc', offset=0, limi
         # We would want to take the max modify time *per* data name.
         # (or not? replication may take place a long time after a modification,
         #  resulting in a 'too new' date)
-        ccols = ['COLL_NAME', 'ORDER(COLL_CREATE_TIME)', "COLL_OWNER_NAME", "META_DATA_ATTR_VALUE"]
+        datarequests.sort(key=lambda x: (x['create_time'], x['id']), reverse=sort_order == 'desc')
     else:
-        ccols = ['ORDER(COLL_NAME)', 'COLL_CREATE_TIME', "COLL_OWNER_NAME", "META_DATA_ATTR_VALUE"]
+        datarequests.sort(key=lambda x: x['id'], reverse=sort_order == 'desc')
 
-    if sort_order == 'desc':
-        ccols = [x.replace('ORDER(', 'ORDER_DESC(') for x in ccols]
+    offset = int(offset)
+    page = datarequests[offset:offset + int(limit)]
 
-    # Build query
-    #
-    # Set filter
-    #
-    # a) Normal case
-    if not dac_member and not archived:
-        criteria = "COLL_PARENT_NAME = '{}' AND DATA_NAME = '{}' AND META_DATA_ATTR_NAME = 'status' AND META_DATA_ATTR_VALUE != 'PRELIMINARY_REJECT' && != 'REJECTED_AFTER_DATAMANAGER_REVIEW' && != 'REJECTED' && != 'RESUBMITTED' && != 'DATA_READY'".format(coll, DATAREQUEST + JSON_EXT)
-    # b) Archive case
-    elif not dac_member and archived:
-        criteria = "COLL_PARENT_NAME = '{}' AND DATA_NAME = '{}' AND META_DATA_ATTR_NAME = 'status' AND META_DATA_ATTR_VALUE = 'PRELIMINARY_REJECT' || = 'REJECTED_AFTER_DATAMANAGER_REVIEW' || = 'REJECTED' || = 'RESUBMITTED' || = 'DATA_READY'".format(coll, DATAREQUEST + JSON_EXT)
-    # c1) DAC reviewable requests case
-    elif dac_member and not dacrequests and not archived:
-        criteria = "COLL_PARENT_NAME = '{}' AND DATA_NAME = '{}' AND META_DATA_ATTR_NAME = 'assignedForReview' AND META_DATA_ATTR_VALUE in '{}'".format(coll, DATAREQUEST + JSON_EXT, user.name(ctx))
-    # c2) DAC own requests case
-    elif dac_member and dacrequests and not archived:
-        criteria = "COLL_PARENT_NAME = '{}' AND DATA_NAME = '{}' AND META_DATA_ATTR_NAME = 'owner' AND META_DATA_ATTR_VALUE in '{}'".format(coll, DATAREQUEST + JSON_EXT, user.name(ctx))
-    # c3) DAC reviewed requests
-    elif dac_member and not dacrequests and archived:
-        criteria = "COLL_PARENT_NAME = '{}' AND DATA_NAME = '{}' AND META_DATA_ATTR_NAME = 'reviewedBy' AND META_DATA_ATTR_VALUE in '{}'".format(coll, DATAREQUEST + JSON_EXT, user.name(ctx))
-    #
-    qcoll = Query(ctx, ccols, criteria, offset=offset, limit=limit, output=AS_DICT)
-    if len(list(qcoll)) > 0:
-        if sort_on == 'modified':
-            coll_names = [result['COLL_NAME'] for result in list(qcoll)]
-        else:
-            if sort_order == 'desc':
-                coll_names = [result['ORDER_DESC(COLL_NAME)'] for result in list(qcoll)]
-            else:
-                coll_names = [result['ORDER(COLL_NAME)'] for result in list(qcoll)]
-        qcoll_title  = Query(ctx, ccols, "META_DATA_ATTR_NAME = 'title' and COLL_NAME = '" + "' || = '".join(coll_names) + "'", offset=offset, limit=limit, output=AS_DICT)
-        qcoll_status = Query(ctx, ccols, "META_DATA_ATTR_NAME = 'status' and COLL_NAME = '" + "' || = '".join(coll_names) + "'", offset=offset, limit=limit, output=AS_DICT)
-    else:
-        return OrderedDict([('total', 0), ('items', [])])
-
-    # Execute query
-    colls = map(transform, list(qcoll))
-    #
-    # Merge datarequest title into results
-    colls_title = map(transform_title, list(qcoll_title))
-    for datarequest_title in colls_title:
-        for datarequest in colls:
-            if datarequest_title['id'] == datarequest['id']:
-                datarequest['title'] = datarequest_title['title']
-                break
-    #
-    # Merge datarequest status into results
-    colls_status = map(transform_status, list(qcoll_status))
-    for datarequest_status in colls_status:
-        for datarequest in colls:
-            if datarequest_status['id'] == datarequest['id']:
-                datarequest['status'] = datarequest_status['status']
-                break
-
-    if len(colls) == 0:
+    if len(page) == 0 and len(datarequests) == 0:
         # No results at all?
         # Make sure the collection actually exists
         if not collection.exists(ctx, coll):
             return api.Error('nonexistent', 'The given path does not exist')
         # (checking this beforehand would waste a query in the most common situation)
 
-    return OrderedDict([('total', qcoll.total_rows()), ('items', colls)])
+    fields = ['id', 'name', 'create_time', 'status', 'title']
+    items = [dict((k, x[k]) for k in fields if k in x) for x in page]
+
+    return OrderedDict([('total', len(datarequests)), ('items', items)])
 
 
 def datarequest_process_expired_review_periods(ctx, request_ids):
@@ -965,6 +1058,7 @@ def api_datarequest_submit(ctx, data, draft, draft_request_id=None):
 
     # Set the proposal fields as AVUs on the proposal JSON file
     avu_json.set_json_to_obj(ctx, file_path, "-d", "root", json.dumps(data))
+    metadata_changed(ctx)
 
     # If draft, set status
     if draft:
@@ -1456,6 +1550,7 @@ def assign_request(ctx, assignees, request_id):
 
     # ... and triggering the processing of delayed rules
     ctx.adminDatarequestActions()
+    metadata_changed(ctx)
 
 
 @api.make()
@@ -1556,6 +1651,7 @@ def api_datarequest_review_submit(ctx, data, request_id):
                                          str(len(reviewers)),
                                          status_code, status_info)
     ctx.adminDatarequestActions()
+    metadata_changed(ctx)
 
     # Set a reviewedBy attribute
     metadata_set(ctx, request_id, "reviewedBy", user.name(ctx))
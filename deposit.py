@@ -4,11 +4,9 @@
 __copyright__ = 'Copyright (c) 2021-2022, Utrecht University'
 __license__   = 'GPLv3, see LICENSE'
 
-import re
 from collections import OrderedDict
 
 import genquery
-from genquery import AS_DICT, Query
 
 import folder
 import groups
@@ -200,16 +198,15 @@ def api_deposit_overview(ctx,
 
     :returns: Dict with paginated collection contents
     """
-    def transform(row):
-        # Remove ORDER_BY etc. wrappers from column names.
-        x = {re.sub('.*\((.*)\)', '\\1', k): v for k, v in row.items()}
+    def transform(item):
+        path = '{}/{}'.format(coll, item['name'])
 
-        deposit_size = collection.size(ctx, x['COLL_NAME'])
+        deposit_size = collection.size(ctx, path)
 
         deposit_title = '(no title)'
         iter = genquery.row_iterator(
             "META_COLL_ATTR_VALUE",
-            "COLL_NAME = '{}' AND META_COLL_ATTR_NAME = 'Title'".format(x['COLL_NAME']),
+            "COLL_NAME = '{}' AND META_COLL_ATTR_NAME = 'Title'".format(path),
             genquery.AS_LIST, ctx
         )
         for row in iter:
@@ -218,50 +215,31 @@ def api_deposit_overview(ctx,
         deposit_access = ''
         iter = genquery.row_iterator(
             "META_COLL_ATTR_VALUE",
-            "COLL_NAME = '{}' AND META_COLL_ATTR_NAME = 'Data_Access_Restriction'".format(x['COLL_NAME']),
+            "COLL_NAME = '{}' AND META_COLL_ATTR_NAME = 'Data_Access_Restriction'".format(path),
             genquery.AS_LIST, ctx
         )
         for row in iter:
             deposit_access = row[0].split("-")[0].strip()
 
-        return {'name':          x['COLL_NAME'].split('/')[-1],
+        return {'name':          item['name'],
                 'type':          'coll',
-                'modify_time':   int(x['COLL_MODIFY_TIME']),
+                'modify_time':   item['modify_time'],
                 'deposit_title': deposit_title,
                 'deposit_access': deposit_access,
                 'deposit_size':  deposit_size}
 
-    if sort_on == 'modified':
-        # FIXME: Sorting on modify date is borked: There appears to be no
-        # reliable way to filter out replicas this way - multiple entries for
-        # the same file may be returned when replication takes place on a
-        # minute boundary, for example.
-        # We would want to take the max modify time *per* data name.
-        # (or not? replication may take place a long time after a modification,
-        #  resulting in a 'too new' date)
-        ccols = ['COLL_NAME', 'ORDER(COLL_MODIFY_TIME)']
-    elif sort_on == 'size':
-        ccols = ['COLL_NAME', 'COLL_MODIFY_TIME']
-    else:
-        ccols = ['ORDER(COLL_NAME)', 'COLL_MODIFY_TIME']
-
-    if sort_order == 'desc':
-        ccols = [x.replace('ORDER(', 'ORDER_DESC(') for x in ccols]
-
     zone = user.zone(ctx)
 
-    # We make offset/limit act on two queries at once, placing qdata right after qcoll.
-    qcoll = Query(ctx, ccols,
-                  "COLL_PARENT_NAME = '{}' AND COLL_NAME not like '/{}/home/vault-%' AND COLL_NAME not like '/{}/home/grp-vault-%'".format(coll, zone, zone),
-                  offset=offset, limit=limit, output=AS_DICT)
-    colls = map(transform, list(qcoll))
+    total, colls = collection.listing(ctx, coll, sort_on, sort_order, offset, limit, data=False,
+                                      exclude=['/{}/home/vault-*'.format(zone), '/{}/home/grp-vault-*'.format(zone)])
+    colls = map(transform, colls)
 
-    if len(colls) == 0:
+    if total == 0:
         # No results at all?
         # Make sure the collection actually exists.
         if not collection.exists(ctx, coll):
             return api.Error('nonexistent', 'The given path does not exist')
         # (checking this beforehand would waste a query in the most common situation)
 
-    return OrderedDict([('total', qcoll.total_rows()),
+    return OrderedDict([('total', total),
                         ('items', colls)])
@@ -1,9 +1,10 @@
 # -*- coding: utf-8 -*-
 """Functions for group management and group queries."""
 
-__copyright__ = 'Copyright (c) 2018-2022, Utrecht University'
+__copyright__ = 'Copyright (c) 2018-2023, Utrecht University'
 __license__   = 'GPLv3, see LICENSE'
 
+import copy
 import re
 from collections import OrderedDict
 from datetime import datetime
@@ -11,7 +12,6 @@ from datetime import datetime
 import genquery
 import requests
 
-import schema
 from util import *
 
 __all__ = ['api_group_data',
@@ -23,6 +23,7 @@ __all__ = ['api_group_data',
            'rule_group_check_external_user',
            'rule_group_expiration_date_validate',
            'rule_group_user_exists',
+           'rule_group_cache_invalidate',
            'api_group_search_users',
            'api_group_exists',
            'api_group_create',
@@ -36,8 +37,21 @@ __all__ = ['api_group_data',
            'api_group_remove_user_from_group']
 
 
-def getGroupData(ctx):
-    """Return groups and related data."""
+# Snapshot of all groups in the zone, shared by all group lookups of this agent.
+# Invalidated by the group management rules (see rule_group_cache_invalidate),
+# the maximum age bounds staleness after changes made outside of these rules.
+# As it may be stale, it is not used for authorization: user_role and
+# group_user_exists query the catalog.
+_group_data_cache = cache.Cache('group_data', max_age=300)
+
+
+def _load_group_data(ctx):
+    """Query groups and related data.
+
+    :param ctx: Combined type of a ctx and rei struct
+
+    :returns: Dict of group name => group data
+    """
     groups = {}
 
     # First query: obtain a list of groups with group attributes.
@@ -109,7 +123,24 @@ def getGroupData(ctx):
                 except KeyError:
                     pass
 
-    return groups.values()
+    return groups
+
+
+def _group_data(ctx):
+    """Return the (cached) snapshot of all groups in the zone.
+
+    The returned data is shared, callers must not modify it.
+
+    :param ctx: Combined type of a ctx and rei struct
+
+    :returns: Dict of group name => group data
+    """
+    return _group_data_cache.get('groups', lambda: _load_group_data(ctx))
+
+
+def getGroupData(ctx):
+    """Return groups and related data."""
+    return copy.deepcopy(_group_data(ctx).values())
 
 
 def getCategories(ctx):
@@ -192,6 +223,34 @@ def getSubcategories(ctx, category):
     return list(categories)
 
 
+def _memberships(ctx, group_name, user):
+    """Query whether a user is a member of a group and of its read-only group.
+
+    :param ctx:        Combined type of a ctx and rei struct
+    :param group_name: Group name
+    :param user:       User name, with zone
+
+    :returns: Tuple of booleans (member, reader)
+    """
+    if group_name in ["rodsadmin", "public"] or group_name.startswith(("read-", "vault-")):
+        return False, False
+
+    # Read-only groups belong to the research or initial group with the same base name.
+    read_group = None
+    if group_name.startswith(("research-", "initial-")):
+        read_group = "read-" + group_name.split("-", 1)[1]
+
+    name, zone = user.split("#", 1)
+    groups = [g for g in (group_name, read_group) if g is not None]
+    found = set(row[0] for row in genquery.row_iterator(
+        "USER_GROUP_NAME",
+        "USER_NAME = '{}' AND USER_ZONE = '{}' AND USER_GROUP_NAME in ({})"
+        .format(name, zone, ", ".join("'{}'".format(g) for g in groups)),
+        genquery.AS_LIST, ctx))
+
+    return group_name in found, read_group in found
+
+
 def user_role(ctx, group_name, user):
     """Return role of user in group.
 
@@ -201,19 +260,20 @@ def user_role(ctx, group_name, user):
 
     :returns: User role ('none' | 'reader' | 'normal' | 'manager')
     """
-    groups = getGroupData(ctx)
     if '#' not in user:
         import session_vars
         user = user + "#" + session_vars.get_map(ctx.rei)["client_user"]["irods_zone"]
 
-    groups = list(filter(lambda group: group_name == group["name"] and (user in group["read"] or user in group["members"]), groups))
+    member, reader = _memberships(ctx, group_name, user)
 
-    if groups:
-        if user in groups[0]["managers"]:
+    if member or reader:
+        if genquery.Query(ctx, "META_USER_ATTR_VALUE",
+                          "USER_TYPE = 'rodsgroup' AND USER_NAME = '{}' AND META_USER_ATTR_NAME = 'manager'"
+                          " AND META_USER_ATTR_VALUE = '{}'".format(group_name, user)).first() is not None:
             return "manager"
-        elif user in groups[0]["members"]:
+        elif member:
             return "normal"
-        elif user in groups[0]["read"]:
+        else:
             return "reader"
     else:
         return "none"
@@ -284,6 +344,12 @@ def api_group_data(ctx):
     # Sort groups on name.
     groups = sorted(groups, key=lambda d: d['name'])
 
+    # Categories that have a metadata schema, used for groups without a schema_id of their own.
+    schema_categories = set(pathutil.basename(row[0]) for row in genquery.row_iterator(
+        "COLL_NAME",
+        "COLL_PARENT_NAME = '/{}/yoda/schemas' AND DATA_NAME = 'metadata.json'".format(user.zone(ctx)),
+        genquery.AS_LIST, ctx))
+
     group_hierarchy = OrderedDict()
     for group in groups:
         group['members'] = sorted(group['members'])
@@ -308,9 +374,9 @@ def api_group_data(ctx):
             group_hierarchy[group['category']][group['subcategory']] = OrderedDict()
 
         # Check whether schema_id is present on group level.
-        # If not, collect it from the corresponding category
+        # If not, collect it from the corresponding category (see schema.get_group_category).
         if "schema_id" not in group:
-            group["schema_id"] = schema.get_group_category(ctx, user.zone(ctx), group['name'])
+            group["schema_id"] = group['category'] if group['category'] in schema_categories else 'default'
 
         group_hierarchy[group['category']][group['subcategory']][group['name']] = {
             'description': group['description'] if 'description' in group else '',
@@ -512,8 +578,13 @@ def apply_data(ctx, data, allow_update, delete_users):
 
         # Now add the users and set their role if other than member
         allusers = managers + members + viewers
+
+        # Look up current roles before changing anything, every change below
+        # invalidates the group data cache.
+        currentroles = {username: user_role(ctx, groupname, username) for username in set(allusers)}
+
         for username in list(set(allusers)):   # duplicates removed
-            currentrole = user_role(ctx, groupname, username)
+            currentrole = currentroles[username]
             if currentrole == "none":
                 response = ctx.uuGroupUserAdd(groupname, username, '', '')['arguments']
                 status = response[2]
@@ -731,17 +802,29 @@ def _are_roles_equivalent(a, b):
 
 
 def group_user_exists(ctx, group_name, username, include_readonly):
-    groups = getGroupData(ctx)
     if '#' not in username:
         import session_vars
         username = username + "#" + session_vars.get_map(ctx.rei)["client_user"]["irods_zone"]
 
+    member, reader = _memberships(ctx, group_name, username)
+
     if not include_readonly:
-        groups = list(filter(lambda group: group_name == group["name"] and username in group["members"], groups))
+        return member
     else:
-        groups = list(filter(lambda group: group_name == group["name"] and (username in group["read"] or username in group["members"]), groups))
+        return member or reader
+
 
-    return len(groups) == 1
+@rule.make(inputs=[0], outputs=[])
+def rule_group_cache_invalidate(ctx, group_name):
+    """Invalidate the group data cache of all agents after a group management change.
+
+    Called by the group management rules in uuGroup.r.
+
+    :param ctx:        Combined type of a ctx and rei struct
+    :param group_name: Name of the changed group
+    """
+    log.debug(ctx, 'Invalidating group data cache after change of group <{}>', group_name)
+    _group_data_cache.invalidate()
 
 
 def rule_group_user_exists(rule_args, callback, rei):
@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 """Functions for intake module."""
 
-__copyright__ = 'Copyright (c) 2019-2021, Utrecht University'
+__copyright__ = 'Copyright (c) 2019-2023, Utrecht University'
 __license__   = 'GPLv3, see LICENSE'
 
 import fnmatch
@@ -386,18 +386,19 @@ def get_dataset_toplevel_objects(ctx, root, dataset_id):
 
 
 @api.make()
-def api_intake_scan_for_datasets(ctx, coll):
+def api_intake_scan_for_datasets(ctx, coll, full=False):
     """The toplevel of a dataset can be determined by attribute 'dataset_toplevel'
     and can either be a collection or a data_object.
 
     :param ctx:  Combined type of a callback and rei struct
     :param coll: Collection to scan for datasets
+    :param full: Scan all objects, instead of only objects that changed since the last scan
 
     :returns: indication correct
     """
 
     if _intake_check_authorized_to_scan(ctx, coll):
-        _intake_scan_for_datasets(ctx, coll)
+        _intake_scan_for_datasets(ctx, coll, incremental=not full)
     else:
         return {}
 
@@ -442,19 +443,20 @@ def _intake_check_authorized_to_scan(ctx, coll):
         return False
 
 
-def _intake_scan_for_datasets(ctx, coll, tl_datasets_log_target=''):
+def _intake_scan_for_datasets(ctx, coll, tl_datasets_log_target='', incremental=True):
     """Internal function for actually running intake scan
 
     :param ctx:  Combined type of a callback and rei struct
     :param coll: Collection to scan for datasets
     :param tl_datasets_log_target: If in ['stdout', 'serverLog'] logging of toplevel datasets will take place to the specified target
+    :param incremental: Only process objects that changed since the last scan
 
     """
     scope = {"wave": "",
              "experiment_type": "",
              "pseudocode": ""}
     found_datasets = []
-    found_datasets = intake_scan.intake_scan_collection(ctx, coll, scope, False, found_datasets)
+    found_datasets = intake_scan.intake_scan_collection(ctx, coll, scope, False, found_datasets, incremental)
 
     if tl_datasets_log_target in ['stdout', 'serverLog']:
         for subscope in found_datasets:
@@ -26,8 +26,7 @@ def intake_dataset_treewalk_change_status(ctx, collection, status, timestamp, re
         try:
             avu.rmw_from_coll(ctx, collection, status, "%")
         except msi.Error as e:
-            log.write(ctx, 'ERROR REMOVE')
-            log.write(ctx, e)
+            log.error(ctx, 'Could not remove status {} from {}: {}', status, collection, e)
     else:
         log.write(ctx, 'step1 . set_on_col')
         avu.set_on_coll(ctx, collection, status, timestamp)
@@ -1,20 +1,103 @@
 # -*- coding: utf-8 -*-
-"""Functions for intake scanning."""
-
-__copyright__ = 'Copyright (c) 2019-2021, Utrecht University'
+"""Functions for intake scanning.
+
+A scan lists the tree below the scanned collection with a few queries,
+determines the intake metadata (WEPV tokens and dataset ids) of every
+collection and data object, and applies it as a diff against the current
+metadata of the object: only changed AVUs are written, in one atomic request
+per object.
+
+In incremental mode, objects that have not changed since they were last
+scanned are skipped altogether. For this, a fingerprint of every scanned
+object (path, size, modify time, lock state and intake metadata) is kept in a
+local index. Skipped objects keep their 'scanned' mark of the scan that last
+processed them. A full scan processes all objects and refreshes the index.
+"""
+
+__copyright__ = 'Copyright (c) 2019-2023, Utrecht University'
 __license__   = 'GPLv3, see LICENSE'
 
+import hashlib
 import os
 import re
+import sqlite3
 import time
 
 import genquery
 
 import intake
+import locks
 from util import *
 
+INTAKE_METADATA = ["wave",
+                   "experiment_type",
+                   "pseudocode",
+                   "version",
+                   "dataset_id",
+                   "dataset_toplevel",
+                   "error",
+                   "warning",
+                   "dataset_error",
+                   "dataset_warning",
+                   "unrecognized",
+                   "object_count",
+                   "object_errors",
+                   "object_warnings"]
+"""Intake metadata removed from objects when they are scanned."""
+
+# Add the following two attributes to remove accumulated metadata during testing.
+# "comment"
+# "scanned"
+
+_SCHEMA = ('CREATE TABLE IF NOT EXISTS fingerprints (path TEXT PRIMARY KEY, fingerprint TEXT NOT NULL)',)
+
+
+def _fingerprints():
+    """Open the scan fingerprint index."""
+    return cache.database('intake-scan', *_SCHEMA)
+
+
+def _load_fingerprints(root):
+    """Get the fingerprints of all objects below root from the last scans.
+
+    :param root: Scanned collection
 
-def intake_scan_collection(ctx, root, scope, in_dataset, found_datasets):
+    :returns: Dict of fingerprints by path
+    """
+    prefix = root + '/'
+    try:
+        rows = _fingerprints().execute('SELECT path, fingerprint FROM fingerprints WHERE substr(path, 1, ?) = ?',
+                                       (len(prefix.decode('utf-8')), prefix.decode('utf-8')))
+        return {path.encode('utf-8'): fingerprint for path, fingerprint in rows}
+    except sqlite3.Error:
+        # Without fingerprints, all objects are scanned.
+        return {}
+
+
+def _store_fingerprints(root, fingerprints):
+    """Replace the fingerprints of all objects below root.
+
+    :param root:         Scanned collection
+    :param fingerprints: Dict of fingerprints by path
+    """
+    prefix = root + '/'
+    try:
+        db = _fingerprints()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute('DELETE FROM fingerprints WHERE substr(path, 1, ?) = ?',
+                       (len(prefix.decode('utf-8')), prefix.decode('utf-8')))
+            db.executemany('INSERT OR REPLACE INTO fingerprints (path, fingerprint) VALUES (?, ?)',
+                           ((path.decode('utf-8'), fingerprint) for path, fingerprint in fingerprints.items()))
+            db.execute('COMMIT')
+        except sqlite3.Error:
+            db.execute('ROLLBACK')
+            raise
+    except sqlite3.Error:
+        pass
+
+
+def intake_scan_collection(ctx, root, scope, in_dataset, found_datasets, incremental=False):
     """Recursively scan a directory in a Youth Cohort intake.
 
     :param ctx:    Combined type of a callback and rei struct
@@ -22,84 +105,191 @@ def intake_scan_collection(ctx, root, scope, in_dataset, found_datasets):
     :param scope:     a scoped kvlist buffer
     :param in_dataset: whether this collection is within a dataset collection
     :param found_datasets: collection of subscopes that were found in order to report toplevel datasets in the scanning process
+    :param incremental: whether to skip objects that have not changed since the last scan
 
     :returns: Found datasets
     """
-    # Scan files under root
+    scan = {'tree':    _list_tree(ctx, root),
+            'known':   _load_fingerprints(root) if incremental else {},
+            'seen':    {},
+            'scanned': user.name(ctx) + ':' + str(int(time.time()))}
+
+    found_datasets = _scan_collection(ctx, scan, root, scope, in_dataset, found_datasets)
+
+    _store_fingerprints(root, scan['seen'])
+
+    return found_datasets
+
+
+def _list_tree(ctx, root):
+    """List all collections and data objects below root, with their lock attributes.
+
+    :param ctx:  Combined type of a callback and rei struct
+    :param root: Collection to list
+
+    :returns: Dict with data objects per collection ({coll: {name: (size, modify time)}}),
+              subcollections per collection ({coll: [path]}) and lock attributes per path ({path: set})
+    """
+    def in_tree(coll):
+        return coll == root or coll.startswith(root + '/')
+
+    tree = {'data': {}, 'colls': {}, 'locks': {}}
+    lock_attrs = ', '.join("'{}'".format(a) for a in locks.INTAKE_LOCK_ATTRS)
+
     iter = genquery.row_iterator(
-        "DATA_NAME, COLL_NAME",
-        "COLL_NAME = '" + root + "'",
+        "COLL_NAME, DATA_NAME, DATA_SIZE, DATA_MODIFY_TIME",
+        "COLL_NAME like '" + root + "%'",
+        genquery.AS_LIST, ctx
+    )
+    for coll, name, size, modify_time in iter:
+        if in_tree(coll):
+            objects = tree['data'].setdefault(coll, {})
+            # Of all replicas, keep the largest size and latest modify time.
+            size, modify_time = int(size or 0), int(modify_time or 0)
+            if name in objects:
+                size, modify_time = max(size, objects[name][0]), max(modify_time, objects[name][1])
+            objects[name] = (size, modify_time)
+
+    iter = genquery.row_iterator(
+        "COLL_NAME",
+        "COLL_NAME like '" + root + "/%'",
         genquery.AS_LIST, ctx
     )
     for row in iter:
-        path = row[1] + '/' + row[0]
+        if in_tree(row[0]):
+            tree['colls'].setdefault(pathutil.dirname(row[0]), []).append(row[0])
+    for children in tree['colls'].values():
+        children.sort()
+
+    iter = genquery.row_iterator(
+        "COLL_NAME, META_COLL_ATTR_NAME",
+        "COLL_NAME like '" + root + "/%' AND META_COLL_ATTR_NAME in (" + lock_attrs + ")",
+        genquery.AS_LIST, ctx
+    )
+    for coll, attr in iter:
+        if in_tree(coll):
+            tree['locks'].setdefault(coll, set()).add(attr)
+
+    iter = genquery.row_iterator(
+        "COLL_NAME, DATA_NAME, META_DATA_ATTR_NAME",
+        "COLL_NAME like '" + root + "%' AND META_DATA_ATTR_NAME in (" + lock_attrs + ")",
+        genquery.AS_LIST, ctx
+    )
+    for coll, name, attr in iter:
+        if in_tree(coll):
+            tree['locks'].setdefault(coll + '/' + name, set()).add(attr)
+
+    return tree
+
+
+def _scan_collection(ctx, scan, root, scope, in_dataset, found_datasets):
+    """Recursively scan a listed collection.
+
+    :param ctx:            Combined type of a callback and rei struct
+    :param scan:           Scan state (see intake_scan_collection())
+    :param root:           the directory to scan
+    :param scope:          a scoped kvlist buffer
+    :param in_dataset:     whether this collection is within a dataset collection
+    :param found_datasets: collection of subscopes that were found in order to report toplevel datasets
 
-        # Determene lock state for object (no collectoin
-        locked_state = object_is_locked(ctx, path, False)
+    :returns: Found datasets
+    """
+    # Scan files under root
+    objects = scan['tree']['data'].get(root, {})
+    for name in sorted(objects):
+        path = root + '/' + name
 
-        if not (locked_state['locked'] or locked_state['frozen']):
-            remove_dataset_metadata(ctx, path, False)
-            scan_mark_scanned(ctx, path, False)
         if in_dataset:
-            apply_dataset_metadata(ctx, path, scope, False, False)
+            metadata = _dataset_metadata(scope, False)
         else:
-            subscope = intake_extract_tokens_from_name(ctx, row[1], row[0], False, scope.copy())
+            subscope = intake_extract_tokens_from_name(ctx, root, name, False, scope.copy())
 
             if intake_tokens_identify_dataset(subscope):
                 # We found a top-level dataset data object.
-                subscope["dataset_directory"] = row[1]
-                apply_dataset_metadata(ctx, path, subscope, False, True)
+                subscope["dataset_directory"] = root
+                metadata = _dataset_metadata(subscope, True)
                 # For reporting purposes collect the subscopes
                 found_datasets.append(subscope)
             else:
-                # subscope["dataset_directory"] = row[1]
-                # apply_dataset_metadata(ctx, path, subscope, False, True)
-                apply_partial_metadata(ctx, subscope, path, False)
-                avu.set_on_data(ctx, path, "unrecognized", "Experiment type, wave or pseudocode missing from path")
+                metadata = _partial_metadata(subscope)
+                metadata.append(("unrecognized", "Experiment type, wave or pseudocode missing from path"))
+
+        _scan_object(ctx, scan, path, False, objects[name], metadata, True)
 
     # Scan collections under root
-    iter = genquery.row_iterator(
-        "COLL_NAME",
-        "COLL_PARENT_NAME = '" + root + "'",
-        genquery.AS_LIST, ctx
-    )
-    counter = 0
-    for row in iter:
-        path = row[0]
-        counter = counter + 1
+    for path in scan['tree']['colls'].get(root, []):
+        # Locked and frozen collections are skipped, including their contents.
+        if path in scan['tree']['locks']:
+            continue
+
         dirname = pathutil.basename(path)
+        subscope = scope.copy()
+        child_in_dataset = in_dataset
+
+        if in_dataset:  # initially is False
+            metadata = _dataset_metadata(subscope, False)
+        else:
+            subscope = intake_extract_tokens_from_name(ctx, path, dirname, True, subscope)
+
+            if intake_tokens_identify_dataset(subscope):
+                child_in_dataset = True
+                # We found a top-level dataset collection.
+                subscope["dataset_directory"] = path
+                metadata = _dataset_metadata(subscope, True)
+                # For reporting purposes collect the subscopes
+                found_datasets.append(subscope)
+            else:
+                metadata = _partial_metadata(subscope)
 
-        if dirname != '/':
-            # get locked /frozen status
-            locked_state = object_is_locked(ctx, path, True)
-
-            if not (locked_state['locked'] or locked_state['frozen']):
-                remove_dataset_metadata(ctx, path, True)
-
-                subscope = scope.copy()
-                child_in_dataset = in_dataset
-
-                if in_dataset:  # initially is False
-                    apply_dataset_metadata(ctx, path, subscope, True, False)
-                    scan_mark_scanned(ctx, path, True)
-                else:
-                    subscope = intake_extract_tokens_from_name(ctx, path, dirname, True, subscope)
-
-                    if intake_tokens_identify_dataset(subscope):
-                        child_in_dataset = True
-                        # We found a top-level dataset collection.
-                        subscope["dataset_directory"] = path
-                        apply_dataset_metadata(ctx, path, subscope, True, True)
-                        # For reporting purposes collect the subscopes
-                        found_datasets.append(subscope)
-                    else:
-                        apply_partial_metadata(ctx, subscope, path, True)
-                # Go a level deeper
-                found_datasets = intake_scan_collection(ctx, path, subscope, child_in_dataset, found_datasets)
+        # Only collections within a dataset are marked as scanned.
+        _scan_object(ctx, scan, path, True, None, metadata, in_dataset)
+
+        # Go a level deeper
+        found_datasets = _scan_collection(ctx, scan, path, subscope, child_in_dataset, found_datasets)
 
     return found_datasets
 
 
+def _scan_object(ctx, scan, path, is_collection, state, metadata, mark_scanned):
+    """Apply intake metadata to a scanned object, unless it has not changed since the last scan.
+
+    Intake metadata of the object that is no longer valid is removed. Locked
+    or frozen data objects only get their intake metadata set: other intake
+    metadata is kept and they are not marked as scanned.
+
+    :param ctx:           Combined type of a callback and rei struct
+    :param scan:          Scan state (see intake_scan_collection())
+    :param path:          Path to the object
+    :param is_collection: Whether the object is a collection
+    :param state:         Size and modify time of a data object, None for collections
+    :param metadata:      List of intake metadata (attribute, value) of the object
+    :param mark_scanned:  Whether to mark the object as scanned
+    """
+    locked = sorted(scan['tree']['locks'].get(path, []))
+    fingerprint = hashlib.sha1(repr((is_collection, state, locked, metadata, mark_scanned))).hexdigest()
+    scan['seen'][path] = fingerprint
+
+    if scan['known'].get(path) == fingerprint:
+        return
+
+    batch = avu.Batch('-C' if is_collection else '-d', path)
+    if not locked:
+        for attr in INTAKE_METADATA:
+            batch.rmw(attr, '%')
+        if mark_scanned:
+            batch.set('scanned', scan['scanned'])
+    for attr, value in metadata:
+        batch.set(attr, value)
+
+    try:
+        batch.apply(ctx)
+    except msi.Error as e:
+        log.write(ctx, "Warning: unable to apply intake metadata to {}".format(path))
+        log.write(ctx, "Applying metadata failed with exception {}".format(str(e)))
+        # Scan the object again next time.
+        del scan['seen'][path]
+
+
 def object_is_locked(ctx, path, is_collection):
     """Returns whether given object in path (collection or dataobject) is locked or frozen
 
@@ -252,94 +442,14 @@ def intake_extract_tokens(ctx, string):
     return foundKVs
 
 
-def remove_dataset_metadata(ctx, path, is_collection):
-    """Remove all intake metadata from dataset.
+def _dataset_metadata(scope, is_top_level):
+    """Get the dataset metadata of an object in a dataset.
 
-    :param ctx:           Combined type of a callback and rei struct
-    :param path:          Path to collection or data object
-    :param is_collection: Whether is a collection or data object
-    """
-    intake_metadata = ["wave",
-                       "experiment_type",
-                       "pseudocode",
-                       "version",
-                       "dataset_id",
-                       "dataset_toplevel",
-                       "error",
-                       "warning",
-                       "dataset_error",
-                       "dataset_warning",
-                       "unrecognized",
-                       "object_count",
-                       "object_errors",
-                       "object_warnings"]
-    intake_metadata_set = set(intake_metadata)
-
-    # Add the following two lines to remove accumulated metadata during testing.
-    # "comment"
-    # "scanned"]
+    :param scope:        A scanner scope containing WEPV values
+    :param is_top_level: If true, a dataset_toplevel field will be set on the object
 
-    if is_collection:
-        iter = genquery.row_iterator(
-            "COLL_ID, META_COLL_ATTR_NAME, META_COLL_ATTR_VALUE",
-            "COLL_NAME = '" + path + "'",
-            genquery.AS_LIST, ctx
-        )
-    else:
-        iter = genquery.row_iterator(
-            "DATA_ID, META_DATA_ATTR_NAME, META_DATA_ATTR_VALUE",
-            "COLL_NAME = '" + pathutil.dirname(path) + "' AND DATA_NAME = '" + pathutil.basename(path) + "'",
-            genquery.AS_LIST, ctx
-        )
-
-    for _row in iter:
-        metadata_name = _row[1]
-        if metadata_name in intake_metadata_set:
-            if is_collection:
-                try:
-                    avu.rmw_from_coll(ctx, path, metadata_name, '%')
-                except Exception as e:
-                    log.write(ctx, "Warning: unable to remove metadata attr {} from {}".format(metadata_name, path))
-                    log.write(ctx, "Removing metadata failed with exception {}".format(str(e)))
-            else:
-                try:
-                    avu.rmw_from_data(ctx, path, metadata_name, '%')
-                except Exception as e:
-                    log.write(ctx, "Warning: unable to remove metadata attr {} from {}".format(metadata_name, path))
-                    log.write(ctx, "Removing metadata failed with exception {}".format(str(e)))
-
-
-def scan_mark_scanned(ctx, path, is_collection):
-    """Sets the username of the scanner and a timestamp as metadata on the scanned object.
-
-    :param ctx:           Combined type of a callback and rei struct
-    :param path:          Path on which to add scan indication to
-    :param is_collection: Is scanned object a collection?
+    :returns: List of metadata (attribute, value)
     """
-    timestamp = int(time.time())
-    user_and_timestamp = user.name(ctx) + ':' + str(timestamp)  # str(datetime.date.today())
-
-    if is_collection:
-        avu.set_on_coll(ctx, path, 'scanned', user_and_timestamp)
-    else:
-        avu.set_on_data(ctx, path, 'scanned', user_and_timestamp)
-
-
-def apply_dataset_metadata(ctx, path, scope, is_collection, is_top_level):
-    """Apply dataset metadata to an object in a dataset.
-
-    :param ctx:           Combined type of a callback and rei struct
-    :param path:          Path to the object
-    :param scope:         A scanner scope containing WEPV values
-    :param is_collection: Whether the object is a collection
-    :param is_top_level:  If true, a dataset_toplevel field will be set on the object
-    """
-
-#    if is_collection:
-#        avu.set_on_coll(ctx, )
-#    else:
-#        avu.set_on_data(ctx, )
-
     if "version" not in scope:
         version = "Raw"
     else:
@@ -353,42 +463,27 @@ def apply_dataset_metadata(ctx, path, scope, is_collection, is_top_level):
 
     subscope["dataset_id"] = dataset_make_id(subscope)
 
-    # add all keys to this to this level
-
-    for key in subscope:
-        if subscope[key]:
-            if is_collection:
-                avu.set_on_coll(ctx, path, key, subscope[key])
-            else:
-                avu.set_on_data(ctx, path, key, subscope[key])
+    metadata = [(key, subscope[key]) for key in sorted(subscope) if subscope[key]]
 
     if is_top_level:
         # Add dataset_id to dataset_toplevel
-        if is_collection:
-            avu.set_on_coll(ctx, path, 'dataset_toplevel', subscope["dataset_id"])
-        else:
-            avu.set_on_data(ctx, path, 'dataset_toplevel', subscope["dataset_id"])
+        metadata.append(("dataset_toplevel", subscope["dataset_id"]))
 
+    return metadata
 
-def apply_partial_metadata(ctx, scope, path, is_collection):
-    """Apply any available id component metadata to the given object.
 
-    To be called only for objects outside datasets. When inside a dataset
-    (or at a dataset toplevel), use intake_apply_dataset_metadata() instead.
+def _partial_metadata(scope):
+    """Get any available id component metadata of an object.
 
-    :param ctx:           Combined type of a callback and rei struct
-    :param scope:         A scanner scope containing some WEPV values
-    :param path:          Path to the object
-    :param is_collection: Whether the object is a collection
+    To be used only for objects outside datasets. When inside a dataset
+    (or at a dataset toplevel), use _dataset_metadata() instead.
+
+    :param scope: A scanner scope containing some WEPV values
+
+    :returns: List of metadata (attribute, value)
     """
     keys = ['wave', 'experiment_type', 'pseudocode', 'version']
-    for key in keys:
-        if key in scope:
-            if scope[key]:
-                if is_collection:
-                    avu.set_on_coll(ctx, path, key, scope[key])
-                else:
-                    avu.set_on_data(ctx, path, key, scope[key])
+    return [(key, scope[key]) for key in keys if scope.get(key)]
 
 
 def dataset_add_error(ctx, top_levels, is_collection_toplevel, text):
@@ -452,6 +547,8 @@ def intake_check_dataset(ctx, root, dataset_id):
     """Run checks on the dataset specified by the given dataset id.
 
     This function adds warnings and errors to objects within the dataset.
+    Errors of earlier checks are replaced. Toplevels of which the errors and
+    counts did not change are not written to.
 
     :param ctx:        Combined type of a callback and rei struct
     :param root:       Collection name
@@ -460,37 +557,30 @@ def intake_check_dataset(ctx, root, dataset_id):
     tl_info = intake.get_dataset_toplevel_objects(ctx, root, dataset_id)
     is_collection = tl_info['is_collection']
     tl_objects = tl_info['objects']
+    errors = []
 
     # Check validity of wav
     waves = ["20w", "30w", "0m", "5m", "10m", "3y", "6y", "9y", "12y", "15y"]
     components = dataset_parse_id(dataset_id)
     if components['wave'] not in waves:
-        dataset_add_error(ctx, tl_objects, is_collection, "The wave '" + components['wave'] + "' is not in the list of accepted waves")
+        errors.append("The wave '" + components['wave'] + "' is not in the list of accepted waves")
 
     # check presence of wave, pseudo-ID and experiment
     if '' in [components['wave'], components['experiment_type'], components['pseudocode']]:
-        dataset_add_error(ctx, tl_objects, is_collection, "Wave, experiment type or pseudo-ID missing")
+        errors.append("Wave, experiment type or pseudo-ID missing")
 
     for tl in tl_objects:
-        # Save the aggregated counts of #objects, #warnings, #errors on object level
+        batch = avu.Batch('-C' if is_collection else '-d', tl)
+        batch.rmw('dataset_error', '%')
+        batch.rmw('dataset_warning', '%')
+        for text in errors:
+            batch.associate('dataset_error', text)
 
-        count = get_aggregated_object_count(ctx, dataset_id, tl)
-        if is_collection:
-            avu.set_on_coll(ctx, tl, "object_count", str(count))
-        else:
-            avu.set_on_data(ctx, tl, "object_count", str(count))
-
-        count = get_aggregated_object_error_count(ctx, dataset_id, tl)
-        if is_collection:
-            avu.set_on_coll(ctx, tl, "object_errors", str(count))
-        else:
-            avu.set_on_data(ctx, tl, "object_errors", str(count))
-
-        count = 0
-        if is_collection:
-            avu.set_on_coll(ctx, tl, "object_warnings", str(count))
-        else:
-            avu.set_on_data(ctx, tl, "object_warnings", str(count))
+        # Save the aggregated counts of #objects, #warnings, #errors on object level
+        batch.set('object_count', str(get_aggregated_object_count(ctx, dataset_id, tl)))
+        batch.set('object_errors', str(get_aggregated_object_error_count(ctx, dataset_id, tl)))
+        batch.set('object_warnings', str(0))
+        batch.apply(ctx)
 
 
 def get_rel_paths_objects(ctx, root, dataset_id):
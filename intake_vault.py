@@ -124,7 +124,7 @@ def dataset_collection_move_2_vault(ctx, toplevel_collection, dataset_id, vault_
     try:
         collection.create(ctx, vault_parent, "1")
     except Exception:
-        log.write(ctx, "ERROR: parent collection could not be created " + vault_parent)
+        log.error(ctx, "parent collection could not be created {}", vault_parent)
         return 2
 
     # variable for treewalk interface
@@ -144,12 +144,12 @@ def dataset_collection_move_2_vault(ctx, toplevel_collection, dataset_id, vault_
         try:
             collection.remove(ctx, toplevel_collection)
         except Exception:
-            log.write(ctx, "ERROR: unable to remove intake collection " + toplevel_collection)
+            log.error(ctx, "unable to remove intake collection {}", toplevel_collection)
             return 3
     else:
         # move failed (partially), cleanup vault
         # NB: keep the dataset in the vault queue so we can retry some other time
-        log.write("ERROR: Ingest failed for " + dataset_id + ", error = " + status)
+        log.error(ctx, "Ingest failed for {}, error = {}", dataset_id, status)
         status = vault_tree_walk_collection(ctx, vault_path, buffer, vault_walk_remove_object)
 
     return status
@@ -190,14 +190,14 @@ def dataset_objects_only_move_2_vault(ctx, toplevel_collection, dataset_id, vaul
     try:
         collection.create(ctx, vault_path, "1")
     except Exception:
-        log.write(ctx, "ERROR: parent collection could not be created " + vault_path)
+        log.error(ctx, "parent collection could not be created {}", vault_path)
         return 2
 
     # stamp the vault dataset collection with default metadata
     try:
         vault_dataset_add_default_metadata(ctx, vault_path, dataset_id)
     except Exception:
-        log.write(ctx, "ERROR: default metadata could not be added to " + vault_path)
+        log.error(ctx, "default metadata could not be added to {}", vault_path)
         return 3
 
     # copy data objects to the vault
@@ -230,10 +230,10 @@ def dataset_objects_only_move_2_vault(ctx, toplevel_collection, dataset_id, vaul
         try:
             data_object.remove(ctx, intake_path, force=True)
         except Exception:
-            log.write(ctx, "ERROR: unable to remove intake object " + intake_path)
+            log.error(ctx, "unable to remove intake object {}", intake_path)
             # error occurred during ingest, cleanup vault area and relay the error to user
             # NB: keep the dataset in the vault queue so we can retry some other time
-            log.write(ctx, "ERROR: Ingest failed for *datasetId error = *status")
+            log.error(ctx, "Ingest failed for {}", dataset_id)
 
             # reset buffer interface
             buffer = {}
@@ -1,9 +1,17 @@
 # -*- coding: utf-8 -*-
-"""Functions for transforming JSON to landingpage HTML."""
+"""Functions for transforming JSON to landingpage HTML.
 
-__copyright__ = 'Copyright (c) 2019-2022, Utrecht University'
+Landing page templates are read from the templates collection of the zone
+and compiled once per agent. Compiled templates are reused as long as the
+checksum, size and modification time of the template data object do not
+change. Templates can extend or include other templates from the same
+collection.
+"""
+
+__copyright__ = 'Copyright (c) 2019-2023, Utrecht University'
 __license__   = 'GPLv3, see LICENSE'
 
+import genquery
 import jinja2
 from dateutil import parser
 
@@ -41,6 +49,76 @@ def persistent_identifier_to_uri(identifier_scheme, identifier):
     return uri
 
 
+class TemplateLoader(jinja2.BaseLoader):
+    """Jinja template loader for templates stored in an iRODS collection.
+
+    Templates are checked for changes before a compiled template is reused,
+    using the ctx of the current render.
+    """
+
+    def __init__(self, coll):
+        self.coll = coll
+        self.ctx  = None
+
+    def get_source(self, environment, template):
+        path = self.coll + '/' + template
+        stamp = template_stamp(self.ctx, path)
+        if stamp is None:
+            raise jinja2.TemplateNotFound(template)
+
+        source = data_object.read(self.ctx, path)
+        if not isinstance(source, unicode):
+            source = source.decode('utf-8')
+
+        return source, path, lambda: template_stamp(self.ctx, path) == stamp
+
+
+def template_stamp(ctx, path):
+    """Get the checksum, size and modification time of the replicas of a template.
+
+    :param ctx:  Combined type of a callback and rei struct
+    :param path: Path of the template data object
+
+    :returns: Tuple identifying the current template contents, None if the template does not exist
+    """
+    coll, name = pathutil.chop(path)
+    iter = genquery.row_iterator(
+        "DATA_CHECKSUM, DATA_SIZE, DATA_MODIFY_TIME",
+        "COLL_NAME = '{}' AND DATA_NAME = '{}'".format(coll, name),
+        genquery.AS_LIST, ctx
+    )
+    stamp = tuple(sorted(tuple(row) for row in iter))
+    return stamp if stamp else None
+
+
+_environments = {}  # Templates collection => jinja2.Environment
+
+
+def get_template(ctx, zone, template_name):
+    """Get a compiled landing page template, reusing compiled templates of this agent.
+
+    :param ctx:           Combined type of a callback and rei struct
+    :param zone:          Zone name
+    :param template_name: Name of the template in the templates collection of the zone
+
+    :returns: Compiled template
+    """
+    coll = '/' + zone + '/yoda/templates'
+    if coll not in _environments:
+        # Enable autoescaping for all templates.
+        # NOTE: autoescape is no longer an extension starting in jinja 2.9 (2017).
+        environment = jinja2.Environment(loader=TemplateLoader(coll),
+                                         autoescape=True,
+                                         auto_reload=True,
+                                         extensions=['jinja2.ext.autoescape'])
+        environment.globals['persistent_identifier_to_uri'] = persistent_identifier_to_uri
+        _environments[coll] = environment
+
+    environment = _environments[coll]
+    environment.loader.ctx = ctx
+    return environment.get_template(template_name)
+
+
 def json_landing_page_create_json_landing_page(callback, rodsZone, template_name, combiJsonPath, json_schema):
     """Get the landing page of published YoDa metadata as a string.
 
@@ -63,19 +141,12 @@ def json_landing_page_create_json_landing_page(callback, rodsZone, template_name
     dictJsonData = jsonutil.remove_empty(dictJsonData)
 
     # Load the Jinja template.
-    landingpage_template_path = '/' + rodsZone + '/yoda/templates/' + template_name
-    template = data_object.read(callback, landingpage_template_path)
-
-    # Enable autoescaping for all templates.
-    # NOTE: autoescape is no longer an extension starting in jinja 2.9 (2017).
-    Template = jinja2.Environment(autoescape=True,
-                                  extensions=['jinja2.ext.autoescape']).from_string
+    tm = get_template(callback, rodsZone, template_name)
 
     # Pre work input for render process.
     # When empty landing page, take a short cut
     if template_name == 'emptylandingpage.html.j2':
         persistent_identifier_datapackage = dictJsonData['System']['Persistent_Identifier_Datapackage']
-        tm = Template(template)
         landing_page = tm.render(persistent_identifier_datapackage=persistent_identifier_datapackage)
         return landing_page
 
@@ -268,9 +339,6 @@ def json_landing_page_create_json_landing_page(callback, rodsZone, template_name
     except KeyError:
         collection_name = ''
 
-    tm = Template(template)
-    # tm.globals['custom_function'] = custom_function
-    tm.globals['persistent_identifier_to_uri'] = persistent_identifier_to_uri
     landing_page = tm.render(
         title=title,
         description=description,
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""Functions for fast lookup of the lock state of research and deposit paths.
+
+Policies check for locks on every I/O operation in the zone. The lock state
+is read from the catalog with one query per collection and remembered for the
+rest of the rule invocation only, so that lock changes made through any
+server take effect immediately.
+"""
+
+__copyright__ = 'Copyright (c) 2023, Utrecht University'
+__license__   = 'GPLv3, see LICENSE'
+
+import genquery
+
+from util import *
+
+INTAKE_LOCK_ATTRS = ['to_vault_lock', 'to_vault_freeze']
+
+
+def _memo(ctx, key, load):
+    """Get a value that is remembered for the duration of a single rule invocation.
+
+    :param ctx:  Combined type of a callback and rei struct
+    :param key:  Key of the value
+    :param load: Function that produces the value
+
+    :returns: The remembered or loaded value
+    """
+    memo = ctx.__dict__.setdefault('_locks', {})
+    if key not in memo:
+        memo[key] = load()
+    return memo[key]
+
+
+def _in_tree(path, root):
+    """Check whether path is equal to or below root."""
+    return path == root or path.startswith(root + '/')
+
+
+def _coll_lock_roots(ctx, coll):
+    """Get the roots of the folder locks related to a collection.
+
+    Locking a folder adds a lock AVU to the folder and all of its descendants
+    and, if that succeeded, to all of its ancestors up to and including the
+    group collection. The lock AVUs of the collection and its ancestors
+    therefore include the roots of all locks on the collection and its
+    ancestors, even if locking failed partway, and the roots of all locks
+    below the collection.
+
+    :param ctx:  Combined type of a callback and rei struct
+    :param coll: A research or deposit collection
+
+    :returns: Set of locked collections
+    """
+    def load():
+        # The collection and its ancestors up to the group collection.
+        colls = [coll]
+        while colls[-1].count('/') > 3:
+            colls.append(pathutil.dirname(colls[-1]))
+
+        return frozenset(genquery.Query(ctx, "META_COLL_ATTR_VALUE",
+                                        "COLL_NAME in ({}) AND META_COLL_ATTR_NAME = '{}'"
+                                        .format(', '.join("'{}'".format(c) for c in colls),
+                                                constants.IILOCKATTRNAME)))
+
+    return _memo(ctx, ('coll', coll), load)
+
+
+def is_folder_locked(ctx, coll):
+    """Check whether a lock exists on the given collection itself or a parent collection.
+
+    Equivalent to folder.is_locked().
+
+    :param ctx:  Combined type of a callback and rei struct
+    :param coll: Collection to check for locks
+
+    :returns: Boolean indicating if folder is locked
+    """
+    return any(_in_tree(coll, root) for root in _coll_lock_roots(ctx, coll))
+
+
+def folder_has_locks(ctx, coll):
+    """Check whether a lock exists on the given collection, its parents or children.
+
+    Equivalent to folder.has_locks(). Locks below the collection are also
+    found if locking them failed before their ancestors were reached.
+
+    :param ctx:  Combined type of a callback and rei struct
+    :param coll: Collection to check for locks
+
+    :returns: Boolean indicating if folder or subfolder is locked
+    """
+    if any(_in_tree(coll, root) or _in_tree(root, coll) for root in _coll_lock_roots(ctx, coll)):
+        return True
+
+    return genquery.Query(ctx, "COLL_NAME",
+                          "COLL_NAME like '{}/%' AND META_COLL_ATTR_NAME = '{}'"
+                          .format(coll, constants.IILOCKATTRNAME)).first() is not None
+
+
+def is_data_locked(ctx, path):
+    """Check whether a lock exists on the given data object or its collection.
+
+    Equivalent to folder.is_data_locked(), which only checks the lock AVUs of
+    the data object itself, combined with is_folder_locked() on its collection.
+
+    :param ctx:  Combined type of a callback and rei struct
+    :param path: Data object to check for locks
+
+    :returns: Boolean indicating if data object is locked
+    """
+    coll, name = pathutil.chop(path)
+
+    if is_folder_locked(ctx, coll):
+        return True
+
+    def load():
+        return frozenset(genquery.Query(ctx, "META_DATA_ATTR_VALUE",
+                                        "COLL_NAME = '{}' AND DATA_NAME = '{}' AND META_DATA_ATTR_NAME = '{}'"
+                                        .format(coll, name, constants.IILOCKATTRNAME)))
+
+    return any(_in_tree(root, path) or _in_tree(path, root) for root in _memo(ctx, ('data', path), load))
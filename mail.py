@@ -1,111 +1,303 @@
 # -*- coding: utf-8 -*-
-"""Rules for sending e-mails."""
+"""Rules for sending e-mails.
 
-__copyright__ = 'Copyright (c) 2020-2022, Utrecht University'
+Mail is delivered over SMTP connections that are kept open per agent and
+reused for following mails, until they have been idle for SMTP_IDLE_TIMEOUT
+seconds.
+
+With the smtp_outbox setting enabled, send() does not wait for the mail
+server: mails are queued in a local outbox, which is delivered in batches by
+rule_mail_outbox_flush (see tools/mail/mail-outbox-flush.r). Mails that
+cannot be delivered are retried with an increasing delay, and dropped after
+OUTBOX_MAX_ATTEMPTS attempts.
+
+For testing, mail can be sent to a local debugging server, e.g.
+'python -m smtpd -n -c DebuggingServer localhost:1025' with smtp_server set
+to 'smtp://localhost:1025' and smtp_auth and smtp_starttls set to 'false'.
+"""
+
+__copyright__ = 'Copyright (c) 2020-2023, Utrecht University'
 __license__   = 'GPLv3, see LICENSE'
 
 import email
 import re
 import smtplib
+import sqlite3
+import time
 from email.mime.text import MIMEText
 
 from util import *
 
-__all__ = ['rule_mail_test']
+__all__ = ['rule_mail_test',
+           'rule_mail_outbox_flush']
 
+SMTP_IDLE_TIMEOUT = 60
+"""Seconds after which an unused SMTP connection is closed instead of reused."""
 
-def send(ctx, to, actor, subject, body, cc=None):
-    """Send an e-mail with specified recipient, subject and body.
+OUTBOX_BATCH_SIZE = 100
+"""Maximum number of mails delivered per outbox flush."""
 
-    The originating address and mail server credentials are taken from the
-    ruleset configuration file.
+OUTBOX_RETRY_DELAY = 60
+"""Seconds before the first retry of an undelivered mail, doubled after every failed attempt."""
 
-    :param ctx:     Combined type of a callback and rei struct
-    :param to:      Recipient of the mail
-    :param actor:   Actor of the mail
-    :param subject: Subject of mail
-    :param body:    Body of mail
-    :param cc:      Comma-separated list of CC recipient(s) of email (optional)
+OUTBOX_MAX_ATTEMPTS = 10
+"""Number of delivery attempts after which an undelivered mail is dropped."""
 
-    :returns: API status
-    """
-    if not config.notifications_enabled:
-        log.write(ctx, 'Sending mail notifications is disabled')
-        return
 
-    if '@' not in to:
-        log.write(ctx, 'Ignoring invalid destination <{}>'.format(to))
-        return  # Silently ignore obviously invalid destinations (mimic old behavior).
+class DeliveryError(Exception):
+    """Mail could not be delivered. The info attribute is suitable for API errors."""
+
+    def __init__(self, message, info='Mail configuration error'):
+        super(DeliveryError, self).__init__(message)
+        self.info = info
 
-    log.write(ctx, u'Sending mail for <{}> to <{}>, subject <{}>'.format(actor, to, subject))
 
-    cfg = {k: getattr(config, v)
-           for k, v in [('from',      'notifications_sender_email'),
-                        ('from_name', 'notifications_sender_name'),
-                        ('reply_to',  'notifications_reply_to'),
-                        ('server',    'smtp_server')]}
+# SMTP connections {{{
 
-    if getattr(config, "smtp_auth"):
-        cfg['username'] = getattr(config, "smtp_username")
-        cfg['password'] = getattr(config, "smtp_password")
+_connections = {}  # (proto, host, port, username) => [smtp, time of last use]
 
+
+def _server():
+    """Get the protocol, host and port of the configured mail server.
+
+    :raises DeliveryError: The mail server is configured incorrectly
+
+    :returns: Tuple of protocol, host and port
+    """
     try:
         # e.g. 'smtps://smtp.gmail.com:465' for SMTP over TLS, or
         # 'smtp://smtp.gmail.com:587' for STARTTLS on the mail submission port.
-        proto, host, port = re.search(r'^(smtps?)://([^:]+)(?::(\d+))?$', cfg['server']).groups()
+        proto, host, port = re.search(r'^(smtps?)://([^:]+)(?::(\d+))?$', config.smtp_server).groups()
 
         # Default to port 465 for SMTP over TLS, and 587 for standard mail
         # submission with STARTTLS.
         port = int(port or (465 if proto == 'smtps' else 587))
 
     except Exception as e:
-        log.write(ctx, 'Configuration error: ' + str(e))
-        return api.Error('internal', 'Mail configuration error')
+        raise DeliveryError('Configuration error: ' + str(e))
+
+    return proto, host, port
+
 
+def _connect(proto, host, port):
+    """Open an authenticated connection to the mail server.
+
+    :raises DeliveryError: Could not connect or login
+
+    :returns: SMTP connection
+    """
     try:
         smtp = (smtplib.SMTP_SSL if proto == 'smtps' else smtplib.SMTP)(host, port)
 
-        if proto != 'smtps' and getattr(config, "smtp_starttls"):
+        if proto != 'smtps' and config.smtp_starttls:
             # Enforce TLS.
             smtp.starttls()
 
     except Exception as e:
-        log.write(ctx, 'Could not connect to mail server at {}://{}:{}: {}'.format(proto, host, port, e))
-        return api.Error('internal', 'Mail configuration error')
+        raise DeliveryError('Could not connect to mail server at {}://{}:{}: {}'.format(proto, host, port, e))
 
     try:
-        if getattr(config, "smtp_auth"):
-            smtp.login(cfg['username'], cfg['password'])
+        if config.smtp_auth:
+            smtp.login(config.smtp_username, config.smtp_password)
 
     except Exception:
-        log.write(ctx, 'Could not login to mail server with configured credentials')
-        return api.Error('internal', 'Mail configuration error')
+        _close(smtp)
+        raise DeliveryError('Could not login to mail server with configured credentials')
+
+    return smtp
+
+
+def _close(smtp):
+    """Close an SMTP connection, ignoring errors."""
+    try:
+        smtp.quit()
+    except Exception:
+        try:
+            smtp.close()
+        except Exception:
+            pass
+
+
+def _connection():
+    """Get a connection to the mail server, reusing the open connection of this agent if possible.
+
+    :raises DeliveryError: Could not connect to the mail server
+
+    :returns: Tuple of key of the connection and SMTP connection
+    """
+    proto, host, port = _server()
+    key = (proto, host, port, config.smtp_username if config.smtp_auth else None)
+
+    if key in _connections:
+        smtp, used = _connections.pop(key)
+        if used > time.time() - SMTP_IDLE_TIMEOUT:
+            return key, smtp
+        _close(smtp)
+
+    return key, _connect(proto, host, port)
+
+
+def _deliver(sender, recipients, message):
+    """Deliver a mail over a (reused) connection to the mail server.
+
+    A reused connection that turns out to be closed by the server is replaced
+    by a new one.
+
+    :param sender:     Envelope sender address
+    :param recipients: List of recipient addresses
+    :param message:    Formatted mail
+
+    :raises DeliveryError: Mail could not be delivered
+    """
+    key, smtp = _connection()
+    try:
+        smtp.sendmail(sender, recipients, message)
+    except smtplib.SMTPServerDisconnected:
+        _close(smtp)
+        smtp = _connect(*key[:3])
+        try:
+            smtp.sendmail(sender, recipients, message)
+        except Exception as e:
+            _close(smtp)
+            raise DeliveryError('Could not send mail: {}'.format(e))
+    except Exception as e:
+        # The connection is not reused after errors.
+        _close(smtp)
+        raise DeliveryError('Could not send mail: {}'.format(e))
+
+    _connections[key] = [smtp, time.time()]
+
+# }}}
+# Outbox {{{
+
+
+_SCHEMA = ('CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, sender TEXT NOT NULL,'
+           ' recipients TEXT NOT NULL, message TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0,'
+           ' next_attempt REAL NOT NULL)',)
+
+
+def _outbox():
+    """Open the outbox."""
+    return cache.durable_database('mail-outbox', *_SCHEMA)
+
+
+def _text(s):
+    """Convert a string to unicode for storage in the outbox."""
+    return s if isinstance(s, unicode) else s.decode('utf-8')
+
+
+def _queue(sender, recipients, message):
+    """Add a mail to the outbox, for delivery by the next flush."""
+    _outbox().execute('INSERT INTO outbox (sender, recipients, message, next_attempt) VALUES (?, ?, ?, ?)',
+                      (_text(sender), _text(jsonutil.dump(recipients, indent=None)), _text(message), time.time()))
+
+
+def flush(ctx):
+    """Deliver mails in the outbox that are due.
+
+    Mails are claimed before delivery, so that concurrent flushes do not
+    deliver the same mail.
+
+    :param ctx: Combined type of a callback and rei struct
+
+    :returns: Tuple of number of mails delivered and failed
+    """
+    db = _outbox()
+    now = time.time()
+
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        due = db.execute('SELECT id, sender, recipients, message, attempts FROM outbox'
+                         ' WHERE next_attempt <= ? ORDER BY id LIMIT ?', (now, OUTBOX_BATCH_SIZE)).fetchall()
+        db.executemany('UPDATE outbox SET next_attempt = ? WHERE id = ?',
+                       ((now + OUTBOX_RETRY_DELAY, id) for id, _, _, _, _ in due))
+        db.execute('COMMIT')
+    except sqlite3.Error:
+        db.execute('ROLLBACK')
+        raise
+
+    delivered = 0
+    failed = 0
+    for id, sender, recipients, message, attempts in due:
+        try:
+            _deliver(sender.encode('utf-8'),
+                     [r.encode('utf-8') for r in jsonutil.parse(recipients)],
+                     message.encode('utf-8'))
+        except DeliveryError as e:
+            failed += 1
+            attempts += 1
+            if attempts >= OUTBOX_MAX_ATTEMPTS:
+                log.write(ctx, 'Dropping mail to <{}> after {} attempts: {}'.format(recipients, attempts, e))
+                db.execute('DELETE FROM outbox WHERE id = ?', (id,))
+            else:
+                log.write(ctx, 'Could not deliver mail to <{}>, retrying later: {}'.format(recipients, e))
+                db.execute('UPDATE outbox SET attempts = ?, next_attempt = ? WHERE id = ?',
+                           (attempts, time.time() + OUTBOX_RETRY_DELAY * 2 ** (attempts - 1), id))
+            continue
+
+        db.execute('DELETE FROM outbox WHERE id = ?', (id,))
+        delivered += 1
+
+    return delivered, failed
+
+# }}}
+
+
+def send(ctx, to, actor, subject, body, cc=None):
+    """Send an e-mail with specified recipient, subject and body.
+
+    The originating address and mail server credentials are taken from the
+    ruleset configuration file. With the outbox enabled, the mail is queued
+    for delivery.
+
+    :param ctx:     Combined type of a callback and rei struct
+    :param to:      Recipient of the mail
+    :param actor:   Actor of the mail
+    :param subject: Subject of mail
+    :param body:    Body of mail
+    :param cc:      Comma-separated list of CC recipient(s) of email (optional)
+
+    :returns: API status
+    """
+    if not config.notifications_enabled:
+        log.write(ctx, 'Sending mail notifications is disabled')
+        return
+
+    if '@' not in to:
+        log.write(ctx, 'Ignoring invalid destination <{}>'.format(to))
+        return  # Silently ignore obviously invalid destinations (mimic old behavior).
+
+    log.write(ctx, u'Sending mail for <{}> to <{}>, subject <{}>'.format(actor, to, subject))
 
     fmt_addr = '{} <{}>'.format
 
     msg = MIMEText(body, 'plain', 'UTF-8')
-    msg['Reply-To'] = cfg['reply_to']
+    msg['Reply-To'] = config.notifications_reply_to
     msg['Date'] = email.utils.formatdate()
-    msg['From'] = fmt_addr(cfg['from_name'], cfg['from'])
+    msg['From'] = fmt_addr(config.notifications_sender_name, config.notifications_sender_email)
     msg['To'] = to
     msg['Subject'] = subject
 
     if cc is not None:
         msg['Cc'] = cc
 
+    recipients = [to] + cc.split(',') if cc is not None else [to]
+
     try:
-        if cc is not None:
-            smtp.sendmail(cfg['from'], [to] + cc.split(','), msg.as_string())
+        if config.smtp_outbox:
+            # Catch configuration errors now rather than at delivery.
+            _server()
+            _queue(config.notifications_sender_email, recipients, msg.as_string())
         else:
-            smtp.sendmail(cfg['from'], [to], msg.as_string())
-    except Exception as e:
-        log.write(ctx, 'Could not send mail: {}'.format(e))
-        return api.Error('internal', 'Mail configuration error')
+            _deliver(config.notifications_sender_email, recipients, msg.as_string())
 
-    try:
-        smtp.quit()
-    except Exception:
-        pass
+    except DeliveryError as e:
+        log.write(ctx, str(e))
+        return api.Error('internal', e.info)
+
+    except sqlite3.Error as e:
+        log.write(ctx, 'Could not queue mail: {}'.format(e))
+        return api.Error('internal', 'Mail configuration error')
 
 
 def _wrapper(ctx, to, actor, subject, body):
@@ -132,3 +324,23 @@ Congratulations, you have sent a test mail from your Yoda system.
 Best regards,
 Yoda system
 """)
+
+
+@rule.make(inputs=[], outputs=[0])
+def rule_mail_outbox_flush(ctx):
+    """Deliver the mails in the outbox of this server that are due.
+
+    :param ctx: Combined type of a callback and rei struct
+
+    :returns: Status message
+    """
+    if user.user_type(ctx) != 'rodsadmin':
+        return 'Insufficient permissions - should only be called by rodsadmin'
+
+    try:
+        delivered, failed = flush(ctx)
+    except sqlite3.Error as e:
+        log.write(ctx, 'Flushing mail outbox failed: {}'.format(e))
+        return 'Flushing mail outbox failed'
+
+    return 'Delivered {} mails, {} failed'.format(delivered, failed)
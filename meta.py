@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 """JSON metadata handling."""
 
-__copyright__ = 'Copyright (c) 2019-2022, Utrecht University'
+__copyright__ = 'Copyright (c) 2019-2023, Utrecht University'
 __license__   = 'GPLv3, see LICENSE'
 
 import re
@@ -82,14 +82,14 @@ def get_json_metadata_errors(callback,
     :returns: List of errors in JSON object
     """
     if schema is None:
-        schema = schema_.get_active_schema(callback, metadata_path)
+        validator = schema_.get_active_schema_validator(callback, metadata_path)
+    else:
+        validator = jsonschema.Draft7Validator(schema)
 
     if metadata is None:
         metadata = jsonutil.read(callback, metadata_path)
 
     # Perform validation and filter errors.
-    validator = jsonschema.Draft7Validator(schema)
-
     errors = validator.iter_errors(metadata)
 
     if ignore_required:
@@ -287,10 +287,12 @@ def ingest_metadata_research(ctx, path):
     # validation, which does not respect our wish to ignore required
     # properties in the research area.
 
-    # Replace all metadata under this namespace.
+    # Synchronise all metadata under this namespace.
     avu_json.set_json_to_obj(ctx, coll, '-C',
                              constants.UUUSERMETADATAROOT,
-                             jsonutil.dump(metadata))
+                             jsonutil.dump(metadata),
+                             sync=True)
+    search.set_metadata(coll, search.metadata_values(metadata))
 
 
 def ingest_metadata_deposit(ctx, path):
@@ -334,68 +336,51 @@ def ingest_metadata_staging(ctx, path):
 
 def update_index_metadata(ctx, path, metadata, creation_time, data_package):
     """Update the index attributes for JSON metadata."""
-    ctx.msi_rmw_avu('-d', path, '%', '%', constants.UUFLATINDEX)
+    batch = avu.Batch('-d', path)
+    batch.rmw('%', '%', constants.UUFLATINDEX)
 
     for creator in metadata['Creator']:
         name = creator['Name']
         if 'Given_Name' in name and 'Family_Name' in name:
-            ctx.msi_add_avu('-d', path, 'Creator',
-                            name['Given_Name'] + ' ' + name['Family_Name'],
-                            constants.UUFLATINDEX)
+            batch.associate('Creator', name['Given_Name'] + ' ' + name['Family_Name'], constants.UUFLATINDEX)
         if 'Owner_Role' in creator:
-            ctx.msi_add_avu('-d', path, 'Owner_Role', creator['Owner_Role'],
-                            constants.UUFLATINDEX)
+            batch.associate('Owner_Role', creator['Owner_Role'], constants.UUFLATINDEX)
 
     if 'Contributor' in metadata:
         for contributor in metadata['Contributor']:
             name = contributor['Name']
             if 'Given_Name' in name and 'Family_Name' in name:
-                ctx.msi_add_avu('-d', path, 'Contributor',
-                                name['Given_Name'] + ' ' + name['Family_Name'],
-                                constants.UUFLATINDEX)
+                batch.associate('Contributor', name['Given_Name'] + ' ' + name['Family_Name'], constants.UUFLATINDEX)
 
     if 'Tag' in metadata:
         for tag in metadata['Tag']:
-            ctx.msi_add_avu('-d', path, 'Tag', tag,
-                            constants.UUFLATINDEX)
-
-    ctx.msi_add_avu('-d', path, 'Title', metadata['Title'],
-                    constants.UUFLATINDEX)
-    ctx.msi_add_avu('-d', path,  'Description', metadata['Description'],
-                    constants.UUFLATINDEX)
-    ctx.msi_add_avu('-d', path, 'Data_Access_Restriction',
-                    metadata['Data_Access_Restriction'], constants.UUFLATINDEX)
+            batch.associate('Tag', tag, constants.UUFLATINDEX)
+
+    batch.associate('Title', metadata['Title'], constants.UUFLATINDEX)
+    batch.associate('Description', metadata['Description'], constants.UUFLATINDEX)
+    batch.associate('Data_Access_Restriction', metadata['Data_Access_Restriction'], constants.UUFLATINDEX)
     if 'Research_Group' in metadata:
-        ctx.msi_add_avu('-d', path, 'Research_Group',
-                        metadata['Research_Group'], constants.UUFLATINDEX)
+        batch.associate('Research_Group', metadata['Research_Group'], constants.UUFLATINDEX)
     if 'Collection_Name' in metadata:
-        ctx.msi_add_avu('-d', path, 'Collection_Name',
-                        metadata['Collection_Name'], constants.UUFLATINDEX)
+        batch.associate('Collection_Name', metadata['Collection_Name'], constants.UUFLATINDEX)
     if 'Collected' in metadata:
         if 'Start_Date' in metadata['Collected']:
-            ctx.msi_add_avu('-d', path, 'Collected_Start_Year',
-                            metadata['Collected']['Start_Date'][:4],
-                            constants.UUFLATINDEX)
+            batch.associate('Collected_Start_Year', metadata['Collected']['Start_Date'][:4], constants.UUFLATINDEX)
         if 'End_Date' in metadata['Collected']:
-            ctx.msi_add_avu('-d', path, 'Collected_End_Year',
-                            metadata['Collected']['End_Date'][:4],
-                            constants.UUFLATINDEX)
+            batch.associate('Collected_End_Year', metadata['Collected']['End_Date'][:4], constants.UUFLATINDEX)
 
     if 'GeoLocation' in metadata:
         for geoLocation in metadata['GeoLocation']:
             if 'Description_Spatial' in geoLocation:
-                ctx.msi_add_avu('-d', path, 'Description_Spatial', geoLocation['Description_Spatial'],
-                                constants.UUFLATINDEX)
+                batch.associate('Description_Spatial', geoLocation['Description_Spatial'], constants.UUFLATINDEX)
 
-    ctx.msi_add_avu('-d', path, 'Creation_Time', creation_time,
-                    constants.UUFLATINDEX)
-    ctx.msi_add_avu('-d', path, 'Creation_Year',
-                    str(datetime.fromtimestamp(int(creation_time)).year),
-                    constants.UUFLATINDEX)
+    batch.associate('Creation_Time', creation_time, constants.UUFLATINDEX)
+    batch.associate('Creation_Year', str(datetime.fromtimestamp(int(creation_time)).year), constants.UUFLATINDEX)
 
     if config.enable_data_package_reference:
-        ctx.msi_add_avu('-d', path, 'Data_Package_Reference', data_package,
-                        constants.UUFLATINDEX)
+        batch.associate('Data_Package_Reference', data_package, constants.UUFLATINDEX)
+
+    batch.apply(ctx)
 
 
 def ingest_metadata_vault(ctx, path):
@@ -441,10 +426,12 @@ def ingest_metadata_vault(ctx, path):
     # Remove any remaining legacy XML-style AVUs.
     ctx.iiRemoveAVUs(coll, constants.UUUSERMETADATAPREFIX)
 
-    # Replace all metadata under this namespace.
+    # Synchronise all metadata under this namespace.
     avu_json.set_json_to_obj(ctx, coll, '-C',
                              constants.UUUSERMETADATAROOT,
-                             jsonutil.dump(metadata))
+                             jsonutil.dump(metadata),
+                             sync=True)
+    search.set_metadata(coll, search.metadata_values(metadata))
 
 # }}}
 
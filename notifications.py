@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 """Functions for user notifications."""
 
-__copyright__ = 'Copyright (c) 2021-2022, Utrecht University'
+__copyright__ = 'Copyright (c) 2021-2023, Utrecht University'
 __license__   = 'GPLv3, see LICENSE'
 
 
@@ -22,6 +22,7 @@ import settings
 from util import *
 
 __all__ = ['api_notifications_load',
+           'api_notifications_count',
            'api_notifications_dismiss',
            'api_notifications_dismiss_all',
            'rule_mail_notification_report',
@@ -31,6 +32,9 @@ __all__ = ['api_notifications_load',
 
 NOTIFICATION_KEY = constants.UUORGMETADATAPREFIX + "notification"
 
+DEPOSIT_LOOKUP_BATCH_SIZE = 50
+"""Maximum number of deposit data packages looked up per query when loading notifications."""
+
 
 def generate_random_id(ctx):
     """Generate random ID for notification."""
@@ -47,25 +51,133 @@ def set(ctx, actor, receiver, target, message):
     :param target:   Target path of the notification
     :param message:  Notification message for user
     """
-    if user.exists(ctx, receiver):
+    set_many(ctx, actor, [receiver], target, message)
+
+
+def set_many(ctx, actor, receivers, target, message):
+    """Set a user notification for multiple users and send mail notifications when configured.
+
+    Existence and mail settings of all receivers are looked up once.
+
+    :param ctx:       Combined type of a callback and rei struct
+    :param actor:     Actor of notification message
+    :param receivers: Receiving users of notification message
+    :param target:    Target path of the notification
+    :param message:   Notification message for user
+    """
+    if len(receivers) == 0:
+        return
+
+    names = ', '.join("'{}'".format(name) for name in sorted(dict.fromkeys(user.from_str(ctx, r).name for r in receivers)))
+    existing = list(Query(ctx, "USER_NAME, USER_ZONE", "USER_NAME in ({}) AND USER_TYPE != 'rodsgroup'".format(names)))
+    receivers = [r for r in receivers if tuple(user.from_str(ctx, r)) in existing]
+    if len(receivers) == 0:
+        return
+
+    mail_notifications = settings.load_many(ctx, 'mail_notifications', [user.from_str(ctx, r)[0] for r in receivers])
+
+    for receiver in receivers:
         identifier = generate_random_id(ctx)
         timestamp = int(time.time())
-        notification = {"identifier": identifier, "timestamp": timestamp, "actor": actor, "target": target, "message": message}
+        notification = {"identifier": identifier, "timestamp": timestamp, "actor": actor, "target": target,
+                        "message": message}
         ctx.uuUserModify(receiver, "{}_{}".format(NOTIFICATION_KEY, identifier), json.dumps(notification), '', '')
 
         # Send mail notification if immediate notifications are on.
         receiver = user.from_str(ctx, receiver)[0]
-        mail_notifications = settings.load(ctx, 'mail_notifications', username=receiver)
-        if mail_notifications == "IMMEDIATE":
+        if mail_notifications[receiver] == "IMMEDIATE":
             send_notification(ctx, receiver, actor, message)
 
 
+def _deposit_data(ctx, targets, submitted):
+    """Look up the title, data package reference and submitter of deposit data packages.
+
+    :param ctx:       Combined type of a callback and rei struct
+    :param targets:   Paths of deposit data packages
+    :param submitted: Paths of the deposit data packages to look up the submitter of
+
+    :returns: Dict of path => dict with 'title', 'reference' and, if found, 'submitter'
+    """
+    deposits = dict((target, {"title": '(no title)', "reference": ""}) for target in targets)
+    targets = sorted(deposits)
+
+    for i in range(0, len(targets), DEPOSIT_LOOKUP_BATCH_SIZE):
+        colls = ', '.join("'{}'".format(t) for t in targets[i:i + DEPOSIT_LOOKUP_BATCH_SIZE])
+        iter = genquery.row_iterator(
+            "COLL_NAME, META_COLL_ATTR_NAME, META_COLL_ATTR_VALUE",
+            "COLL_NAME in ({}) AND META_COLL_ATTR_NAME in ('{}', 'Title')".format(colls, constants.DATA_PACKAGE_REFERENCE),
+            genquery.AS_LIST, ctx
+        )
+        for coll, attr, value in iter:
+            deposits[coll]["title" if attr == 'Title' else "reference"] = value
+
+    submitted = sorted(submitted)
+    for i in range(0, len(submitted), DEPOSIT_LOOKUP_BATCH_SIZE):
+        colls = ', '.join("'{}'".format(t) for t in submitted[i:i + DEPOSIT_LOOKUP_BATCH_SIZE])
+        # Get actor from action log on action = "submitted for vault", latest first.
+        iter = genquery.row_iterator(
+            "order_desc(META_COLL_MODIFY_TIME), COLL_NAME, META_COLL_ATTR_VALUE",
+            "COLL_NAME in ({}) AND META_COLL_ATTR_NAME = '{}'".format(colls, constants.UUORGMETADATAPREFIX + 'action_log'),
+            genquery.AS_LIST, ctx
+        )
+        for _, coll, value in iter:
+            # value contains json encoded [str(int(time.time())), action, actor]
+            log_item_list = jsonutil.parse(value)
+            if log_item_list[1] == "submitted for vault" and "submitter" not in deposits[coll]:
+                deposits[coll]["submitter"] = log_item_list[2].split('#')[0]
+
+    return deposits
+
+
+def _display(ctx, notification, deposits):
+    """Add the data to display a notification with.
+
+    :param ctx:          Combined type of a callback and rei struct
+    :param notification: Notification
+    :param deposits:     Deposit data packages, as returned by _deposit_data()
+    """
+    notification["actor"] = user.from_str(ctx, notification["actor"])[0]
+
+    # Get data package and link from target path for research and vault packages.
+    target = notification["target"]
+    space, _, group, subpath = pathutil.info(target)
+    if space is pathutil.Space.RESEARCH:
+        notification["data_package"] = group if subpath == '' else pathutil.basename(subpath)
+        notification["link"] = "/research/browse?dir=/{}/{}".format(group, subpath)
+    elif space is pathutil.Space.VAULT:
+        notification["data_package"] = group if subpath == '' else pathutil.basename(subpath)
+        notification["link"] = "/vault/browse?dir=/{}/{}".format(group, subpath)
+
+        # Deposit situation required different information to be presented.
+        if subpath.startswith('deposit-'):
+            deposit = deposits[target]
+            notification["data_package"] = deposit["title"]
+            notification["link"] = "/vault/yoda/{}".format(deposit["reference"])
+
+            # Find real actor when
+            if notification["actor"] == 'system' and "submitter" in deposit:
+                notification["actor"] = deposit["submitter"]
+    elif target != "":
+        notification["link"] = target
+
+
+def _is_deposit(target):
+    """Check whether a notification target is a deposit data package in the vault."""
+    info = pathutil.info(target)
+    return info.space is pathutil.Space.VAULT and info.subpath.startswith('deposit-')
+
+
 @api.make()
-def api_notifications_load(ctx, sort_order="desc"):
+def api_notifications_load(ctx, sort_order="desc", offset=0, limit=0):
     """Load user notifications.
 
+    Display data is looked up for the requested notifications only, with a
+    query per batch of deposit data packages rather than per notification.
+
     :param ctx:        Combined type of a callback and rei struct
     :param sort_order: Sort order of notifications on timestamp ("asc" or "desc", default "desc")
+    :param offset:     Offset of the first notification to return
+    :param limit:      Maximum number of notifications to return (0 for all)
 
     :returns: Dict with all notifications
     """
@@ -78,67 +190,47 @@ def api_notifications_load(ctx, sort_order="desc"):
         try:
             notification = jsonutil.parse(result)
             notification["datetime"] = (datetime.fromtimestamp(notification["timestamp"])).strftime('%Y-%m-%d %H:%M')
-            notification["actor"] = user.from_str(ctx, notification["actor"])[0]
-
-            # Get data package and link from target path for research and vault packages.
-            space, _, group, subpath = pathutil.info(notification["target"])
-            if space is pathutil.Space.RESEARCH:
-                notification["data_package"] = group if subpath == '' else pathutil.basename(subpath)
-                notification["link"] = "/research/browse?dir=/{}/{}".format(group, subpath)
-            elif space is pathutil.Space.VAULT:
-                notification["data_package"] = group if subpath == '' else pathutil.basename(subpath)
-                notification["link"] = "/vault/browse?dir=/{}/{}".format(group, subpath)
-
-                # Deposit situation required different information to be presented.
-                if subpath.startswith('deposit-'):
-                    data_package_reference = ""
-                    iter = genquery.row_iterator(
-                        "META_COLL_ATTR_VALUE",
-                        "COLL_NAME = '{}' AND META_COLL_ATTR_NAME = '{}'".format(notification["target"], constants.DATA_PACKAGE_REFERENCE),
-                        genquery.AS_LIST, ctx
-                    )
-
-                    for row in iter:
-                        data_package_reference = row[0]
-
-                    deposit_title = '(no title)'
-                    iter = genquery.row_iterator(
-                        "META_COLL_ATTR_VALUE",
-                        "COLL_NAME = '{}' AND META_COLL_ATTR_NAME = 'Title'".format(notification["target"]),
-                        genquery.AS_LIST, ctx
-                    )
-                    for row in iter:
-                        deposit_title = row[0]
-
-                    notification["data_package"] = deposit_title
-                    notification["link"] = "/vault/yoda/{}".format(data_package_reference)
-
-                    # Find real actor when
-                    if notification["actor"] == 'system':
-                        # Get actor from action log on action = "submitted for vault"
-                        iter2 = genquery.row_iterator(
-                            "order_desc(META_COLL_MODIFY_TIME), META_COLL_ATTR_VALUE",
-                            "COLL_NAME = '" + notification["target"] + "' AND META_COLL_ATTR_NAME = '" + constants.UUORGMETADATAPREFIX + 'action_log' + "'",
-                            genquery.AS_LIST, ctx
-                        )
-                        for row2 in iter2:
-                            # row2 contains json encoded [str(int(time.time())), action, actor]
-                            log_item_list = jsonutil.parse(row2[1])
-                            if log_item_list[1] == "submitted for vault":
-                                notification["actor"] = log_item_list[2].split('#')[0]
-                                break
-            elif notification["target"] != "":
-                notification["link"] = notification["target"]
-
+            # Display data stored with earlier notifications may be outdated.
+            notification.pop("display", None)
             notifications.append(notification)
         except Exception:
             continue
 
     # Return notifications sorted on timestamp
-    if sort_order == "asc":
-        return sorted(notifications, key=lambda k: k['timestamp'], reverse=False)
-    else:
-        return sorted(notifications, key=lambda k: k['timestamp'], reverse=True)
+    notifications = sorted(notifications, key=lambda k: k['timestamp'], reverse=(sort_order != "asc"))
+    notifications = notifications[offset:offset + limit] if limit > 0 else notifications[offset:]
+
+    deposits = [n for n in notifications if _is_deposit(n["target"])]
+    try:
+        deposits = _deposit_data(ctx, [n["target"] for n in deposits],
+                                 [n["target"] for n in deposits if user.from_str(ctx, n["actor"])[0] == 'system'])
+    except Exception:
+        deposits = {}
+
+    displayed = []
+    for notification in notifications:
+        try:
+            _display(ctx, notification, deposits)
+            displayed.append(notification)
+        except Exception:
+            continue
+
+    return displayed
+
+
+@api.make()
+def api_notifications_count(ctx):
+    """Count user notifications.
+
+    Notifications are unread until they are dismissed.
+
+    :param ctx: Combined type of a callback and rei struct
+
+    :returns: Dict with number of unread notifications
+    """
+    count = Query(ctx, "COUNT(META_USER_ATTR_NAME)",
+                  "USER_NAME = '{}' AND USER_TYPE != 'rodsgroup' AND META_USER_ATTR_NAME like '{}_%%'".format(user.name(ctx), NOTIFICATION_KEY)).first()
+    return {"unread": int(count or 0)}
 
 
 @api.make()
@@ -284,10 +376,8 @@ def rule_process_ending_retention_packages(ctx):
                 # Send notifications to datamanager(s).
                 datamanagers = folder.get_datamanagers(ctx, '/{}/home/'.format(zone) + datamanager_group_name)
                 message = "Data package reaching end of preservation date: {}".format(formatted_date)
-                for datamanager in datamanagers:
-                    datamanager = '{}#{}'.format(*datamanager)
-                    actor = 'system'
-                    set(ctx, actor, datamanager, dp_coll, message)
+                actor = 'system'
+                set_many(ctx, actor, ['{}#{}'.format(*datamanager) for datamanager in datamanagers], dp_coll, message)
                 log.write(ctx, 'retention - Notifications set for ending retention period on {}. <{}>'.format(formatted_date, dp_coll))
 
     log.write(ctx, 'retention - Finished checking vault packages for ending retention | notified: {} | errors: {}'.format(dp_notify_count, errors))
@@ -333,11 +423,8 @@ def rule_process_groups_expiration_date(ctx):
             # Send notifications to datamanager(s).
             datamanagers = folder.get_datamanagers(ctx, '/{}/home/'.format(zone) + datamanager_group_name)
             message = "Group '{}' reached expiration date: {}".format(group_name, expiration_date)
-
-            for datamanager in datamanagers:
-                datamanager = '{}#{}'.format(*datamanager)
-                actor = 'system'
-                set(ctx, actor, datamanager, coll, message)
+            actor = 'system'
+            set_many(ctx, actor, ['{}#{}'.format(*datamanager) for datamanager in datamanagers], coll, message)
             log.write(ctx, 'group expiration date - Notifications set for group {} reaching expiration date on {}. <{}>'.format(group_name, expiration_date, coll))
 
     log.write(ctx, 'group expiration date - Finished checking research groups for reaching group expiration date | notified: {}'.format(notify_count))
@@ -359,7 +446,10 @@ def rule_process_data_access_token_expiry(ctx):
         return
 
     log.write(ctx, 'data access token - Checking for expiring data access tokens')
-    tokens = data_access_token.get_all_tokens(ctx)
+    # Only tokens expiring within the notification period (plus the day margin below) are retrieved.
+    before = datetime.combine(datetime.now().date(), datetime.min.time())
+    before += timedelta(days=2, hours=config.token_expiration_notification)
+    tokens = data_access_token.get_all_tokens(ctx, before)
     for token in tokens:
         # Calculate token expiration notification date.
         exp_time = datetime.strptime(token['exp_time'], '%Y-%m-%d %H:%M:%S.%f')
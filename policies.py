@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 """iRODS policy implementations."""
 
-__copyright__ = 'Copyright (c) 2020, Utrecht University'
+__copyright__ = 'Copyright (c) 2020-2023, Utrecht University'
 __license__   = 'GPLv3, see LICENSE'
 
 import re
@@ -9,12 +9,13 @@ import re
 import session_vars
 
 import datarequest
-import folder
+import locks
 import policies_datapackage_status
 import policies_datarequest_status
 import policies_folder_status
 import policies_intake
 import replication
+import resources
 import revisions
 from util import *
 
@@ -34,13 +35,15 @@ from util import *
 
 def can_coll_create(ctx, actor, coll):
     """Disallow creating collections in locked folders."""
-    log.debug(ctx, 'check coll create <{}>'.format(coll))
+    log.debug(ctx, 'check coll create <{}>', coll)
 
-    if pathutil.info(coll).space in [pathutil.Space.RESEARCH, pathutil.Space.DEPOSIT]:
-        if folder.is_locked(ctx, pathutil.dirname(coll)) and not user.is_admin(ctx, actor):
+    space = pathutil.info(coll).space
+
+    if space in [pathutil.Space.RESEARCH, pathutil.Space.DEPOSIT]:
+        if locks.is_folder_locked(ctx, pathutil.dirname(coll)) and not user.is_admin(ctx, actor):
             return policy.fail('Parent folder is locked')
 
-    if pathutil.info(coll).space is pathutil.Space.INTAKE:
+    elif space is pathutil.Space.INTAKE:
         if policies_intake.is_coll_in_locked_dataset(ctx, user.user_and_zone(ctx), pathutil.chop(coll)[0]):
             return policy.fail('Collection part of a locked dataset')
 
@@ -49,16 +52,18 @@ def can_coll_create(ctx, actor, coll):
 
 def can_coll_delete(ctx, actor, coll):
     """Disallow deleting collections in locked folders and collections containing locked folders."""
-    log.debug(ctx, 'check coll delete <{}>'.format(coll))
+    log.debug(ctx, 'check coll delete <{}>', coll)
 
     if re.match(r'^/[^/]+/home/[^/]+$', coll) and not user.is_admin(ctx, actor):
         return policy.fail('Cannot delete or move collections directly under /home')
 
-    if pathutil.info(coll).space in [pathutil.Space.RESEARCH, pathutil.Space.DEPOSIT]:
-        if not user.is_admin(ctx, actor) and folder.has_locks(ctx, coll):
+    space = pathutil.info(coll).space
+
+    if space in [pathutil.Space.RESEARCH, pathutil.Space.DEPOSIT]:
+        if locks.folder_has_locks(ctx, coll) and not user.is_admin(ctx, actor):
             return policy.fail('Folder or subfolder is locked')
 
-    if pathutil.info(coll).space is pathutil.Space.INTAKE:
+    elif space is pathutil.Space.INTAKE:
         if policies_intake.coll_in_path_of_locked_dataset(ctx, user.user_and_zone(ctx), coll):
             return policy.fail('Collection part of a locked dataset')
 
@@ -66,28 +71,30 @@ def can_coll_delete(ctx, actor, coll):
 
 
 def can_coll_move(ctx, actor, src, dst):
-    log.debug(ctx, 'check coll move <{}> -> <{}>'.format(src, dst))
+    log.debug(ctx, 'check coll move <{}> -> <{}>', src, dst)
 
     return policy.all(can_coll_delete(ctx, actor, src),
                       can_coll_create(ctx, actor, dst))
 
 
 def can_data_create(ctx, actor, path):
-    log.debug(ctx, 'check data create <{}>'.format(path))
+    log.debug(ctx, 'check data create <{}>', path)
+
+    space = pathutil.info(path).space
 
-    if pathutil.info(path).space in [pathutil.Space.RESEARCH, pathutil.Space.DEPOSIT]:
-        if folder.is_locked(ctx, pathutil.dirname(path)):
+    if space in [pathutil.Space.RESEARCH, pathutil.Space.DEPOSIT]:
+        if locks.is_folder_locked(ctx, pathutil.dirname(path)):
             # Parent coll locked?
             if not user.is_admin(ctx, actor):
                 return policy.fail('Folder is locked')
-        elif folder.is_data_locked(ctx, path):
+        elif locks.is_data_locked(ctx, path):
             # If the parent coll is not locked, there might still be a lock on
             # an existing destination data object (though this situation cannot
             # arise through portal actions).
             if not user.is_admin(ctx, actor):
                 return policy.fail('Destination is locked')
 
-    if pathutil.info(path).space is pathutil.Space.INTAKE:
+    elif space is pathutil.Space.INTAKE:
         if policies_intake.is_data_in_locked_dataset(ctx, user.user_and_zone(ctx), path):
             return policy.fail('Data part of a locked dataset')
 
@@ -95,15 +102,17 @@ def can_data_create(ctx, actor, path):
 
 
 def can_data_write(ctx, actor, path):
-    log.debug(ctx, 'check data write <{}>'.format(path))
+    log.debug(ctx, 'check data write <{}>', path)
+
+    space = pathutil.info(path).space
 
     # Disallow writing to locked objects in research and deposit folders.
-    if pathutil.info(path).space in [pathutil.Space.RESEARCH, pathutil.Space.DEPOSIT]:
-        if folder.is_data_locked(ctx, path) and not user.is_admin(ctx, actor):
+    if space in [pathutil.Space.RESEARCH, pathutil.Space.DEPOSIT]:
+        if locks.is_data_locked(ctx, path) and not user.is_admin(ctx, actor):
             return policy.fail('Data object is locked')
 
     # Disallow writing to locked datasets in intake.
-    if pathutil.info(path).space is pathutil.Space.INTAKE:
+    elif space is pathutil.Space.INTAKE:
         if policies_intake.is_data_in_locked_dataset(ctx, user.user_and_zone(ctx), path):
             return policy.fail('Data part of a locked dataset')
 
@@ -114,11 +123,13 @@ def can_data_delete(ctx, actor, path):
     if re.match(r'^/[^/]+/home/[^/]+$', path) and not user.is_admin(ctx, actor):
         return policy.fail('Cannot delete or move data directly under /home')
 
-    if pathutil.info(path).space in [pathutil.Space.RESEARCH, pathutil.Space.DEPOSIT]:
-        if not user.is_admin(ctx, actor) and folder.is_data_locked(ctx, path):
+    space = pathutil.info(path).space
+
+    if space in [pathutil.Space.RESEARCH, pathutil.Space.DEPOSIT]:
+        if locks.is_data_locked(ctx, path) and not user.is_admin(ctx, actor):
             return policy.fail('Folder is locked')
 
-    if pathutil.info(path).space is pathutil.Space.INTAKE:
+    elif space is pathutil.Space.INTAKE:
         if policies_intake.is_data_in_locked_dataset(ctx, user.user_and_zone(ctx), path):
             return policy.fail('Data part of a locked dataset')
 
@@ -126,12 +137,12 @@ def can_data_delete(ctx, actor, path):
 
 
 def can_data_copy(ctx, actor, src, dst):
-    log.debug(ctx, 'check data copy <{}> -> <{}>'.format(src, dst))
+    log.debug(ctx, 'check data copy <{}> -> <{}>', src, dst)
     return can_data_create(ctx, actor, dst)
 
 
 def can_data_move(ctx, actor, src, dst):
-    log.debug(ctx, 'check data move <{}> -> <{}>'.format(src, dst))
+    log.debug(ctx, 'check data move <{}> -> <{}>', src, dst)
     return policy.all(can_data_delete(ctx, actor, src),
                       can_data_create(ctx, actor, dst))
 
@@ -378,7 +389,7 @@ def py_acPreProcForModifyAVUMetadata(ctx, option, obj_type, obj_name, attr, valu
         # Research package metadata, set when saving the metadata form.
         # Allow if object is not locked.
 
-        if (not folder.is_locked(ctx, obj_name)) or user.is_admin(ctx, actor):
+        if (not locks.is_folder_locked(ctx, obj_name)) or user.is_admin(ctx, actor):
             return policy.succeed()
         else:
             return policy.fail('Folder is locked')
@@ -397,6 +408,43 @@ def py_acPreProcForModifyAVUMetadata(ctx, option, obj_type, obj_name, attr, valu
         return policy.succeed()
 
 
+# Atomic metadata operations (e.g. avu.Batch and synchronised JSON AVUs) do
+# not trigger the static metadata PEPs above.
+@policy.require()
+def pep_api_atomic_apply_metadata_operations_pre(ctx, instance_name, rs_comm, json_input, json_output):
+    log.debug(ctx, 'pep_api_atomic_apply_metadata_operations_pre')
+
+    try:
+        request = jsonutil.parse(''.join(json_input.buf[:json_input.len]))
+    except jsonutil.ParseError:
+        return policy.fail('Invalid atomic metadata operations request')
+
+    if request.get('entity_type') not in ['data_object', 'collection']:
+        # Metadata policies below only apply to data objects and collections.
+        return policy.succeed()
+
+    actor = user.user_and_zone(ctx)
+    obj_name = request.get('entity_name', '')
+    space = pathutil.info(obj_name).space
+    operations = request.get('operations', [])
+
+    for operation in operations:
+        attr = operation.get('attribute')
+        if ((space in [pathutil.Space.RESEARCH, pathutil.Space.DEPOSIT] and attr == constants.IISTATUSATTRNAME)
+           or (space is pathutil.Space.VAULT and attr == constants.IIVAULTSTATUSATTRNAME)
+           or (space is pathutil.Space.DATAREQUEST and attr == datarequest.DATAREQUESTSTATUSATTRNAME)):
+            # Status transitions are validated and processed by the static metadata PEPs only.
+            return policy.fail('Status attributes cannot be changed with atomic metadata operations')
+
+    if (request['entity_type'] == 'collection' and space is pathutil.Space.RESEARCH
+       and any(operation.get('units', '').startswith(constants.UUUSERMETADATAROOT + '_') for operation in operations)):
+        # Research package metadata, see py_acPreProcForModifyAVUMetadata.
+        if locks.is_folder_locked(ctx, obj_name) and not user.is_admin(ctx, actor):
+            return policy.fail('Folder is locked')
+
+    return policy.succeed()
+
+
 # imeta mod
 @policy.require()
 def py_acPreProcForModifyAVUMetadata_mod(ctx, *args):
@@ -462,7 +510,8 @@ def py_acPreProcForExecCmd(ctx, cmd, args, addr, hint):
     if user.is_admin(ctx, actor):
         return policy.succeed()
 
-    if config.enable_tape_archive and cmd in ['dmattr', 'dmget', 'admin-tape-archive-set-state.sh']:
+    if config.enable_tape_archive and cmd in [config.tape_archive_dmattr, config.tape_archive_dmget,
+                                              'admin-tape-archive-set-state.sh']:
         return policy.succeed()
 
     if user.is_member_of(ctx, 'priv-execcmd-all', actor):
@@ -500,10 +549,21 @@ def resource_should_trigger_policies(resource):
 
 @rule.make()
 def pep_resource_modified_post(ctx, instance_name, _ctx, out):
+    path = _ctx.map()['logical_path']
+
+    # Storage is accounted per resource, so writes of any replica (e.g. by
+    # asynchronous replication or tiering) change the storage of the group.
+    resources.storage_changed(path)
+
     if not resource_should_trigger_policies(instance_name):
         return
 
-    path = _ctx.map()['logical_path']
+    # Writes of other replicas do not change the indexed statistics or
+    # search entries.
+    if instance_name in config.resource_primary:
+        collection.invalidate_stats(path)
+        search.added(path, 'data')
+
     zone = _ctx.map()['user_rods_zone']
     username = _ctx.map()['user_user_name']
     info = pathutil.info(path)
@@ -540,8 +600,37 @@ def pep_resource_modified_post(ctx, instance_name, _ctx, out):
     revisions.resource_modified_post_revision(ctx, instance_name, zone, path)
 
 
+@rule.make()
+def py_acPostProcForCollCreate(ctx):
+    path = str(session_vars.get_map(ctx.rei)['collection']['name'])
+    collection.invalidate_stats(path)
+    search.added(path, 'coll')
+
+
+@rule.make()
+def py_acPostProcForRmColl(ctx):
+    path = str(session_vars.get_map(ctx.rei)['collection']['name'])
+    collection.invalidate_stats(path, recursive=True)
+    resources.storage_changed(path)
+    search.removed(path)
+
+
+@rule.make()
+def py_acPostProcForDelete(ctx):
+    path = str(session_vars.get_map(ctx.rei)['data_object']['object_path'])
+    collection.invalidate_stats(path)
+    resources.storage_changed(path)
+    search.removed(path)
+
+
 @rule.make()
 def py_acPostProcForObjRename(ctx, src, dst):
+    collection.invalidate_stats(src, recursive=True)
+    collection.invalidate_stats(dst, recursive=True)
+    resources.storage_changed(src)
+    resources.storage_changed(dst)
+    search.renamed(src, dst)
+
     # Update ACLs to give correct group ownership when an object is moved into
     # a different research- or grp- collection.
     info = pathutil.info(dst)
@@ -549,5 +638,11 @@ def py_acPostProcForObjRename(ctx, src, dst):
         if len(info.subpath) and info.group != pathutil.info(src).group:
             ctx.uuEnforceGroupAcl(dst)
 
+
+@rule.make()
+def py_acPostProcForModifyAccessControl(ctx, recursive, access_level, user_name, zone, path):
+    # Listings are indexed per client and depend on the client's permissions.
+    collection.invalidate_listings(path, recursive == '1')
+
 # }}}
 # }}}
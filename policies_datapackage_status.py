@@ -77,9 +77,8 @@ def post_status_transition(ctx, path, actor, status):
             # Send notifications to datamanagers.
             datamanagers = folder.get_datamanagers(ctx, path)
             message = "Data package submitted for publication"
-            for datamanager in datamanagers:
-                datamanager = '{}#{}'.format(*datamanager)
-                notifications.set(ctx, actor, datamanager, path, message)
+            notifications.set_many(ctx, actor, ['{}#{}'.format(*datamanager) for datamanager in datamanagers],
+                                   path, message)
 
     elif status is constants.vault_package_state.APPROVED_FOR_PUBLICATION:
         provenance.log_action(ctx, actor, path, "approved for publication")
@@ -105,9 +105,8 @@ def post_status_transition(ctx, path, actor, status):
             # Send notifications to datamanagers
             datamanagers = folder.get_datamanagers(ctx, path)
             message = "Data package submitted for the vault"
-            for datamanager in datamanagers:
-                datamanager = '{}#{}'.format(*datamanager)
-                notifications.set(ctx, actor, datamanager, path, message)
+            notifications.set_many(ctx, actor, ['{}#{}'.format(*datamanager) for datamanager in datamanagers],
+                                   path, message)
         else:
             # Set status to accepted for deposit groups or if research group has no datamanager.
             folder.set_status(ctx, path, constants.research_package_state.ACCEPTED)
@@ -23,7 +23,7 @@ def is_data_in_locked_dataset(ctx, actor, path):
     )
     for row in iter:
         dataset_id = row[0]
-        log.debug(ctx, 'dataset found: ' + dataset_id)
+        log.debug(ctx, 'dataset found: {}', dataset_id)
 
         # now check whether a lock exists
         # Find the toplevel and get the collection check whether is locked
@@ -54,7 +54,7 @@ def is_data_in_locked_dataset(ctx, actor, path):
             log.debug(ctx, locked_state)
             return (locked_state['locked'] or locked_state['frozen']) and not user.is_admin(ctx, actor)
         else:
-            log.debug(ctx, "Could not determine lock state of data object " + path)
+            log.debug(ctx, 'Could not determine lock state of data object {}', path)
             # Pretend presence of a lock so no unwanted data gets deleted
             return True
 
@@ -72,7 +72,7 @@ def is_coll_in_locked_dataset(ctx, actor, coll):
     )
     for row in iter:
         dataset_id = row[0]
-        log.debug(ctx, 'dataset found: ' + dataset_id)
+        log.debug(ctx, 'dataset found: {}', dataset_id)
 
         # now check whether a lock exists
         # return True
@@ -105,7 +105,7 @@ def is_coll_in_locked_dataset(ctx, actor, coll):
             log.debug(ctx, locked_state)
             return (locked_state['locked'] or locked_state['frozen']) and not user.is_admin(ctx, actor)
         else:
-            log.debug(ctx, "Could not determine lock state of data object " + path)
+            log.debug(ctx, 'Could not determine lock state of data object {}', path)
             # Pretend presence of a lock so no unwanted data gets deleted
             return True
 
@@ -124,7 +124,7 @@ def coll_in_path_of_locked_dataset(ctx, actor, coll):
 
     for row in iter:
         dataset_id = row[0]
-        log.debug(ctx, 'dataset found: ' + dataset_id)
+        log.debug(ctx, 'dataset found: {}', dataset_id)
 
     if dataset_id:
         # Now find the toplevel and get the collection check whether is locked
@@ -155,7 +155,7 @@ def coll_in_path_of_locked_dataset(ctx, actor, coll):
             log.debug(ctx, locked_state)
             return (locked_state['locked'] or locked_state['frozen']) and not user.is_admin(ctx, actor)
         else:
-            log.debug(ctx, "Could not determine lock state of data object " + path)
+            log.debug(ctx, 'Could not determine lock state of data object {}', path)
             # Pretend presence of a lock so no unwanted data gets deleted
             return True
     else:
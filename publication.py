@@ -1,10 +1,13 @@
 # -*- coding: utf-8 -*-
 """Functions for publication."""
 
-__copyright__ = 'Copyright (c) 2019-2022, Utrecht University'
+__copyright__ = 'Copyright (c) 2019-2023, Utrecht University'
 __license__   = 'GPLv3, see LICENSE'
 
+import hashlib
 import json
+import time
+from contextlib import contextmanager
 from datetime import datetime
 
 import genquery
@@ -21,7 +24,11 @@ from util import *
 __all__ = ['rule_process_publication',
            'rule_process_depublication',
            'rule_process_republication',
-           'rule_update_publication']
+           'rule_update_publication',
+           'rule_update_publications']
+
+STAGE_SLOT_WAIT_INTERVAL = 1
+"""Interval in seconds between attempts to acquire a slot for a publication update stage."""
 
 
 def get_publication_config(ctx):
@@ -69,6 +76,18 @@ def get_publication_config(ctx):
     return configKeys
 
 
+def digest(content):
+    """Compute a digest of generated publication content, to detect whether it changed.
+
+    :param content: Generated content (JSON or HTML)
+
+    :returns: Hex digest of the content
+    """
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    return hashlib.sha256(content).hexdigest()
+
+
 def generate_combi_json(ctx, publication_config, publication_state):
     """Join system metadata with the user metadata in yoda-metadata.json.
 
@@ -105,6 +124,7 @@ def generate_combi_json(ctx, publication_config, publication_state):
     json_datacite41.json_datacite41_create_combi_metadata_json(ctx, metadataJsonPath, combiJsonPath, lastModifiedDateTime, yodaDOI, publicationDate, openAccessLink, licenseUri)
 
     publication_state["combiJsonPath"] = combiJsonPath
+    publication_state["combiJsonDigest"] = digest(data_object.read(ctx, combiJsonPath))
 
 
 def generate_system_json(ctx, publication_state):
@@ -133,55 +153,72 @@ def generate_system_json(ctx, publication_state):
     publication_state["combiJsonPath"] = system_json_path
 
 
+class PublicationState(dict):
+    """Publication state of a vault package, as loaded by get_publication_state().
+
+    Besides the state itself, this keeps the state values as they are stored
+    on the vault package, so that save_publication_state() only has to
+    write the keys that changed. Saved changes are recorded in order in
+    transitions, for debugging.
+    """
+
+    def __init__(self, vault_package, stored):
+        """Create a publication state.
+
+        :param vault_package: Path to the package in the vault
+        :param stored:        Dict with state values stored on the vault package, None if unknown
+        """
+        super(PublicationState, self).__init__()
+        self.vault_package = vault_package
+        self.stored        = stored
+        self.transitions   = []  # [(time, [(key, old value, new value)])]
+
+
 def get_publication_state(ctx, vault_package):
     """The publication state is kept as metadata on the vault package.
 
+    All metadata of the vault package is read in one query.
+
     :param ctx:           Combined type of a callback and rei struct
     :param vault_package: Path to the package in the vault
 
-    :returns: Dict with state of the publication process
+    :returns: PublicationState dict with state of the publication process
     """
-    publication_state = {
-        "status": "Unknown",
-        "accessRestriction": "Closed"
-    }
-
-    publ_metadata = get_collection_metadata(ctx, vault_package, constants.UUORGMETADATAPREFIX + 'publication_')
+    prefix = constants.UUORGMETADATAPREFIX + 'publication_'
+    values = {}
+    consistent = True
+    access_restriction = None
+    license = ""
+    license_uri = ""
+
+    for a in avu.of_coll(ctx, vault_package):
+        if a.attr.startswith(prefix):
+            key = a.attr[len(prefix):]
+            # Keys stored more than once or with units cannot be updated key by key.
+            if key in values or a.unit != '':
+                consistent = False
+            values[key] = a.value
+        elif a.attr.endswith('Data_Access_Restriction'):
+            access_restriction = a.value
+        elif a.attr.endswith('License'):
+            license = a.value
+        elif a.attr == constants.UUORGMETADATAPREFIX + "license_uri":
+            license_uri = a.value
+
+    publication_state = PublicationState(vault_package, dict(values) if consistent else None)
+    publication_state["status"] = "Unknown"
+    publication_state["accessRestriction"] = "Closed"
 
     # Take over all actual values as saved earlier.
-    for key in publ_metadata.keys():
-        publication_state[key] = publ_metadata[key]
+    publication_state.update(values)
 
     # Handle access restriction.
-    iter = genquery.row_iterator(
-        "META_COLL_ATTR_VALUE",
-        "META_COLL_ATTR_NAME like '%Data_Access_Restriction' AND COLL_NAME = '" + vault_package + "'",
-        genquery.AS_LIST, ctx
-    )
-    for row in iter:
-        publication_state["accessRestriction"] = row[0]
+    if access_restriction is not None:
+        publication_state["accessRestriction"] = access_restriction
 
     # Handle license.
-    license = ""
-    iter = genquery.row_iterator(
-        "META_COLL_ATTR_VALUE",
-        "META_COLL_ATTR_NAME like '%License' AND COLL_NAME = '" + vault_package + "'",
-        genquery.AS_LIST, ctx
-    )
-    for row in iter:
-        license = row[0]
-
     if license != "":
         publication_state["license"] = license
-        license_uri = ""
-        iter = genquery.row_iterator(
-            "META_COLL_ATTR_VALUE",
-            "META_COLL_ATTR_NAME like '" + constants.UUORGMETADATAPREFIX + "license_uri" + "' AND COLL_NAME = '" + vault_package + "'",
-            genquery.AS_LIST, ctx
-        )
-        for row in iter:
-            license_uri = row[0]
-
         if license_uri != "":
             publication_state["licenseUri"] = license_uri
 
@@ -192,14 +229,54 @@ def get_publication_state(ctx, vault_package):
 def save_publication_state(ctx, vault_package, publication_state):
     """Save the publication state key-value-pairs to AVU's on the vault package.
 
+    All changes are applied in one atomic request, so that an interrupted
+    save never leaves the vault package without publication state. For a
+    state loaded with get_publication_state(), only keys that changed since
+    loading or the previous save are written, without querying the stored
+    state first.
+
     :param ctx:               Combined type of a callback and rei struct
     :param vault_package:     Path to the package in the vault
     :param publication_state: Dict with state of the publication process
     """
-    ctx.msi_rmw_avu("-C", vault_package, constants.UUORGMETADATAPREFIX + 'publication_%', "%", "%")
-    for key in publication_state.keys():
-        if publication_state[key] != "":
-            avu.set_on_coll(ctx, vault_package, constants.UUORGMETADATAPREFIX + 'publication_' + key, publication_state[key])
+    prefix = constants.UUORGMETADATAPREFIX + 'publication_'
+    state = dict((key, value if isinstance(value, basestring) else str(value))
+                 for key, value in publication_state.items() if value != "")
+    stored = getattr(publication_state, 'stored', None)
+
+    if stored is not None:
+        changes = [(key, stored.get(key), state.get(key))
+                   for key in sorted(set(stored) | set(state)) if stored.get(key) != state.get(key)]
+        if len(changes) == 0:
+            return
+
+        batch = avu.Batch('-C', vault_package)
+        for key, old, new in changes:
+            if old is not None:
+                batch.remove(prefix + key, old)
+            if new is not None:
+                batch.associate(prefix + key, new)
+        try:
+            batch.apply(ctx)
+        except msi.Error as e:
+            # The stored state was changed elsewhere in the meantime.
+            log.write(ctx, "save_publication_state: stored state of <{}> changed, saving all keys: {}".format(vault_package, e))
+            stored = None
+
+    if stored is None:
+        changes = [(key, None, value) for key, value in sorted(state.items())]
+        batch = avu.Batch('-C', vault_package)
+        batch.rmw(prefix + '%', "%", "%")
+        for key, value in state.items():
+            batch.set(prefix + key, value)
+        batch.apply(ctx)
+
+    if isinstance(publication_state, PublicationState):
+        publication_state.stored = state
+        publication_state.transitions.append((time.time(), changes))
+        if log.enabled('debug'):
+            log.debug(ctx, 'Publication state of <{}> saved: {}', vault_package,
+                      ', '.join('{}: {} -> {}'.format(key, old, new) for key, old, new in changes))
 
 
 def set_update_publication_state(ctx, vault_package):
@@ -364,9 +441,11 @@ def generate_datacite_json(ctx, publication_state):
     # Based on content of *combiJsonPath, get DataciteJson as string
     datacite_json = json_datacite41.json_datacite41_create_datacite_json(ctx, publication_state["landingPageUrl"], combiJsonPath)
 
-    data_object.write(ctx, datacite_json_path, jsonutil.dump(datacite_json))
+    datacite_json = jsonutil.dump(datacite_json)
+    data_object.write(ctx, datacite_json_path, datacite_json)
 
     publication_state["dataCiteJsonPath"] = datacite_json_path
+    publication_state["dataCiteJsonDigest"] = digest(datacite_json)
 
 
 def upload_metadata_to_datacite(ctx, publication_state, yoda_doi=None, hide=False):
@@ -478,6 +557,23 @@ def generate_landing_page(ctx, publication_state, publish):
     data_object.write(ctx, landing_page_path, landing_page_html)
 
     publication_state["landingPagePath"] = landing_page_path
+    publication_state["landingPageDigest"] = digest(landing_page_html)
+
+
+def secure_copy(ctx, argv, path):
+    """Copy a data object to a remote host with the configured secure copy command.
+
+    The command (config.publication_secure_copy, securecopy.sh by default)
+    can be replaced by a local stand-in for testing.
+
+    :param ctx:  Combined type of a callback and rei struct
+    :param argv: Arguments of the copy command, e.g. "host user destination"
+    :param path: Path of the data object to copy
+
+    :returns: iRODS error code of the copy command, negative if copying failed
+    """
+    ret = ctx.iiGenericSecureCopy(config.publication_secure_copy, argv, path, '')
+    return int(ret['arguments'][3])
 
 
 def copy_landingpage_to_public_host(ctx, random_id, publication_config, publication_state):
@@ -496,8 +592,7 @@ def copy_landingpage_to_public_host(ctx, random_id, publication_config, publicat
 
     argv = publicHost + " inbox /var/www/landingpages/" + publicPath
 
-    error = 0
-    ctx.iiGenericSecureCopy(argv, landingPagePath, error)
+    error = secure_copy(ctx, argv, landingPagePath)
     if error >= 0:
         publication_state["landingPageUploaded"] = "yes"
     else:
@@ -519,13 +614,12 @@ def copy_metadata_to_moai(ctx, random_id, publication_config, publication_state)
     combiJsonPath = publication_state["combiJsonPath"]
 
     argv = publicHost + " inbox /var/www/moai/metadata/" + yodaInstance + "/" + yodaPrefix + "/" + random_id + ".json"
-    error = 0
-    ctx.iiGenericSecureCopy(argv, combiJsonPath, error)
+    error = secure_copy(ctx, argv, combiJsonPath)
     if error >= 0:
         publication_state["oaiUploaded"] = "yes"
     else:
         publication_state["status"] = "Retry"
-        log.write(ctx, "copy_metadata_to_public: " + error)
+        log.write(ctx, "copy_metadata_to_public: " + str(error))
 
 
 def set_access_restrictions(ctx, vault_package, publication_state):
@@ -1197,18 +1291,135 @@ def rule_update_publication(ctx, vault_package, update_datacite, update_landingp
     return update_publication(ctx, vault_package, update_datacite == 'Yes', update_landingpage == 'Yes', update_moai == 'Yes')
 
 
-def update_publication(ctx, vault_package, update_datacite=False, update_landingpage=False, update_moai=False):
+@rule.make(outputs=[], transform=jsonutil.dump, handler=rule.Output.STDOUT)
+def rule_update_publications(ctx, update_datacite, update_landingpage, update_moai, worker='0', workers='1'):
+    """Update the publications of all published vault packages.
+
+    Multiple jobs can run concurrently as workers of a single run (see
+    tools/update-publications.py). Each worker only updates the packages in
+    its own partition (COLL_ID modulo the number of workers). The number of
+    packages sending to the same remote endpoint at the same time is limited
+    per stage, see stage_limit().
+
+    :param ctx:                Combined type of a callback and rei struct
+    :param update_datacite:    Flag that indicates updating DataCite
+    :param update_landingpage: Flag that indicates updating landingpage
+    :param update_moai:        Flag that indicates updating MOAI (OAI-PMH)
+    :param worker:             Index of this worker (0 <= worker < workers)
+    :param workers:            Number of concurrent workers in this run
+
+    :returns: Summary of this worker's run, with the status and stage timings of every package
+    """
+    worker, workers = int(worker), int(workers)
+    start = time.time()
+    results = []
+
+    if user.user_type(ctx) != 'rodsadmin':
+        log.write(ctx, "User is no rodsadmin")
+        return update_summary_of(results, 0)
+
+    log.write(ctx, "Update publications started (worker {}/{})".format(worker + 1, workers))
+
+    iter = genquery.row_iterator(
+        "COLL_ID, COLL_NAME",
+        "COLL_NAME like '/{}/home/vault-%' AND META_COLL_ATTR_NAME = '{}' AND META_COLL_ATTR_VALUE = '{}'"
+        .format(user.zone(ctx), constants.UUORGMETADATAPREFIX + 'vault_status', constants.vault_package_state.PUBLISHED),
+        genquery.AS_LIST, ctx
+    )
+    packages = [coll_name for coll_id, coll_name in iter if int(coll_id) % workers == worker]
+
+    for vault_package in sorted(packages):
+        package_start = time.time()
+        timings = {}
+        try:
+            status = update_publication(ctx, vault_package, update_datacite == 'Yes', update_landingpage == 'Yes', update_moai == 'Yes', timings)
+        except Exception as e:
+            # Continue with the other packages.
+            log.write(ctx, "Update publication of <{}> failed: {}".format(vault_package, e))
+            status = "Error"
+
+        results.append({'package': vault_package,
+                        'status':  status,
+                        'seconds': round(time.time() - package_start, 3),
+                        'stages':  timings})
+
+    summary = update_summary_of(results, time.time() - start)
+    log.write(ctx, "Update publications finished (worker {}/{}): {} packages, {} OK in {} seconds"
+              .format(worker + 1, workers, summary['packages'], summary['ok'], summary['seconds']))
+    return summary
+
+
+def update_summary_of(results, seconds):
+    """Create a publication update run summary.
+
+    :param results: List of results per package
+    :param seconds: Duration of the run in seconds
+
+    :returns: Dict with run summary
+    """
+    return {'packages': len(results),
+            'ok':       len([x for x in results if x['status'] == 'OK']),
+            'seconds':  int(seconds),
+            'results':  results}
+
+
+def stage_limit(stage):
+    """Get the maximum number of concurrent publication updates in a stage.
+
+    Limits are configured in 'publication_stage_limits' as a list of
+    'stage:limit' entries, for the stages that send data to a remote
+    endpoint: 'datacite', 'landingpage' and 'moai'.
+
+    :param stage: Name of the stage
+
+    :returns: Maximum number of concurrent updates in the stage, or None for no limit
+    """
+    for x in config.publication_stage_limits:
+        name, _, limit = x.partition(':')
+        if name == stage:
+            return int(limit)
+    return None
+
+
+@contextmanager
+def timed_stage(timings, stage):
+    """Record the duration of a publication update stage in timings.
+
+    Stages sending data to a remote endpoint wait for a free slot first,
+    see stage_limit(). Waiting is not included in the duration.
+
+    :param timings: Dict of stage durations
+    :param stage:   Name of the stage
+    """
+    limit = stage_limit(stage)
+    slot = None if limit is None else cache.acquire_slot('publication-' + stage, limit, STAGE_SLOT_WAIT_INTERVAL)
+    start = time.time()
+    try:
+        yield
+    finally:
+        timings[stage] = round(time.time() - start, 3)
+        cache.release(slot)
+
+
+def update_publication(ctx, vault_package, update_datacite=False, update_landingpage=False, update_moai=False, timings=None):
     """Routine to update a publication with sanity checks at every step.
 
+    Data is only sent to DataCite, the public host and MOAI when it changed
+    since it was last sent successfully. Skipped stages are recorded as
+    'skipped' in timings.
+
     :param ctx:                Combined type of a callback and rei struct
     :param vault_package:      Path to the package in the vault
     :param update_datacite:    Flag that indicates updating DataCite
     :param update_landingpage: Flag that indicates updating landingpage
     :param update_moai:        Flag that indicates updating MOAI (OAI-PMH)
+    :param timings:            Optional dict in which the duration of every stage is recorded
 
     :returns: "OK" if all went ok
     """
     publication_state = {}
+    if timings is None:
+        timings = {}
 
     log.write(ctx, "update_publication: Process vault package <{}> DataCite={} landingpage={} MOAI={}".format(vault_package, update_datacite, update_landingpage, update_moai))
 
@@ -1241,10 +1452,16 @@ def update_publication(ctx, vault_package, update_datacite=False, update_landing
     publication_state["lastModifiedDateTime"] = get_last_modified_datetime(ctx, vault_package)
 
     # Generate Combi Json consisting of user and system metadata
-    try:
-        generate_combi_json(ctx, publication_config, publication_state)
-    except msi.Error:
-        publication_state["status"] = "Unrecoverable"
+    previous_digest = publication_state.get("combiJsonDigest")
+    with timed_stage(timings, 'combi_json'):
+        try:
+            generate_combi_json(ctx, publication_config, publication_state)
+        except msi.Error:
+            publication_state["status"] = "Unrecoverable"
+
+    # Changed metadata needs to be sent to MOAI again.
+    if publication_state.get("combiJsonDigest") != previous_digest:
+        publication_state["oaiUploaded"] = ""
 
     save_publication_state(ctx, vault_package, publication_state)
 
@@ -1254,10 +1471,15 @@ def update_publication(ctx, vault_package, update_datacite=False, update_landing
     if update_datacite:
         # Generate DataCite JSON
         log.write(ctx, 'Update datacite for package {}'.format(vault_package))
-        try:
-            generate_datacite_json(ctx, publication_state)
-        except msi.Error:
-            publication_state["status"] = "Unrecoverable"
+        previous_digest = publication_state.get("dataCiteJsonDigest")
+        with timed_stage(timings, 'datacite_json'):
+            try:
+                generate_datacite_json(ctx, publication_state)
+            except msi.Error:
+                publication_state["status"] = "Unrecoverable"
+
+        if publication_state.get("dataCiteJsonDigest") != previous_digest:
+            publication_state["dataCiteMetadataPosted"] = ""
 
         save_publication_state(ctx, vault_package, publication_state)
 
@@ -1265,23 +1487,32 @@ def update_publication(ctx, vault_package, update_datacite=False, update_landing
             return publication_state["status"]
 
         # Send DataCite JSON to metadata end point
-        try:
-            upload_metadata_to_datacite(ctx, publication_state, publication_state['yodaDOI'])
-        except msi.Error:
-            publication_state["status"] = "Retry"
+        if publication_state.get("dataCiteMetadataPosted") == "yes":
+            timings['datacite'] = 'skipped'
+        else:
+            with timed_stage(timings, 'datacite'):
+                try:
+                    upload_metadata_to_datacite(ctx, publication_state, publication_state['yodaDOI'])
+                except msi.Error:
+                    publication_state["status"] = "Retry"
 
-        save_publication_state(ctx, vault_package, publication_state)
+            save_publication_state(ctx, vault_package, publication_state)
 
-        if publication_state["status"] in ["Unrecoverable", "Retry"]:
-            return publication_state["status"]
+            if publication_state["status"] in ["Unrecoverable", "Retry"]:
+                return publication_state["status"]
 
     if update_landingpage:
         # Create landing page
         log.write(ctx, 'Update landingpage for package {}'.format(vault_package))
-        try:
-            generate_landing_page(ctx, publication_state, "publish")
-        except msi.Error:
-            publication_state["status"] = "Unrecoverable"
+        previous_digest = publication_state.get("landingPageDigest")
+        with timed_stage(timings, 'landingpage_html'):
+            try:
+                generate_landing_page(ctx, publication_state, "publish")
+            except msi.Error:
+                publication_state["status"] = "Unrecoverable"
+
+        if publication_state.get("landingPageDigest") != previous_digest:
+            publication_state["landingPageUploaded"] = ""
 
         save_publication_state(ctx, vault_package, publication_state)
 
@@ -1289,22 +1520,30 @@ def update_publication(ctx, vault_package, update_datacite=False, update_landing
             return publication_state["status"]
 
         # Use secure copy to push landing page to the public host
-        random_id = publication_state["randomId"]
-        copy_landingpage_to_public_host(ctx, random_id, publication_config, publication_state)
-        save_publication_state(ctx, vault_package, publication_state)
+        if publication_state.get("landingPageUploaded") == "yes":
+            timings['landingpage'] = 'skipped'
+        else:
+            random_id = publication_state["randomId"]
+            with timed_stage(timings, 'landingpage'):
+                copy_landingpage_to_public_host(ctx, random_id, publication_config, publication_state)
+            save_publication_state(ctx, vault_package, publication_state)
 
-        if publication_state["status"] == "Retry":
-            return publication_state["status"]
+            if publication_state["status"] == "Retry":
+                return publication_state["status"]
 
     if update_moai:
         # Use secure copy to push combi JSON to MOAI server
         log.write(ctx, 'Update MOAI for package {}'.format(vault_package))
-        random_id = publication_state["randomId"]
-        copy_metadata_to_moai(ctx, random_id, publication_config, publication_state)
-        save_publication_state(ctx, vault_package, publication_state)
+        if publication_state.get("oaiUploaded") == "yes":
+            timings['moai'] = 'skipped'
+        else:
+            random_id = publication_state["randomId"]
+            with timed_stage(timings, 'moai'):
+                copy_metadata_to_moai(ctx, random_id, publication_config, publication_state)
+            save_publication_state(ctx, vault_package, publication_state)
 
-        if publication_state["status"] == "Retry":
-            return publication_state["status"]
+            if publication_state["status"] == "Retry":
+                return publication_state["status"]
 
     # Updating was a success
     publication_state["status"] = "OK"
@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
 """Functions for replication management."""
 
-__copyright__ = 'Copyright (c) 2019-2022, Utrecht University'
+__copyright__ = 'Copyright (c) 2019-2023, Utrecht University'
 __license__   = 'GPLv3, see LICENSE'
 
+import time
+
 import genquery
 import irods_types
 
@@ -11,6 +13,12 @@ from util import *
 
 __all__ = ['rule_replicate_batch']
 
+BLOCKED_CHECK_INTERVAL = 10
+"""Interval in seconds between checks whether an admin has blocked replication."""
+
+SLOT_WAIT_INTERVAL = 1
+"""Interval in seconds between attempts to acquire a transfer slot on a resource."""
+
 
 def replicate_asynchronously(ctx, path, source_resource, target_resource):
     """Schedule replication of a data object.
@@ -32,101 +40,263 @@ def replicate_asynchronously(ctx, path, source_resource, target_resource):
         pass
 
 
-@rule.make()
-def rule_replicate_batch(ctx, verbose):
+@rule.make(outputs=[], transform=jsonutil.dump, handler=rule.Output.STDOUT)
+def rule_replicate_batch(ctx, verbose, worker='0', workers='1'):
     """Scheduled replication batch job.
 
     Performs replication for all data objects marked with 'org_replication_scheduled' metadata.
     The metadata value indicates the source and destination resource.
 
+    Multiple batch jobs can run concurrently as workers of a single run. Each
+    worker only handles data objects in its own partition (DATA_ID modulo the
+    number of workers). Objects are additionally claimed while they are being
+    replicated, so that overlapping runs never replicate the same object.
+
     :param ctx:     Combined type of a callback and rei struct
     :param verbose: Whether to log verbose messages for troubleshooting ('1': yes, anything else: no)
-    """
-    count         = 0
-    count_ok      = 0
-    print_verbose = (verbose == '1')
+    :param worker:  Index of this worker (0 <= worker < workers)
+    :param workers: Number of concurrent workers in this run
 
-    attr = constants.UUORGMETADATAPREFIX + "replication_scheduled"
-    errorattr = constants.UUORGMETADATAPREFIX + "replication_failed"
+    :returns: Summary of this worker's run (objects, replicated, failed, bytes, seconds, throughput)
+    """
+    worker, workers = int(worker), int(workers)
 
     # Stop further execution if admin has blocked replication process.
     if is_replication_blocked_by_admin(ctx):
         log.write(ctx, "Batch replication job is stopped")
-    else:
-        log.write(ctx, "Batch replication job started")
-
-        # Get list of data objects scheduled for replication.
-        iter = genquery.row_iterator(
-            "ORDER(DATA_ID), COLL_NAME, DATA_NAME, META_DATA_ATTR_VALUE",
-            "META_DATA_ATTR_NAME = '{}'".format(attr),
-            genquery.AS_LIST, ctx
-        )
-        for row in iter:
-            # Stop further execution if admin has blocked replication process.
+        return summary_of(0, 0, 0, 0, 0)
+
+    log.write(ctx, "Batch replication job started (worker {}/{})", worker + 1, workers)
+
+    result = replicate_batch(ctx, worker, workers, verbose == '1')
+
+    # Total replication process completed
+    log.write(ctx, "Batch replication job finished (worker {}/{})", worker + 1, workers, **result)
+    return result
+
+
+def summary_of(objects, replicated, failed, size, seconds):
+    """Create a replication run summary.
+
+    :param objects:    Number of data objects processed
+    :param replicated: Number of data objects replicated successfully
+    :param failed:     Number of data objects that could not be replicated
+    :param size:       Number of bytes replicated
+    :param seconds:    Duration of the run in seconds
+
+    :returns: Dict with run summary, including throughput in bytes per second
+    """
+    return {'objects':    objects,
+            'replicated': replicated,
+            'failed':     failed,
+            'bytes':      size,
+            'seconds':    int(seconds),
+            'throughput': int(size / seconds) if seconds > 0 else 0}
+
+
+def replicate_batch(ctx, worker, workers, print_verbose):
+    """Replicate all scheduled data objects in the partition of a worker.
+
+    :param ctx:           Combined type of a callback and rei struct
+    :param worker:        Index of this worker (0 <= worker < workers)
+    :param workers:       Number of concurrent workers in this run
+    :param print_verbose: Whether to log verbose messages for troubleshooting
+
+    :returns: Summary of the replicated data objects
+    """
+    count      = 0
+    count_ok   = 0
+    count_fail = 0
+    size       = 0
+    start      = time.time()
+    checked    = start
+
+    attr = constants.UUORGMETADATAPREFIX + "replication_scheduled"
+
+    # Get list of data objects scheduled for replication.
+    # Data objects with multiple replicas may be listed more than once.
+    iter = genquery.row_iterator(
+        "ORDER(DATA_ID), COLL_NAME, DATA_NAME, META_DATA_ATTR_VALUE, DATA_SIZE",
+        "META_DATA_ATTR_NAME = '{}'".format(attr),
+        genquery.AS_LIST, ctx
+    )
+
+    previous = None
+    for row in iter:
+        data_id = row[0]
+        if (data_id, row[3]) == previous or int(data_id) % workers != worker:
+            continue
+        previous = (data_id, row[3])
+
+        # Stop further execution if admin has blocked replication process.
+        if time.time() - checked > BLOCKED_CHECK_INTERVAL:
             if is_replication_blocked_by_admin(ctx):
                 log.write(ctx, "Batch replication job is stopped")
                 break
+            checked = time.time()
 
-            count += 1
-            path = row[1] + "/" + row[2]
-            rescs = row[3]
-            xs = rescs.split(',')
-            if len(xs) != 2:
-                # Not replicable.
-                log.write(ctx, "ERROR - Invalid replication data for {}".format(path))
-                try:
-                    ctx.msi_add_avu('-d', path, errorattr, "Invalid,Invalid", "")
-                except Exception:
-                    pass
-
-                # Go to next record and skip further processing.
+        path = row[1] + "/" + row[2]
+        rescs = row[3]
+
+        claim = claim_object(data_id)
+        if claim is None:
+            # Being replicated by an overlapping run.
+            continue
+
+        try:
+            # Another run may have replicated the object since it was listed.
+            if not is_replication_scheduled(ctx, data_id, rescs):
                 continue
 
-            from_path = xs[0]
-            to_path = xs[1]
+            count += 1
+            if replicate_object(ctx, path, rescs, print_verbose):
+                count_ok += 1
+                size += int(row[4])
+            else:
+                count_fail += 1
+        finally:
+            release_object(claim, data_id)
 
-            if print_verbose:
-                log.write(ctx, "Batch replication: copying {} from {} to {}".format(path, from_path, to_path))
+    return summary_of(count, count_ok, count_fail, size, time.time() - start)
 
-            # Actual replication
-            try:
-                # Ensure first replica has checksum before replication.
-                msi.data_obj_chksum(ctx, path, "replNum=0", irods_types.BytesBuf())
 
-                # Workaround the PREP deadlock issue: Restrict threads to 1.
-                ofFlags = "numThreads=1++++rescName={}++++destRescName={}++++irodsAdmin=++++verifyChksum=".format(from_path, to_path)
-                msi.data_obj_repl(ctx, path, ofFlags, irods_types.BytesBuf())
-                # Mark as correctly replicated
-                count_ok += 1
-            except msi.Error as e:
-                log.write(ctx, 'ERROR - The file could not be replicated: {}'.format(str(e)))
-                try:
-                    ctx.msi_add_avu('-d', path, errorattr, "{},{}".format(from_path, to_path), "")
-                except Exception:
-                    pass
-
-            # Remove replication_scheduled flag no matter if replication succeeded or not.
-            # rods should have been given own access via policy to allow AVU changes
-            avu_deleted = False
-            try:
-                avu.rmw_from_data(ctx, path, attr, "{},{}".format(from_path, to_path))  # use wildcard cause rm_from_data causes problems
-                avu_deleted = True
-            except Exception:
-                avu_deleted = False
-
-            # Try removing attr/resc meta data again with other ACL's
-            if not avu_deleted:
-                try:
-                    # The object's ACLs may have changed.
-                    # Force the ACL and try one more time.
-                    msi.sudo_obj_acl_set(ctx, "", "own", user.full_name(ctx), path, "")
-                    avu.rmw_from_data(ctx, path, attr, "{},{}".format(from_path, to_path))  # use wildcard cause rm_from_data causes problems
-                except Exception:
-                    # error => report it but still continue
-                    log.write(ctx, "ERROR - Scheduled replication of <{}>: could not remove schedule flag".format(path))
-
-        # Total replication process completed
-        log.write(ctx, "Batch replication job finished. {}/{} objects replicated successfully.".format(count_ok, count))
+def replicate_object(ctx, path, rescs, print_verbose):
+    """Replicate a single data object and remove its replication schedule flag.
+
+    :param ctx:           Combined type of a callback and rei struct
+    :param path:          Data object to be replicated
+    :param rescs:         Value of the schedule flag ('source resource,target resource')
+    :param print_verbose: Whether to log verbose messages for troubleshooting
+
+    :returns: Boolean indicating whether replication succeeded
+    """
+    attr = constants.UUORGMETADATAPREFIX + "replication_scheduled"
+    errorattr = constants.UUORGMETADATAPREFIX + "replication_failed"
+
+    xs = rescs.split(',')
+    if len(xs) != 2:
+        # Not replicable.
+        log.error(ctx, "Invalid replication data for {}", path)
+        try:
+            ctx.msi_add_avu('-d', path, errorattr, "Invalid,Invalid", "")
+        except Exception:
+            pass
+
+        # Skip further processing.
+        return False
+
+    from_path = xs[0]
+    to_path = xs[1]
+
+    if print_verbose:
+        log.write(ctx, "Batch replication: copying {} from {} to {}", path, from_path, to_path)
+
+    # Actual replication
+    ok = False
+    slot = acquire_resource_slot(to_path)
+    try:
+        # Ensure first replica has checksum before replication.
+        msi.data_obj_chksum(ctx, path, "replNum=0", irods_types.BytesBuf())
+
+        # Workaround the PREP deadlock issue: Restrict threads to 1.
+        ofFlags = "numThreads=1++++rescName={}++++destRescName={}++++irodsAdmin=++++verifyChksum=".format(from_path, to_path)
+        msi.data_obj_repl(ctx, path, ofFlags, irods_types.BytesBuf())
+        # Mark as correctly replicated
+        ok = True
+    except msi.Error as e:
+        log.error(ctx, 'The file could not be replicated: {}', str(e))
+        try:
+            ctx.msi_add_avu('-d', path, errorattr, "{},{}".format(from_path, to_path), "")
+        except Exception:
+            pass
+    finally:
+        cache.release(slot)
+
+    # Remove replication_scheduled flag no matter if replication succeeded or not.
+    # rods should have been given own access via policy to allow AVU changes
+    avu_deleted = False
+    try:
+        avu.rmw_from_data(ctx, path, attr, "{},{}".format(from_path, to_path))  # use wildcard cause rm_from_data causes problems
+        avu_deleted = True
+    except Exception:
+        avu_deleted = False
+
+    # Try removing attr/resc meta data again with other ACL's
+    if not avu_deleted:
+        try:
+            # The object's ACLs may have changed.
+            # Force the ACL and try one more time.
+            msi.sudo_obj_acl_set(ctx, "", "own", user.full_name(ctx), path, "")
+            avu.rmw_from_data(ctx, path, attr, "{},{}".format(from_path, to_path))  # use wildcard cause rm_from_data causes problems
+        except Exception:
+            # error => report it but still continue
+            log.error(ctx, "Scheduled replication of <{}>: could not remove schedule flag", path)
+
+    return ok
+
+
+def is_replication_scheduled(ctx, data_id, rescs):
+    """Check whether a data object still has a given replication schedule flag.
+
+    :param ctx:     Combined type of a callback and rei struct
+    :param data_id: Data object id
+    :param rescs:   Value of the schedule flag ('source resource,target resource')
+
+    :returns: Boolean indicating whether the data object is still scheduled for replication
+    """
+    return genquery.Query(ctx, "DATA_ID",
+                          "DATA_ID = '{}' AND META_DATA_ATTR_NAME = '{}' AND META_DATA_ATTR_VALUE = '{}'"
+                          .format(data_id, constants.UUORGMETADATAPREFIX + "replication_scheduled", rescs)).first() is not None
+
+
+def claim_object(data_id):
+    """Claim a data object for replication by this agent.
+
+    :param data_id: Data object id
+
+    :returns: Claim to be released with release_object(), or None if the object is claimed by another agent
+    """
+    return cache.lock('replication-{}.claim'.format(data_id))
+
+
+def release_object(claim, data_id):
+    """Release the claim on a data object, removing its claim file.
+
+    :param claim:   Claim returned by claim_object()
+    :param data_id: Data object id
+    """
+    cache.release(claim, 'replication-{}.claim'.format(data_id))
+
+
+def resource_limit(resource):
+    """Get the maximum number of concurrent replications to a resource.
+
+    Limits are configured in 'replication_resource_limits' as a list of
+    'resource:limit' entries.
+
+    :param resource: Name of the target resource
+
+    :returns: Maximum number of concurrent replications, or None for no limit
+    """
+    for x in config.replication_resource_limits:
+        name, _, limit = x.partition(':')
+        if name == resource:
+            return int(limit)
+    return None
+
+
+def acquire_resource_slot(resource):
+    """Wait for a free transfer slot on a target resource.
+
+    :param resource: Name of the target resource
+
+    :returns: Slot to be released with cache.release(), None if the resource has no limit
+    """
+    limit = resource_limit(resource)
+    if limit is None:
+        return None
+
+    return cache.acquire_slot('replication-{}'.format(resource), limit, SLOT_WAIT_INTERVAL)
 
 
 def is_replication_blocked_by_admin(ctx):
@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
 """Functions for statistics module."""
 
-__copyright__ = 'Copyright (c) 2018-2022, Utrecht University'
+__copyright__ = 'Copyright (c) 2018-2023, Utrecht University'
 __license__   = 'GPLv3, see LICENSE'
 
+import sqlite3
+import time
 from datetime import datetime
 from datetime import timedelta
 from math import ceil
@@ -427,8 +429,164 @@ def get_tier_by_resource_name(ctx, res_name):
     return tier
 
 
+# Storage accounting {{{
+
+# Storage totals per group and tier are kept in a local database, so that the
+# monthly statistics job only needs to recompute groups that changed since
+# their totals were last computed.
+#
+# Data object create, modify and remove events (see policies.py) mark the
+# group of the changed path as changed. Events are recorded by the server
+# handling the request for its primary resources only, so changes through
+# other servers and to replicas go unnoticed. Accounted storage is therefore
+# recomputed once it is older than STORAGE_ACCOUNTING_MAX_AGE. Running the
+# job in 'reconcile' mode recomputes all groups.
+
+STORAGE_ACCOUNTING_MAX_AGE = 80 * 24 * 3600
+"""Maximum age in seconds of accounted storage, i.e. groups are recomputed at least every third month."""
+
+
+def _accounting():
+    """Open the storage accounting database."""
+    return cache.database('storage-accounting',
+                          'CREATE TABLE IF NOT EXISTS totals (grp TEXT NOT NULL, resc TEXT NOT NULL, size INTEGER NOT NULL,'
+                          ' PRIMARY KEY (grp, resc))',
+                          'CREATE TABLE IF NOT EXISTS computed (grp TEXT PRIMARY KEY, time REAL NOT NULL)',
+                          'CREATE TABLE IF NOT EXISTS changed (grp TEXT PRIMARY KEY, time REAL NOT NULL)')
+
+
+def storage_groups(path):
+    """Get the names of the research or deposit groups whose storage is affected by a change to a path.
+
+    :param path: Path of a changed collection or data object
+
+    :returns: List of group names (possibly nonexistent)
+    """
+    parts = path.split('/')
+    if len(parts) < 4:
+        return []
+
+    if parts[2] == 'home':
+        group = parts[3]
+    elif '/'.join(parts[2:4]) == constants.UUREVISIONCOLLECTION.strip('/') and len(parts) > 4:
+        group = parts[4]
+    else:
+        return []
+
+    if group.startswith('research-') or group.startswith('deposit-'):
+        return [group]
+    elif group.startswith('vault-'):
+        # Vault storage is accounted to either the research or the deposit group.
+        return [group.replace('vault-', 'research-', 1), group.replace('vault-', 'deposit-', 1)]
+    else:
+        return []
+
+
+def storage_changed(path):
+    """Record that the storage of the group of a path changed.
+
+    :param path: Path of a changed collection or data object
+    """
+    now = time.time()
+    try:
+        db = _accounting()
+        for group in storage_groups(path):
+            db.execute('INSERT OR REPLACE INTO changed (grp, time) VALUES (?, ?)', (group, now))
+    except sqlite3.Error:
+        # Changes go unnoticed until the next reconciliation.
+        pass
+
+
+def get_stored_group_storage(ctx, group):
+    """Get the accounted storage per resource of a group, if it is still current.
+
+    :param ctx:   Combined type of a callback and rei struct
+    :param group: Research or deposit group name
+
+    :returns: Dict of resource name => storage in bytes, or None if the group changed, was never accounted
+              or was accounted longer than STORAGE_ACCOUNTING_MAX_AGE ago
+    """
+    db = _accounting()
+    computed = db.execute('SELECT time FROM computed WHERE grp = ?', (group,)).fetchone()
+    if computed is None or computed[0] < time.time() - STORAGE_ACCOUNTING_MAX_AGE:
+        return None
+
+    changed = db.execute('SELECT time FROM changed WHERE grp = ?', (group,)).fetchone()
+    if changed is not None and changed[0] >= computed[0]:
+        return None
+
+    return dict(db.execute('SELECT resc, size FROM totals WHERE grp = ?', (group,)))
+
+
+def store_group_storage(ctx, group, resource_storage, start):
+    """Store the accounted storage per resource of a group.
+
+    :param ctx:              Combined type of a callback and rei struct
+    :param group:            Research or deposit group name
+    :param resource_storage: Dict of resource name => storage in bytes
+    :param start:            Time at which computation of the storage started
+    """
+    db = _accounting()
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        db.execute('DELETE FROM totals WHERE grp = ?', (group,))
+        db.executemany('INSERT INTO totals (grp, resc, size) VALUES (?, ?, ?)',
+                       [(group, resc, size) for resc, size in resource_storage.items()])
+        # Changes during computation have a later time, and remain noticed.
+        db.execute('INSERT OR REPLACE INTO computed (grp, time) VALUES (?, ?)', (group, start))
+        db.execute('COMMIT')
+    except sqlite3.Error:
+        db.execute('ROLLBACK')
+        raise
+
+
+def compute_group_storage(ctx, group):
+    """Compute the storage per resource of a group, including its vault and revisions.
+
+    :param ctx:   Combined type of a callback and rei struct
+    :param group: Research or deposit group name
+
+    :returns: Dict of resource name => storage in bytes
+    """
+    zone = user.zone(ctx)
+    resource_storage = {}
+
+    # The software distinguishes 2 separate areas.
+    # 1) VAULT AREA
+    # 2) RESEARCH AREA - which includes research and deposit groups
+    # groupname can start with 'research-' or 'deposit-'
+    if group.startswith('research-'):
+        vault_group = group.replace('research-', 'vault-', 1)
+    else:
+        vault_group = group.replace('deposit-', 'vault-', 1)
+
+    revision_path = '/{}{}/{}'.format(zone, constants.UUREVISIONCOLLECTION, group)
+
+    # Per group two statements are required to gather all data
+    # 1) data in folder itself
+    # 2) data in all subfolders of the folder
+    where_clauses = []
+    for path in ['/{}/home/{}'.format(zone, group), '/{}/home/{}'.format(zone, vault_group)]:
+        where_clauses.append("COLL_NAME = '" + path + "'")
+        where_clauses.append("COLL_NAME like '" + path + "/%'")
+    # Revision area
+    where_clauses.append("COLL_NAME like '" + revision_path + "/%'")
+
+    for where_clause in where_clauses:
+        iter = genquery.row_iterator(
+            "SUM(DATA_SIZE), RESC_NAME",
+            where_clause,
+            genquery.AS_LIST, ctx
+        )
+
+        for row in iter:
+            resource_storage[row[1]] = resource_storage.get(row[1], 0) + int(row[0])
+
+    return resource_storage
+
+
 @rule.make()
-def rule_resource_store_monthly_storage_statistics(ctx):
+def rule_resource_store_monthly_storage_statistics(ctx, mode='incremental'):
     """For all categories, known store all found storage data for each group belonging to these categories.
 
     Store as metadata on group level holding
@@ -436,11 +594,17 @@ def rule_resource_store_monthly_storage_statistics(ctx):
     2) tier
     3) actual calculated storage for the group
 
+    In 'incremental' mode, storage is only recomputed for groups that changed
+    since it was last computed, or whose storage was computed longer than
+    STORAGE_ACCOUNTING_MAX_AGE ago. In 'reconcile' mode, storage of all groups is
+    recomputed and differences with the accounted storage are logged.
+
     :param ctx:  Combined type of a callback and rei struct
+    :param mode: Either 'incremental' or 'reconcile'
 
     :returns: Storage data for each group of each category
     """
-    zone = user.zone(ctx)
+    reconcile = mode == 'reconcile'
 
     # Get storage month with leading 0
     dt = datetime.today()
@@ -475,15 +639,10 @@ def rule_resource_store_monthly_storage_statistics(ctx):
     tiers = get_all_tiers(ctx)
 
     # List of resources and their corresponding tiers (for easy access further)
-    resource_tiers = {}
-    for resource in get_resources(ctx):
-        resource_tiers[resource] = get_tier_by_resource_name(ctx, resource)
+    resource_tiers = get_resource_tiers(ctx)
 
-    # Steps to be taken per group
-    # The software distinguishes 2 separate areas.
-    # 1) VAULT AREA
-    # 2) RESEARCH AREA - which includes research and deposit groups
-    steps = ['research', 'vault']
+    count_computed = 0
+    count_reused   = 0
 
     # Loop through all categories
     for category in categories:
@@ -491,81 +650,54 @@ def rule_resource_store_monthly_storage_statistics(ctx):
         groups = get_groups_on_category(ctx, category)
 
         for group in groups:
-            # COLLECT GROUP DATA
-            # Per group collect totals for category and tier
-
-            # Loop though all tiers and set storage to 0
-            tier_storage = {}
-            for tier in tiers:
-                tier_storage[tier] = 0
-
             # If anyting goes wrong during collection or storing of storage data for this group
             # -> for current group fall back on data of previous month
             try:
-                # Research and vault area
-                log.write(ctx, 'Research and vault area starting for group: ' + group)
-                for step in steps:
-                    if step == 'research':
-                        path = '/' + zone + '/home/' + group
-                    else:
-                        # groupname can start with 'research-' or 'deposit-'
-                        if group.startswith('research-'):
-                            vault_group = group.replace('research-', 'vault-', 1)
-                        else:
-                            vault_group = group.replace('deposit-', 'vault-', 1)
-                        path = '/' + zone + '/home/' + vault_group
-
-                    # Per group two statements are required to gather all data
-                    # 1) data in folder itself
-                    # 2) data in all subfolders of the folder
-
-                    for folder in ['self', 'subfolders']:
-                        if folder == 'self':
-                            whereClause = "COLL_NAME = '" + path + "'"
-                        else:
-                            whereClause = "COLL_NAME like '" + path + "/%'"
-
-                        iter = genquery.row_iterator(
-                            "SUM(DATA_SIZE), RESC_NAME",
-                            whereClause,
-                            genquery.AS_LIST, ctx
-                        )
-
-                        for row in iter:
-                            # sum up for this tier
-                            the_tier = resource_tiers[row[1]]
-                            tier_storage[the_tier] += int(row[0])
-                log.write(ctx, 'Research and vault area complete for group: ' + group)
-
-                # Revision area
-                log.write(ctx, 'Revision area starting for group: ' + group)
-                revision_path = '/{}{}/{}'.format(zone, constants.UUREVISIONCOLLECTION, group)
-                whereClause = "COLL_NAME like '" + revision_path + "/%'"
-                iter = genquery.row_iterator(
-                    "SUM(DATA_SIZE), RESC_NAME",
-                    whereClause,
-                    genquery.AS_LIST, ctx
-                )
-                for row in iter:
+                resource_storage = None
+                try:
+                    resource_storage = get_stored_group_storage(ctx, group)
+                except sqlite3.Error as e:
+                    log.write(ctx, 'Could not read accounted storage for group {}: {}'.format(group, e))
+
+                if resource_storage is None or reconcile:
+                    # COLLECT GROUP DATA
+                    start = time.time()
+                    accounted = resource_storage
+                    resource_storage = compute_group_storage(ctx, group)
+                    count_computed += 1
+
+                    if accounted is not None:
+                        for resc in set(accounted) | set(resource_storage):
+                            if accounted.get(resc, 0) != resource_storage.get(resc, 0):
+                                log.write(ctx, 'Storage accounting of group {} on resource {} was {}, actual storage is {}'
+                                               .format(group, resc, accounted.get(resc, 0), resource_storage.get(resc, 0)))
+                    try:
+                        store_group_storage(ctx, group, resource_storage, start)
+                    except sqlite3.Error as e:
+                        log.write(ctx, 'Could not store accounted storage for group {}: {}'.format(group, e))
+                else:
+                    count_reused += 1
+
+                # Per group collect totals for category and tier
+                tier_storage = {tier: 0 for tier in tiers}
+                for resc, size in resource_storage.items():
                     # sum up for this tier
-                    the_tier = resource_tiers[row[1]]
-                    tier_storage[the_tier] += int(row[0])
-                log.write(ctx, 'Revision area completed for group: ' + group)
+                    # Accounted storage may include resources that were removed since.
+                    the_tier = resource_tiers.get(resc, constants.UUDEFAULTRESOURCETIER)
+                    tier_storage[the_tier] += size
 
                 # STORE GROUP DATA
                 # Write total storages as metadata on current group for any tier
                 # val = [category, tier, storage]
                 for tier in tiers:
-                    log.write(ctx, 'Storing for group: ' + group)
                     # constructed this way to be backwards compatible (not using json.dump)
                     val = "[\"" + category + "\", \"" + tier + "\", " + str(tier_storage[tier]) + "]"
-                    log.write(ctx, val)
                     # write as metadata (kv-pair) to current group
                     avu.associate_to_group(ctx, group, md_storage_month, val)
-                log.write(ctx, 'All group data collected and stored for current month')
+                log.write(ctx, 'Storage data collected and stored for group: ' + group)
 
             except Exception:
-                log.write(ctx, 'ERROR COLLECTING OR SAVING GROUP STORAGE DATA')
+                log.error(ctx, 'Collecting or saving group storage data failed')
                 log.write(ctx, 'Copy prev month storage to current month')
 
                 # Something went wrong during collection. Possibly some newly collected data has been added to groups already.
@@ -590,8 +722,11 @@ def rule_resource_store_monthly_storage_statistics(ctx):
                     avu.associate_to_group(ctx, group, md_storage_month, storage_prev_month)
                     log.write(ctx, 'Previous data associated to group ' + group + ' month: ' + md_storage_month + ' val: ' + storage_prev_month)
 
+    log.write(ctx, 'Storage statistics stored: {} groups computed, {} groups unchanged'.format(count_computed, count_reused))
     return 'ok'
 
+# }}}
+
 
 def resource_exists(ctx, resource_name):
     """Check whether given resource actually exists."""
@@ -608,6 +743,28 @@ def resource_exists(ctx, resource_name):
     return False
 
 
+def get_resource_tiers(ctx):
+    """Get the tier of every resource.
+
+    :param ctx: Combined type of a callback and rei struct
+
+    :returns: Dict of resource name => tier name
+    """
+    # Add default tier as this might not be present in database.
+    resource_tiers = {resource: constants.UUDEFAULTRESOURCETIER for resource in get_resources(ctx)}
+
+    iter = genquery.row_iterator(
+        "RESC_NAME, META_RESC_ATTR_VALUE",
+        "META_RESC_ATTR_NAME = '{}'".format(constants.UURESOURCETIERATTRNAME),
+        genquery.AS_LIST, ctx
+    )
+
+    for row in iter:
+        resource_tiers[row[0]] = row[1]
+
+    return resource_tiers
+
+
 def get_all_tiers(ctx):
     """List all tiers currently present including 'Standard'."""
     tiers = [constants.UUDEFAULTRESOURCETIER]
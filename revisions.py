@@ -1,9 +1,10 @@
 # -*- coding: utf-8 -*-
 """Functions for revision management."""
 
-__copyright__ = 'Copyright (c) 2019-2022, Utrecht University'
+__copyright__ = 'Copyright (c) 2019-2023, Utrecht University'
 __license__   = 'GPLv3, see LICENSE'
 
+import bisect
 import datetime
 import os
 import time
@@ -300,7 +301,7 @@ def rule_revision_batch(ctx, verbose):
             resc = row[3]
 
             if print_verbose:
-                log.write(ctx, "Batch revision: creating revision for {} on resc {}".format(path, resc))
+                log.write(ctx, "Batch revision: creating revision for {} on resc {}", path, resc)
 
             id = revision_create(ctx, resc, path, constants.UUMAXREVISIONSIZE, verbose)
 
@@ -308,7 +309,7 @@ def rule_revision_batch(ctx, verbose):
             # rods should have been given own access via policy to allow AVU
             # changes.
             if print_verbose:
-                log.write(ctx, "Batch revision: removing AVU for {}".format(path))
+                log.write(ctx, "Batch revision: removing AVU for {}", path)
 
             # try removing attr/resc meta data
             avu_deleted = False
@@ -327,11 +328,11 @@ def rule_revision_batch(ctx, verbose):
                     msi.sudo_obj_acl_set(ctx, "", "own", user.full_name(ctx), path, "")
                     avu.rmw_from_data(ctx, path, attr, "%")  # use wildcard cause rm_from_data causes problems
                 except Exception:
-                    log.write(ctx, "ERROR - Scheduled revision creation of <{}>: could not remove schedule flag".format(path))
+                    log.error(ctx, "Scheduled revision creation of <{}>: could not remove schedule flag", path)
 
             # now back to the created revision
             if id:
-                log.write(ctx, "Revision created for {} ID={}".format(path, id))
+                log.write(ctx, "Revision created for {} ID={}", path, id)
                 count_ok += 1
                 # Revision creation OK. Remove any existing error indication attribute.
                 iter2 = genquery.row_iterator(
@@ -348,11 +349,11 @@ def rule_revision_batch(ctx, verbose):
                     break
             else:
                 count_ignored += 1
-                log.write(ctx, "ERROR - Scheduled revision creation of <{}> failed".format(path))
+                log.error(ctx, "Scheduled revision creation of <{}> failed", path)
                 avu.set_on_data(ctx, path, errorattr, "true")
 
         # Total revision process completed
-        log.write(ctx, "Batch revision job finished. {}/{} objects processed successfully. {} objects ignored.".format(count_ok, count, count_ignored))
+        log.write(ctx, "Batch revision job finished. {}/{} objects processed successfully. {} objects ignored.", count_ok, count, count_ignored)
 
 
 def is_revision_blocked_by_admin(ctx):
@@ -402,11 +403,11 @@ def revision_create(ctx, resource, path, max_size, verbose):
         break
 
     if not found:
-        log.write(ctx, "Data object <{}> was not found or path was collection".format(path))
+        log.write(ctx, "Data object <{}> was not found or path was collection", path)
         return ""
 
     if int(data_size) > max_size:
-        log.write(ctx, "Files larger than {} bytes cannot store revisions".format(max_size))
+        log.write(ctx, "Files larger than {} bytes cannot store revisions", max_size)
         return ""
 
     groups = list(genquery.row_iterator(
@@ -418,10 +419,10 @@ def revision_create(ctx, resource, path, max_size, verbose):
     if len(groups) == 1:
         (group_name, user_zone) = groups[0]
     elif len(groups) == 0:
-        log.write(ctx, "Cannot find owner of data object <{}>. It may have been removed. Skipping.".format(path))
+        log.write(ctx, "Cannot find owner of data object <{}>. It may have been removed. Skipping.", path)
         return ""
     else:
-        log.write(ctx, "Cannot find unique owner of data object <{}>. Skipping.".format(path))
+        log.write(ctx, "Cannot find unique owner of data object <{}>. Skipping.", path)
         return ""
 
     # All revisions are stored in a group with the same name as the research group in a system collection
@@ -456,13 +457,13 @@ def revision_create(ctx, resource, path, max_size, verbose):
             try:
                 msi.coll_create(ctx, rev_coll, '1', irods_types.BytesBuf())
             except error.UUError:
-                log.write(ctx, "ERROR - Failed to create staging area at <{}>".format(rev_coll))
+                log.error(ctx, "Failed to create staging area at <{}>", rev_coll)
                 return ""
 
         rev_path = rev_coll + "/" + rev_filename
 
         if print_verbose:
-            log.write(ctx, "Creating revision {} -> {}".format(path, rev_path))
+            log.write(ctx, "Creating revision {} -> {}", path, rev_path)
 
         # actual copying to revision store
         try:
@@ -477,45 +478,53 @@ def revision_create(ctx, resource, path, max_size, verbose):
             ))
 
             if len(revision_ids) == 0:
-                log.write(ctx, "failed to find data object id for revision <{}>. Aborting.".format(rev_path))
+                log.write(ctx, "failed to find data object id for revision <{}>. Aborting.", rev_path)
                 return ""
             elif len(revision_ids) == 1:
                 revision_id = revision_ids[0][0]
             else:
-                log.write(ctx, "failed to find unique data object id for revision <{}>. Aborting.".format(rev_path))
+                log.write(ctx, "failed to find unique data object id for revision <{}>. Aborting.", rev_path)
                 return ""
 
             # Add original metadata to revision data object.
-            avu.set_on_data(ctx, rev_path, constants.UUORGMETADATAPREFIX + "original_path", path)
-            avu.set_on_data(ctx, rev_path, constants.UUORGMETADATAPREFIX + "original_coll_name", parent)
-            avu.set_on_data(ctx, rev_path, constants.UUORGMETADATAPREFIX + "original_data_name", basename)
-            avu.set_on_data(ctx, rev_path, constants.UUORGMETADATAPREFIX + "original_data_owner_name", data_owner)
-            avu.set_on_data(ctx, rev_path, constants.UUORGMETADATAPREFIX + "original_data_id", data_id)
-            avu.set_on_data(ctx, rev_path, constants.UUORGMETADATAPREFIX + "original_coll_id", coll_id)
-            avu.set_on_data(ctx, rev_path, constants.UUORGMETADATAPREFIX + "original_modify_time", modify_time)
-            avu.set_on_data(ctx, rev_path, constants.UUORGMETADATAPREFIX + "original_group_name", group_name)
-            avu.set_on_data(ctx, rev_path, constants.UUORGMETADATAPREFIX + "original_filesize", data_size)
+            batch = avu.Batch('-d', rev_path)
+            batch.set(constants.UUORGMETADATAPREFIX + "original_path", path)
+            batch.set(constants.UUORGMETADATAPREFIX + "original_coll_name", parent)
+            batch.set(constants.UUORGMETADATAPREFIX + "original_data_name", basename)
+            batch.set(constants.UUORGMETADATAPREFIX + "original_data_owner_name", data_owner)
+            batch.set(constants.UUORGMETADATAPREFIX + "original_data_id", data_id)
+            batch.set(constants.UUORGMETADATAPREFIX + "original_coll_id", coll_id)
+            batch.set(constants.UUORGMETADATAPREFIX + "original_modify_time", modify_time)
+            batch.set(constants.UUORGMETADATAPREFIX + "original_group_name", group_name)
+            batch.set(constants.UUORGMETADATAPREFIX + "original_filesize", data_size)
+            batch.apply(ctx)
         except msi.Error as e:
-            log.write(ctx, 'ERROR - The file could not be copied: {}'.format(str(e)))
+            log.error(ctx, 'The file could not be copied: {}', str(e))
             return ''
 
     return revision_id
 
 
-@rule.make(inputs=range(2), outputs=range(2, 3))
-def rule_revisions_clean_up(ctx, bucketcase, endOfCalendarDay):
+REVISION_CLEANUP_BATCH_SIZE = 1000
+"""Number of revisions removed between checks whether an admin has blocked the revision process."""
+
+
+@rule.make(inputs=range(3), outputs=range(3, 4))
+def rule_revisions_clean_up(ctx, bucketcase, endOfCalendarDay, dryRun='false'):
     """Step through entire revision store and apply the chosen bucket strategy.
 
     :param ctx:              Combined type of a callback and rei struct
     :param bucketcase:       Multiple ways of cleaning up revisions can be chosen.
     :param endOfCalendarDay: If zero, system will determine end of current day in seconds since epoch (1970-01-01 00:00 UTC)
+    :param dryRun:           If 'true', only report the revisions that would be removed
 
     :returns: String with status of cleanup
     """
     zone = user.zone(ctx)
     revision_store = '/' + zone + constants.UUREVISIONCOLLECTION
+    dry_run = dryRun == 'true'
 
-    if user.user_type(ctx) == 'rodsadmin':
+    if user.user_type(ctx) == 'rodsadmin' and not dry_run:
         msi.set_acl(ctx, "recursive", "admin:own", user.full_name(ctx), revision_store)
         msi.set_acl(ctx, "recursive", "inherit", user.full_name(ctx), revision_store)
 
@@ -526,35 +535,78 @@ def rule_revisions_clean_up(ctx, bucketcase, endOfCalendarDay):
     # get definition of buckets
     buckets = revision_bucket_list(ctx, bucketcase)
 
-    # step through entire revision store and per item apply the bucket strategy
+    # Get all revisions in a single pass and apply the bucket strategy per original path.
+    originals  = get_revision_store(ctx)
+    candidates = []
+    for revisions in originals.values():
+        candidates.extend(get_deletion_candidates(ctx, buckets, revisions, end_of_calendar_day))
+
+    total = sum(len(revisions) for revisions in originals.values())
+
+    if dry_run:
+        for revision_id, _, revision_path in candidates:
+            log.write(ctx, "Revision cleanup (dry run): would remove revision <{}>: <{}>", revision_id, revision_path)
+        return 'Dry run: {} of {} revisions of {} originals would be removed'.format(len(candidates), total, len(originals))
+
+    # Delete the revisions that were found being obsolete, in bounded batches.
+    for i in range(0, len(candidates), REVISION_CLEANUP_BATCH_SIZE):
+        if i > 0:
+            log.write(ctx, "Revision cleanup: removed {}/{} revisions".format(i, len(candidates)))
+            if is_revision_blocked_by_admin(ctx):
+                return 'Revision store cleanup stopped by admin after removing {} revisions'.format(i)
+
+        for revision_id, _, revision_path in candidates[i:i + REVISION_CLEANUP_BATCH_SIZE]:
+            if not revision_remove_path(ctx, revision_id, revision_path):
+                return 'Something went wrong cleaning up revision store'
+
+    return 'Successfully cleaned up the revision store'
+
+
+def get_revision_store(ctx):
+    """Get all revisions in the revision store, grouped by original path.
+
+    All revision metadata is fetched with a single query.
+
+    :param ctx: Combined type of a callback and rei struct
+
+    :returns: Dict of original path => list of revisions [dataId, timestamp of modification, revision path],
+              in descending order of dataId
+    """
+    zone = user.zone(ctx)
+    revision_store = '/' + zone + constants.UUREVISIONCOLLECTION
+
+    path_attr  = constants.UUORGMETADATAPREFIX + 'original_path'
+    mtime_attr = constants.UUORGMETADATAPREFIX + 'original_modify_time'
+
+    revisions = {}  # dataId => [original path, modify time, revision path]
+
     iter = genquery.row_iterator(
-        "META_DATA_ATTR_VALUE",
-        "META_DATA_ATTR_NAME = '" + constants.UUORGMETADATAPREFIX + 'original_path' + "'"
-        " AND COLL_NAME like '" + revision_store + "%'",
+        "DATA_ID, COLL_NAME, DATA_NAME, META_DATA_ATTR_NAME, META_DATA_ATTR_VALUE",
+        "META_DATA_ATTR_NAME in ('{}', '{}') AND COLL_NAME like '{}%'".format(path_attr, mtime_attr, revision_store),
         genquery.AS_LIST, ctx
     )
 
-    for row in iter:
-        original_path = row[0]
-        # Get all related revisions
-        revisions = get_revision_list(ctx, original_path)
+    for data_id, coll_name, data_name, attr, value in iter:
+        revision = revisions.setdefault(data_id, [None, 0, coll_name + '/' + data_name])
+        if attr == path_attr:
+            revision[0] = value
+        else:
+            revision[1] = int(value)
 
-        # Process the original path conform the bucket settings
-        candidates = get_deletion_candidates(ctx, buckets, revisions, end_of_calendar_day)
+    originals = {}
+    for data_id, (original_path, modify_time, revision_path) in revisions.items():
+        if original_path is not None:
+            originals.setdefault(original_path, []).append([data_id, modify_time, revision_path])
 
-        # Delete the revisions that were found being obsolete
-        for revision_id in candidates:
-            if not revision_remove(ctx, revision_id):
-                return 'Something went wrong cleaning up revision store'
+    for revision_list in originals.values():
+        revision_list.sort(key=lambda x: int(x[0]), reverse=True)
 
-    return 'Successfully cleaned up the revision store'
+    return originals
 
 
 def revision_remove(ctx, revision_id):
     """Remove a revision from the revision store.
 
-    Called by revision-cleanup.r cronjob.
-
     :param ctx:         Combined type of a callback and rei struct
     :param revision_id: DATA_ID of the revision to remove
 
@@ -577,13 +629,32 @@ def revision_remove(ctx, revision_id):
             msi.data_obj_unlink(ctx, revision_path, irods_types.BytesBuf())
             return True
         except msi.Error:
-            log.write(ctx, "ERROR - Something went wrong deleting revision <{}>: <{}>.".format(revision_id, revision_path))
+            log.error(ctx, "Something went wrong deleting revision <{}>: <{}>.", revision_id, revision_path)
             return False
 
-    log.write(ctx, "ERROR - Revision ID <{}> not found or permission denied.".format(revision_id))
+    log.error(ctx, "Revision ID <{}> not found or permission denied.", revision_id)
     return False
 
 
+def revision_remove_path(ctx, revision_id, revision_path):
+    """Remove a revision from the revision store, given its path.
+
+    Called by revision-clean-up.r cronjob.
+
+    :param ctx:           Combined type of a callback and rei struct
+    :param revision_id:   DATA_ID of the revision to remove
+    :param revision_path: Path of the revision to remove
+
+    :returns: Boolean indicating if revision was removed
+    """
+    try:
+        msi.data_obj_unlink(ctx, revision_path, irods_types.BytesBuf())
+        return True
+    except msi.Error:
+        log.error(ctx, "Something went wrong deleting revision <{}>: <{}>.", revision_id, revision_path)
+        return False
+
+
 def revision_bucket_list(ctx, case):
     """Returns a bucket list definition containing timebox of a bucket, max number of entries and start index.
 
@@ -639,98 +710,48 @@ def revision_bucket_list(ctx, case):
         ]
 
 
-def get_revision_list(ctx, path):
-    """Returns list of all revisions
-
-    Format: [dataId, timestamp of modification] in descending order where org_original_path=path
-
-    :param ctx:   Combined type of a callback and rei struct
-    :param path:  Path of original
-
-    :returns: List of all revisions
-    """
-    candidates = []
-    zone = user.zone(ctx)
-    revision_store = '/' + zone + constants.UUREVISIONCOLLECTION
-
-    iter = genquery.row_iterator(
-        "DATA_ID, order_desc(DATA_ID)",
-        "META_DATA_ATTR_NAME = '" + constants.UUORGMETADATAPREFIX + "original_path" + "'  "
-        " AND META_DATA_ATTR_VALUE = '" + path + "' "
-        " AND COLL_NAME like '" + revision_store + "%'",
-        genquery.AS_LIST, ctx
-    )
-
-    for row in iter:
-        # Get modification time
-        modify_time = 0
-        iter2 = genquery.row_iterator(
-            "META_DATA_ATTR_VALUE",
-            "META_DATA_ATTR_NAME = '" + constants.UUORGMETADATAPREFIX + "original_modify_time" + "' "
-            "AND DATA_ID = '" + row[0] + "'",
-            genquery.AS_LIST, ctx
-        )
-        for row2 in iter2:
-            modify_time = int(row2[0])
-        candidates.append([row[0], modify_time])
-
-    return candidates
-
-
 def get_deletion_candidates(ctx, buckets, revisions, initial_upper_time_bound):
     """Get the candidates for deletion based on the active strategy case
 
     :param ctx:                      Combined type of a callback and rei struct
     :param buckets:                  List of buckets
-    :param revisions:                List of revisions
+    :param revisions:                List of revisions, in descending order of dataId
     :param initial_upper_time_bound: Initial upper time bound for first bucket
 
     :returns: List of candidates for deletion based on the active strategy case
+              (revisions in the same format as the input revisions)
     """
     deletion_candidates = []
 
-    # Set initial upper bound
-    t2 = initial_upper_time_bound
+    # Lower time bounds of the buckets, in ascending order.
+    # Bucket i holds revisions with lower_bounds[n - i - 1] < time <= upper bound of bucket i.
+    lower_bounds = []
+    t = initial_upper_time_bound
+    for bucket in buckets:
+        t -= bucket[0]
+        lower_bounds.insert(0, t)
 
     # List of bucket index with per bucket a list of its revisions within that bucket
-    # [[data_ids0],[data_ids1]]
-    bucket_revisions = []
-
-    for bucket in buckets:
-        t1 = t2
-        t2 = t1 - bucket[0]
+    bucket_revisions = [[] for _ in buckets]
 
-        revision_list = []
-        for revision in revisions:
-            if revision[1] <= t1 and revision[1] > t2:
-                # Link the bucket and the revision together so its clear which revisions belong into which bucket
-                revision_list.append(revision[0])  # append data-id
-        # Link the collected data_ids (revision_ids) to the corresponding bucket
-        bucket_revisions.append(revision_list)
+    for revision in revisions:
+        if lower_bounds and lower_bounds[0] < revision[1] <= initial_upper_time_bound:
+            # Number of lower bounds at or above the modify time is the bucket index.
+            index = len(buckets) - bisect.bisect_left(lower_bounds, revision[1])
+            bucket_revisions[index].append(revision)
 
     # Per bucket find the revision candidates for deletion
-    bucket_counter = 0
-    for rev_list in bucket_revisions:
-        bucket = buckets[bucket_counter]
-
+    for bucket, rev_list in zip(buckets, bucket_revisions):
         max_bucket_size = bucket[1]
         bucket_start_index = bucket[2]
 
-        if len(rev_list) > max_bucket_size:
-            nr_to_be_removed = len(rev_list) - max_bucket_size
-
-            count = 0
+        nr_to_be_removed = len(rev_list) - max_bucket_size
+        if nr_to_be_removed > 0:
             if bucket_start_index >= 0:
-                while count < nr_to_be_removed:
-                    # Add revision to list of removal
-                    deletion_candidates.append(rev_list[bucket_start_index + count])
-                    count += 1
+                deletion_candidates.extend(rev_list[bucket_start_index:bucket_start_index + nr_to_be_removed])
             else:
-                while count < nr_to_be_removed:
-                    deletion_candidates.append(rev_list[len(rev_list) + (bucket_start_index) - count])
-                    count += 1
-
-        bucket_counter += 1  # To keep conciding with strategy list
+                start = len(rev_list) + bucket_start_index
+                deletion_candidates.extend(rev_list[start - nr_to_be_removed + 1:start + 1][::-1])
 
     return deletion_candidates
 
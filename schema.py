@@ -1,18 +1,28 @@
 # -*- coding: utf-8 -*-
 """Functions for finding the active schema."""
 
-__copyright__ = 'Copyright (c) 2018-2022, Utrecht University'
+__copyright__ = 'Copyright (c) 2018-2023, Utrecht University'
 __license__   = 'GPLv3, see LICENSE'
 
+import copy
 import re
 
 import genquery
+import jsonschema
 
 import meta
 from util import *
 
 __all__ = ['api_schema_get_schemas']
 
+# Group categories are derived from group metadata, so they share the
+# generation stamp of the group data cache (see groups.py).
+_category_cache = cache.Cache('group_data', max_age=300)
+
+# Parsed schema files and validators, keyed by path and file version.
+_schema_cache    = cache.Cache(max_size=64)
+_validator_cache = cache.Cache(max_size=16)
+
 
 @api.make()
 def api_schema_get_schemas(ctx):
@@ -43,6 +53,12 @@ def get_group_category(callback, rods_zone, group_name):
 
     :returns: string -- Category
     """
+    return _category_cache.get((rods_zone, group_name),
+                               lambda: _get_group_category(callback, rods_zone, group_name))
+
+
+def _get_group_category(callback, rods_zone, group_name):
+    """Determine category (for schema purposes), without caching (see get_group_category())."""
     category = '-1'
     schemaCategory = 'default'
 
@@ -107,17 +123,56 @@ def get_active_schema_path(callback, path):
         group_name = path_parts[4]
 
     if group_name.startswith("vault-"):
-        temp_group_name = group_name.replace("vault-", "deposit-", 1)
-        if group.exists(callback, temp_group_name):
-            group_name = temp_group_name
-        else:
-            group_name = group_name.replace("vault-", "research-", 1)
+        group_name = _category_cache.get(('vault', group_name),
+                                         lambda: _vault_owner_group(callback, group_name))
 
     category = get_group_category(callback, rods_zone, group_name)
 
     return '/{}/yoda/schemas/{}/metadata.json'.format(rods_zone, category)
 
 
+def _vault_owner_group(callback, vault_group_name):
+    """Get the name of the deposit or research group that a vault group belongs to."""
+    temp_group_name = vault_group_name.replace("vault-", "deposit-", 1)
+    if group.exists(callback, temp_group_name):
+        return temp_group_name
+    else:
+        return vault_group_name.replace("vault-", "research-", 1)
+
+
+def _file_version(callback, path):
+    """Get a value that changes whenever the data object at the given path changes.
+
+    :param callback: Combined type of a callback and rei struct
+    :param path:     Path of a data object
+
+    :returns: Version of the data object, or None if it does not exist
+    """
+    coll, name = pathutil.chop(path)
+    rows = genquery.row_iterator("DATA_ID, DATA_MODIFY_TIME, DATA_SIZE, DATA_CHECKSUM",
+                                 "COLL_NAME = '{}' AND DATA_NAME = '{}'".format(coll, name),
+                                 genquery.AS_LIST, callback)
+    return tuple(sorted(tuple(row) for row in rows)) or None
+
+
+def _read_schema(callback, path):
+    """Read a schema file, reusing earlier parses of the same file version.
+
+    The returned object is shared between callers and must not be modified.
+
+    :param callback: Combined type of a callback and rei struct
+    :param path:     Path of a schema file
+
+    :returns: Schema object (parsed from JSON)
+    """
+    version = _file_version(callback, path)
+    if version is None:
+        # Let jsonutil report the missing file.
+        return jsonutil.read(callback, path)
+
+    return _schema_cache.get((path, version), lambda: jsonutil.read(callback, path))
+
+
 def get_active_schema(callback, path):
     """Get a schema object from a research or vault path.
 
@@ -127,7 +182,7 @@ def get_active_schema(callback, path):
 
     :returns: Schema object (parsed from JSON)
     """
-    return jsonutil.read(callback, get_active_schema_path(callback, path))
+    return copy.deepcopy(_read_schema(callback, get_active_schema_path(callback, path)))
 
 
 def get_active_schema_uischema(callback, path):
@@ -135,8 +190,28 @@ def get_active_schema_uischema(callback, path):
     schema_path   = get_active_schema_path(callback, path)
     uischema_path = '{}/{}'.format(pathutil.chop(schema_path)[0], 'uischema.json')
 
-    return jsonutil.read(callback, schema_path), \
-        jsonutil.read(callback, uischema_path)
+    return copy.deepcopy(_read_schema(callback, schema_path)), \
+        copy.deepcopy(_read_schema(callback, uischema_path))
+
+
+def get_active_schema_validator(callback, path):
+    """Get a validator for the active schema of a research or vault path.
+
+    Validators are reused as long as the schema file does not change.
+
+    :param callback: Combined type of a callback and rei struct
+    :param path:     A research or vault path, e.g. /tempZone/home/vault-bla/pkg1/yoda-metadata.json
+                     (anything after the group name is ignored)
+
+    :returns: Draft 7 validator for the active schema
+    """
+    schema_path = get_active_schema_path(callback, path)
+    version     = _file_version(callback, schema_path)
+    if version is None:
+        return jsonschema.Draft7Validator(jsonutil.read(callback, schema_path))
+
+    return _validator_cache.get((schema_path, version),
+                                lambda: jsonschema.Draft7Validator(_read_schema(callback, schema_path)))
 
 
 def get_active_schema_id(callback, path):
@@ -148,7 +223,7 @@ def get_active_schema_id(callback, path):
 
     :returns: string -- Schema $id (e.g. https://yoda.uu.nl/schemas/.../metadata.json)
     """
-    return get_active_schema(callback, path)['$id']
+    return _read_schema(callback, get_active_schema_path(callback, path))['$id']
 
 
 def get_schema_id(callback, metadata_path, metadata=None):
@@ -187,4 +262,4 @@ def get_schema_by_id(callback, path, schema_id):
     path = get_schema_path_by_id(callback, path, schema_id)
     if path is None:
         return None
-    return jsonutil.read(callback, path)
+    return copy.deepcopy(_read_schema(callback, path))
@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 """Functions for user settings."""
 
-__copyright__ = 'Copyright (c) 2021, Utrecht University'
+__copyright__ = 'Copyright (c) 2021-2023, Utrecht University'
 __license__   = 'GPLv3, see LICENSE'
 
 from genquery import Query
@@ -41,6 +41,28 @@ def load(ctx, setting, username=None):
         return USER_SETTINGS[setting]["default"]
 
 
+def load_many(ctx, setting, usernames):
+    """Load a user setting of multiple users at once.
+
+    :param ctx:       Combined type of a callback and rei struct
+    :param setting:   Name of setting to retrieve
+    :param usernames: Names of users to retrieve setting from
+
+    :returns: Dict with user setting or setting default per username
+    """
+    values = dict.fromkeys(usernames, USER_SETTINGS[setting]["default"])
+    if len(values) == 0:
+        return values
+
+    names = ', '.join("'{}'".format(username) for username in sorted(values))
+    for username, value in Query(ctx, "USER_NAME, META_USER_ATTR_VALUE",
+                                 "USER_NAME in ({}) AND USER_TYPE != 'rodsgroup' AND META_USER_ATTR_NAME = '{}{}'".format(names, SETTINGS_KEY, setting)):
+        if username in values:
+            values[username] = value
+
+    return values
+
+
 @api.make()
 def api_settings_load(ctx):
     """Load user settings.
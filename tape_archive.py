@@ -1,9 +1,30 @@
 # -*- coding: utf-8 -*-
-"""Functions for tape archive."""
+"""Functions for tape archive.
 
-__copyright__ = 'Copyright (c) 2021-2022, Utrecht University'
+Files are brought back from tape through a staging queue. Stage requests for
+data objects and collections add the data objects' files to the queue, once
+per file no matter how many users request it. rule_tape_archive_stage_process
+(see tools/tape_archive/tape-archive-stage.r) periodically looks up the DMF
+state of all queued files and recalls offline files in batches, sorted by
+physical path, with one dmget invocation per batch.
+
+The queue is kept in a local database on the server handling stage requests
+and running the staging job. Requests that are complete are removed after
+REQUEST_MAX_AGE seconds.
+
+The DMF commands are run on the tape archive host with msiExecCmd, and can be
+replaced by other commands with the tape_archive_dmattr and tape_archive_dmget
+settings (e.g. by the fake commands in tools/tape_archive, for testing on a
+system without DMF). The dmattr command must print the path and DMF state of
+each given file, separated by a space, one file per line (like 'dmattr -a
+path,state', see tools/tape_archive/tape-archive-dmattr). The dmget command
+must recall all given files.
+"""
+
+__copyright__ = 'Copyright (c) 2021-2023, Utrecht University'
 __license__   = 'GPLv3, see LICENSE'
 
+import sqlite3
 from enum import Enum
 from time import time
 
@@ -11,10 +32,22 @@ import genquery
 
 from util import *
 
-__all__ = ['api_tape_archive_stage']
+__all__ = ['api_tape_archive_stage',
+           'api_tape_archive_stage_paths',
+           'api_tape_archive_stage_status',
+           'rule_tape_archive_stage_process']
 
 TAPE_ARCHIVE_RESC = "testArchiveVault"
 
+STAGE_BATCH_SIZE = 100
+"""Maximum number of files per dmattr or dmget invocation."""
+
+RECALL_RETRY = 3600
+"""Seconds after which a recall of a file that is still offline is retried."""
+
+REQUEST_MAX_AGE = 7 * 24 * 3600
+"""Seconds after which complete stage requests are removed."""
+
 
 class State(Enum):
     """DMF tape archive has several possible states for files."""
@@ -32,6 +65,9 @@ class State(Enum):
     the file becomes "offline." If you make any change to a dual-state file,
     the offline copy becomes out of date and invalid, and the file is once again a "regular" file."""
 
+    PARTIAL = "PAR"
+    """Partial-state. Part of the file's data is online, the rest is offline only."""
+
     MIGRATING = "MIG"
     """Migrating. The file is in process of migrating from disk to tape."""
 
@@ -46,6 +82,13 @@ class State(Enum):
     The most likely reason is that it is in a filesystem that does not use DMF."""
 
 
+ONLINE_STATES = [State.REGULAR, State.DUAL_STATE, State.MIGRATING]
+"""States of files that can be read."""
+
+OFFLINE_STATES = [State.OFFLINE, State.PARTIAL]
+"""States of files that must be recalled."""
+
+
 def get_physical_path(ctx, path):
     """Get physical path of data object on tape archive."""
     coll_name, data_name = pathutil.chop(path)
@@ -62,31 +105,307 @@ def get_physical_path(ctx, path):
     return None
 
 
+def get_physical_paths(ctx, coll):
+    """Get logical and physical paths of all data objects in a collection on tape archive, recursively.
+
+    :param ctx:  Combined type of a callback and rei struct
+    :param coll: Collection name
+
+    :returns: List of tuples with logical and physical path
+    """
+    files = []
+    for condition in ["COLL_NAME = '{}'".format(coll), "COLL_NAME like '{}/%'".format(coll)]:
+        iter = genquery.row_iterator(
+            "COLL_NAME, DATA_NAME, DATA_PATH",
+            "RESC_NAME = '{}' AND {}".format(TAPE_ARCHIVE_RESC, condition),
+            genquery.AS_LIST, ctx
+        )
+        files += [(c + '/' + d, p) for c, d, p in iter]
+
+    return files
+
+
+# Staging queue {{{
+
+_SCHEMA = ('CREATE TABLE IF NOT EXISTS requests (id INTEGER PRIMARY KEY AUTOINCREMENT, actor TEXT NOT NULL,'
+           ' time REAL NOT NULL)',
+           'CREATE TABLE IF NOT EXISTS files (physical_path TEXT PRIMARY KEY, path TEXT NOT NULL,'
+           ' state TEXT, recalled REAL)',
+           'CREATE TABLE IF NOT EXISTS request_files (request INTEGER NOT NULL, physical_path TEXT NOT NULL,'
+           ' PRIMARY KEY (request, physical_path))')
+
+
+def _queue():
+    """Open the staging queue."""
+    return cache.durable_database('tape-archive-stage', *_SCHEMA)
+
+
+def _text(s):
+    """Convert a path to unicode for storage in the queue."""
+    return s if isinstance(s, unicode) else s.decode('utf-8')
+
+
+def _exec_dmf(ctx, cmd, physical_paths):
+    """Run a DMF command on the tape archive host for a batch of files.
+
+    :param ctx:            Combined type of a callback and rei struct
+    :param cmd:            Name of the command
+    :param physical_paths: Physical paths of files
+
+    :returns: Output of the command
+    """
+    args = ' '.join('"{}"'.format(p) for p in physical_paths)
+    ret = ctx.uuTapeArchiveExecCmd(cmd, args, '')
+    return ret['arguments'][2]
+
+
+def dmattr(ctx, physical_paths):
+    """Get the DMF state of files.
+
+    :param ctx:            Combined type of a callback and rei struct
+    :param physical_paths: Physical paths of files
+
+    :returns: Dict of States by physical path, files without a known state are INVALID
+    """
+    states = {}
+    for i in range(0, len(physical_paths), STAGE_BATCH_SIZE):
+        batch = physical_paths[i:i + STAGE_BATCH_SIZE]
+        wanted = set(batch)
+        for line in _exec_dmf(ctx, config.tape_archive_dmattr, batch).splitlines():
+            # Paths may contain spaces, states do not.
+            physical_path, _, state = line.rpartition(' ')
+            if physical_path not in wanted:
+                continue
+            try:
+                states[physical_path] = State(state.strip())
+            except ValueError:
+                states[physical_path] = State.INVALID
+
+    for physical_path in physical_paths:
+        states.setdefault(physical_path, State.INVALID)
+
+    return states
+
+
+def dmget(ctx, physical_paths):
+    """Recall files from tape, in batches.
+
+    :param ctx:            Combined type of a callback and rei struct
+    :param physical_paths: Physical paths of files
+    """
+    for i in range(0, len(physical_paths), STAGE_BATCH_SIZE):
+        _exec_dmf(ctx, config.tape_archive_dmget, physical_paths[i:i + STAGE_BATCH_SIZE])
+
+
+def stage(ctx, paths):
+    """Add the files of data objects and collections to the staging queue.
+
+    :param ctx:   Combined type of a callback and rei struct
+    :param paths: Paths of data objects and collections
+
+    :returns: Stage request, or API error
+    """
+    files = []
+    for path in paths:
+        if collection.exists(ctx, path):
+            files += get_physical_paths(ctx, path)
+        else:
+            physical_path = get_physical_path(ctx, path)
+            if physical_path is None:
+                return api.Error('file_not_found', 'Could not find file <{}> on tape archive resource'.format(path))
+            files.append((path, physical_path))
+
+    # Quotes cannot be passed to the DMF commands.
+    files = [(p, pp) for p, pp in files if '"' not in pp]
+    if len(files) == 0:
+        return api.Error('file_not_found', 'Could not find files on tape archive resource')
+
+    try:
+        db = _queue()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            request = db.execute('INSERT INTO requests (actor, time) VALUES (?, ?)',
+                                 (user.full_name(ctx), time())).lastrowid
+            # Files requested before are queued once. Their DMF state is reset,
+            # so that files that went offline since are recalled again.
+            db.executemany('INSERT OR REPLACE INTO files (physical_path, path) VALUES (?, ?)',
+                           ((_text(p), _text(path)) for path, p in files))
+            db.executemany('INSERT OR IGNORE INTO request_files (request, physical_path) VALUES (?, ?)',
+                           ((request, _text(p)) for _, p in files))
+            db.execute('COMMIT')
+        except sqlite3.Error:
+            db.execute('ROLLBACK')
+            raise
+    except sqlite3.Error as e:
+        log.write(ctx, 'Could not queue files for staging: {}'.format(e))
+        return api.Error('queue_failed', 'Request to bring files back online failed')
+
+    return {'request': request, 'files': len(set(p for _, p in files))}
+
+
+def stage_status(ctx, request):
+    """Get the progress of a stage request.
+
+    :param ctx:     Combined type of a callback and rei struct
+    :param request: Stage request id
+
+    :returns: Dict with number of files per DMF state, or None if the request does not exist
+    """
+    db = _queue()
+    row = db.execute('SELECT actor FROM requests WHERE id = ?', (request,)).fetchone()
+    if row is None or (row[0] != user.full_name(ctx) and not user.is_admin(ctx)):
+        return None
+
+    states = dict((state.value, 0) for state in State)
+    pending = 0
+    for state, count in db.execute('SELECT f.state, count(*) FROM request_files r'
+                                   ' JOIN files f ON f.physical_path = r.physical_path'
+                                   ' WHERE r.request = ? GROUP BY f.state', (request,)):
+        if state is None:
+            # DMF state not yet known.
+            pending += count
+        else:
+            states[state] += count
+
+    total  = pending + sum(states.values())
+    online = sum(states[s.value] for s in ONLINE_STATES)
+    return {'total':   total,
+            'pending': pending,
+            'online':  online,
+            'failed':  states[State.INVALID.value] + states[State.NONMIGRATABLE.value],
+            'states':  states}
+
+
+def process(ctx):
+    """Process the staging queue.
+
+    Looks up the DMF state of all queued files that are not online, records it
+    on the data objects and recalls offline files. Complete requests that are
+    older than REQUEST_MAX_AGE are removed from the queue.
+
+    :param ctx: Combined type of a callback and rei struct
+
+    :returns: Tuple of number of files checked and recalled
+    """
+    db = _queue()
+    now = time()
+    online = [s.value for s in ONLINE_STATES]
+
+    queued = db.execute('SELECT physical_path, path, recalled FROM files'
+                        ' WHERE state IS NULL OR state NOT IN ({})'.format(', '.join('?' * len(online))),
+                        online).fetchall()
+    if len(queued) == 0:
+        return 0, 0
+
+    physical_paths = sorted(p.encode('utf-8') for p, _, _ in queued)
+    states = dmattr(ctx, physical_paths)
+
+    recall = []
+    for physical_path, path, recalled in queued:
+        state = states[physical_path.encode('utf-8')]
+        if state in OFFLINE_STATES and (recalled is None or recalled < now - RECALL_RETRY):
+            recall.append(physical_path.encode('utf-8'))
+
+        # Keep the DMF state used by the tape archive policies up to date.
+        batch = avu.Batch('-d', path.encode('utf-8'))
+        batch.set(constants.UUORGMETADATAPREFIX + 'tape_archive_state', state.value)
+        batch.set(constants.UUORGMETADATAPREFIX + 'tape_archive_time', str(int(now)))
+        try:
+            batch.apply(ctx)
+        except msi.Error as e:
+            log.write(ctx, 'Could not set DMF state of <{}>: {}'.format(path, e))
+
+    # Recalls are grouped in batches sorted by physical path, to keep tape mounts and seeks to a minimum.
+    recall.sort()
+    dmget(ctx, recall)
+
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        db.executemany('UPDATE files SET state = ? WHERE physical_path = ?',
+                       ((states[p].value, _text(p)) for p in physical_paths))
+        db.executemany('UPDATE files SET recalled = ? WHERE physical_path = ?',
+                       ((now, _text(p)) for p in recall))
+
+        # Remove old requests that are complete, and files no longer requested.
+        incomplete = [s.value for s in OFFLINE_STATES + [State.UNMIGRATING]]
+        db.execute('DELETE FROM requests WHERE time < ? AND id NOT IN'
+                   ' (SELECT r.request FROM request_files r JOIN files f ON f.physical_path = r.physical_path'
+                   '  WHERE f.state IS NULL OR f.state IN ({}))'.format(', '.join('?' * len(incomplete))),
+                   [now - REQUEST_MAX_AGE] + incomplete)
+        db.execute('DELETE FROM request_files WHERE request NOT IN (SELECT id FROM requests)')
+        db.execute('DELETE FROM files WHERE physical_path NOT IN (SELECT physical_path FROM request_files)')
+        db.execute('COMMIT')
+    except sqlite3.Error:
+        db.execute('ROLLBACK')
+        raise
+
+    return len(queued), len(recall)
+
+# }}}
+
+
 @api.make()
 def api_tape_archive_stage(ctx, path):
-    """Bring back a file from tape archive.
+    """Bring back a file, or all files in a collection, from tape archive.
+
+    The files are queued on this server, which must also run the staging job
+    (rule_tape_archive_stage_process).
 
     :param ctx:  Combined type of a callback and rei struct
-    :param path: Path to file to bring back online from tape archive
+    :param path: Path to file or collection to bring back online from tape archive
 
-    :returns: API status
+    :returns: Stage request id and number of files queued
     """
-    physical_path = get_physical_path(ctx, path)
+    return stage(ctx, [path])
 
-    if physical_path is None:
-        return api.Error('file_not_found', 'Could not find file <{}> on tape archive resource'.format(path))
 
-    state = ""
-    timestamp = str(int(time()))
+@api.make()
+def api_tape_archive_stage_paths(ctx, paths):
+    """Bring back files and collections from tape archive.
 
-    try:
-        ctx.uuTapeArchiveSetState(path, physical_path, timestamp)
-    except Exception:
-        return api.Error('dmattr_failed', 'Retrieving file <{}> DMF state failed'.format(path))
+    :param ctx:   Combined type of a callback and rei struct
+    :param paths: Paths to files and collections to bring back online from tape archive
+
+    :returns: Stage request id and number of files queued
+    """
+    return stage(ctx, paths)
+
+
+@api.make()
+def api_tape_archive_stage_status(ctx, request):
+    """Get the progress of bringing back files from tape archive.
+
+    Stage requests are queued on the server that handled the stage request
+    (see tape_archive_stage). Their progress can only be requested through
+    that server: other servers report the request as not found.
+
+    :param ctx:     Combined type of a callback and rei struct
+    :param request: Stage request id
+
+    :returns: Number of files in total, with unknown state (pending), online and failed, and per DMF state
+    """
+    status = stage_status(ctx, request)
+    if status is None:
+        return api.Error('not_found', 'Stage request <{}> does not exist on this server'.format(request))
+
+    return status
+
+
+@rule.make(inputs=[], outputs=[0])
+def rule_tape_archive_stage_process(ctx):
+    """Process the tape archive staging queue of this server.
+
+    :param ctx: Combined type of a callback and rei struct
+
+    :returns: Status message
+    """
+    if user.user_type(ctx) != 'rodsadmin':
+        return 'Insufficient permissions - should only be called by rodsadmin'
 
     try:
-        ctx.dmget(physical_path, state)
-    except Exception:
-        return api.Error('dmget_failed', 'Request to bring file <{}> back online failed'.format(path))
+        checked, recalled = process(ctx)
+    except sqlite3.Error as e:
+        log.write(ctx, 'Processing tape archive staging queue failed: {}'.format(e))
+        return 'Processing tape archive staging queue failed'
 
-    return api.Result.ok()
+    return 'Checked {} queued files, recalled {}'.format(checked, recalled)
@@ -0,0 +1,364 @@
+#!/usr/bin/env python2
+"""Yoda ruleset benchmarks.
+
+Runs hot ruleset entry points against an in-memory zone (see fakeirods.py
+and zonegen.py), and reports the number of catalog queries, microservice /
+rule calls and time each benchmark takes.
+
+Each benchmark runs once with empty caches (cold) and a number of times
+after that (warm). Query and call counts are compared with a stored baseline,
+and the run fails when any count exceeds its baseline. Timings are reported
+only, as they depend on the machine and on the in-memory catalog.
+
+Usage:
+
+    python2 benchmark.py                    # run all benchmarks, compare with baseline
+    python2 benchmark.py -k policies        # run benchmarks matching 'policies'
+    python2 benchmark.py --update-baseline  # store current counts as new baseline
+
+This module imports (and therefore executes) ruleset code.
+"""
+from __future__ import print_function
+
+__copyright__ = 'Copyright (c) 2023, Utrecht University'
+__license__   = 'GPLv3, see LICENSE'
+
+import argparse
+import imp
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import fakeirods
+import zonegen
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+RULESET_DIR   = os.path.abspath(os.path.join(BENCHMARK_DIR, '..', '..'))
+BASELINE      = os.path.join(BENCHMARK_DIR, 'baseline.json')
+
+COUNTS = ['queries', 'calls']
+"""Counts compared against the baseline."""
+
+
+# Ruleset loading {{{
+
+class Ruleset(object):
+    """Gives access to ruleset modules by name, e.g. ruleset.groups or ruleset.util.cache."""
+
+    def __init__(self, name='rules_uu'):
+        self.name = name
+
+    def __getattr__(self, module):
+        return sys.modules['{}.{}'.format(self.name, module)]
+
+    def module(self, name):
+        return sys.modules['{}.{}'.format(self.name, name)]
+
+
+def load_ruleset():
+    """Import the ruleset from this repository, with the in-memory rule engine stand-ins."""
+    fakeirods.install()
+    imp.load_module('rules_uu', None, RULESET_DIR, ('', '', imp.PKG_DIRECTORY))
+    return Ruleset()
+
+
+def reset_caches(ruleset):
+    """Empty all ruleset caches, and give the ruleset new local cache and state directories.
+
+    :returns: The new cache directory
+    """
+    cache = ruleset.module('util.cache')
+    for db in cache._databases.values():
+        db.close()
+    cache._databases.clear()
+    cache.CACHE_DIR = tempfile.mkdtemp(prefix='yoda-benchmark-')
+    cache.STATE_DIR = os.path.join(cache.CACHE_DIR, 'state')
+
+    for name, module in sys.modules.items():
+        if module is None or not name.startswith(ruleset.name):
+            continue
+        for value in vars(module).values():
+            if isinstance(value, cache.Cache):
+                value.clear()
+                value._gen = None
+
+    return cache.CACHE_DIR
+
+# }}}
+# Benchmark helpers {{{
+
+
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(name, mutates=False, **zone):
+    """Register a benchmark.
+
+    :param name:    Benchmark name
+    :param mutates: Whether the benchmark changes the zone (a fresh zone is generated for every run)
+    :param zone:    Zone generator parameters (see zonegen.generate())
+
+    :returns: Decorator registering a function taking a Ruleset and a Zone
+    """
+    def deco(f):
+        BENCHMARKS[name] = (f, mutates, zone)
+        return f
+    return deco
+
+
+def call_rule(rule, zone, args=None, user='rods', **session):
+    """Call a ruleset rule like the rule engine does.
+
+    :param rule:    Rule function
+    :param zone:    Zone to run the rule against
+    :param args:    Rule arguments
+    :param user:    Client user name
+    :param session: Other session variables
+
+    :returns: Tuple of rule arguments after the call and the callback
+    """
+    args = list(args or [])
+    callback = fakeirods.Callback(zone)
+    rule(args, callback, fakeirods.session(user, zone.name, **session))
+    return args, callback
+
+
+def call_api(api, zone, user='rods', **data):
+    """Call a ruleset API function like the portal does.
+
+    :raises AssertionError: API function did not return status 'ok'
+
+    :returns: Data returned by the API function
+    """
+    _, callback = call_rule(api, zone, [json.dumps(data)], user)
+    result = json.loads(callback.stdout[-1])
+    assert result['status'] == 'ok', result
+    return result['data']
+
+
+def context(ruleset, zone, user='rods', **session):
+    """Create a ctx for calling ruleset functions directly."""
+    return ruleset.module('util.rule').Context(fakeirods.Callback(zone),
+                                               fakeirods.session(user, zone.name, **session))
+
+
+@contextmanager
+def configured(ruleset, **items):
+    """Override ruleset configuration items for the duration of a with block.
+
+    The configuration is frozen once the ruleset is loaded, so items are set
+    on it directly.
+    """
+    config = ruleset.module('util.config').config
+    saved = dict((k, getattr(config, k)) for k in items)
+    config._items.update(items)
+    try:
+        yield
+    finally:
+        config._items.update(saved)
+
+# }}}
+# Benchmarks {{{
+
+
+@benchmark('groups.user_role')
+def bench_user_role(ruleset, zone):
+    ctx = context(ruleset, zone)
+    for g in range(10):
+        for m in range(5):
+            ruleset.groups.user_role(ctx, 'research-g{}'.format(g), 'researcher{}@yoda.test'.format(m))
+
+
+@benchmark('browse.api_browse_folder')
+def bench_browse_folder(ruleset, zone):
+    for coll, sort_on, sort_order in [('research-g0', 'name', 'asc'),
+                                      ('research-g0/folder0', 'size', 'desc'),
+                                      ('research-g1', 'modified', 'asc')]:
+        call_api(ruleset.browse.api_browse_folder, zone, 'researcher0@yoda.test',
+                 coll='/{}/home/{}'.format(zone.name, coll), sort_on=sort_on, sort_order=sort_order,
+                 offset=0, limit=10, space='Space.RESEARCH')
+
+
+@benchmark('browse.api_search')
+def bench_search(ruleset, zone):
+    call_rule(ruleset.browse.rule_search_index_rebuild, zone, [''])
+    for search_type, search_string in [('filename', 'file1'),
+                                       ('filename', 'dat'),
+                                       ('folder', 'folder1'),
+                                       ('metadata', 'benchmark')]:
+        for offset in [0, 10]:
+            call_api(ruleset.browse.api_search, zone, 'researcher0@yoda.test', search_string=search_string,
+                     search_type=search_type, offset=offset, limit=10)
+
+
+@benchmark('revisions.rule_revisions_clean_up', mutates=True)
+def bench_revisions_clean_up(ruleset, zone):
+    # The end of the day is taken from the zone clock, so that the revision ages are deterministic.
+    args, _ = call_rule(ruleset.revisions.rule_revisions_clean_up, zone, ['B', str(zone.time), 'false', ''])
+    assert args[3].startswith('Successfully'), args[3]
+
+
+def _research_objects(zone, n=20):
+    return ['/{}/home/research-g0/folder0/file{}.dat'.format(zone.name, i) for i in range(n)]
+
+
+@benchmark('policies.py_acPreprocForDataObjOpen')
+def bench_pep_data_obj_open(ruleset, zone):
+    for path in _research_objects(zone):
+        call_rule(ruleset.policies.py_acPreprocForDataObjOpen, zone, user='researcher0@yoda.test',
+                  data_object={'object_path': path, 'write_flag': 1})
+
+
+@benchmark('policies.py_acPreprocForCollCreate')
+def bench_pep_coll_create(ruleset, zone):
+    for i in range(20):
+        call_rule(ruleset.policies.py_acPreprocForCollCreate, zone, user='researcher0@yoda.test',
+                  collection={'name': '/{}/home/research-g0/folder0/new{}'.format(zone.name, i)})
+
+
+@benchmark('policies.py_acDataDeletePolicy')
+def bench_pep_data_delete(ruleset, zone):
+    for path in _research_objects(zone):
+        call_rule(ruleset.policies.py_acDataDeletePolicy, zone, user='researcher0@yoda.test',
+                  data_object={'object_path': path})
+
+
+@benchmark('policies.py_acPreProcForObjRename')
+def bench_pep_obj_rename(ruleset, zone):
+    for path in _research_objects(zone):
+        call_rule(ruleset.policies.py_acPreProcForObjRename, zone, [path, path + '.renamed'],
+                  user='researcher0@yoda.test', operation_type=11)
+
+
+@benchmark('policies.pep_resource_modified_post')
+def bench_pep_resource_modified_post(ruleset, zone):
+    # Writes to a primary resource with a replica resource trigger all policies.
+    with configured(ruleset, resource_primary=['irodsResc'], resource_replica=['replRescUU1']):
+        for path in _research_objects(zone):
+            call_rule(ruleset.policies.pep_resource_modified_post, zone,
+                      ['irodsResc', fakeirods.PluginContext(logical_path=path,
+                                                            user_rods_zone=zone.name,
+                                                            user_user_name='researcher0@yoda.test'), ''],
+                      user='researcher0@yoda.test')
+
+
+@benchmark('vault.copy_folder_to_vault', mutates=True)
+def bench_copy_folder_to_vault(ruleset, zone):
+    # Retry of a copy that failed before the first checkpoint was stored:
+    # objects copied by the first attempt are overwritten.
+    ctx = context(ruleset, zone)
+    folder = '/{}/home/research-g0/folder0'.format(zone.name)
+    target = '/{}/home/vault-g0/folder0[1600000000]'.format(zone.name)
+    objects = sorted(ruleset.util.collection.data_objects(ctx, folder, recursive=True))
+    for path in objects[:3]:
+        zone.add_data(target + '/original' + path[len(folder):], contents='partial')
+
+    ruleset.vault.copy_folder_to_vault(ctx, folder, target)
+    for path in objects:
+        copy = zone.data_id(target + '/original' + path[len(folder):])
+        assert copy is not None and zone.contents[copy] == zone.contents[zone.data_id(path)], path
+
+
+@benchmark('meta.get_json_metadata_errors')
+def bench_metadata_errors(ruleset, zone):
+    ctx = context(ruleset, zone)
+    for g in range(10):
+        ruleset.meta.get_json_metadata_errors(ctx, '/{}/home/research-g{}/yoda-metadata.json'.format(zone.name, g))
+
+# }}}
+# Runner {{{
+
+
+def run(ruleset, name, repeat):
+    """Run a benchmark once cold and a number of times warm.
+
+    :returns: Dict with counts and timings of the cold and warm runs
+    """
+    f, mutates, params = BENCHMARKS[name]
+    cache_dir = reset_caches(ruleset)
+    zone = None
+    runs = []
+    try:
+        for _ in range(repeat + 1):
+            if zone is None or mutates:
+                zone = zonegen.generate(**params)
+            fakeirods.counters.reset()
+            t = time.time()
+            f(ruleset, zone)
+            t = time.time() - t
+            runs.append(dict(fakeirods.counters.as_dict(), ms=int(t * 1000)))
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    warm = runs[1:] or runs
+    return OrderedDict([('cold', runs[0]),
+                        ('warm', OrderedDict([(k, max(r[k] for r in warm)) for k in COUNTS]
+                                             + [('ms', sorted(r['ms'] for r in warm)[len(warm) // 2])]))])
+
+
+def regressions(name, result, baseline):
+    """List counts of a benchmark result that exceed the baseline."""
+    found = []
+    for kind in ['cold', 'warm']:
+        for count in COUNTS:
+            expected = baseline.get(name, {}).get(kind, {}).get(count)
+            if expected is not None and result[kind][count] > expected:
+                found.append('{} {} {}: {} > {}'.format(name, kind, count, result[kind][count], expected))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-k', dest='pattern', default='', help='only run benchmarks with names containing this string')
+    parser.add_argument('--repeat', type=int, default=3, help='number of warm runs per benchmark (default: 3)')
+    parser.add_argument('--baseline', default=BASELINE, help='baseline file (default: baseline.json)')
+    parser.add_argument('--update-baseline', action='store_true', help='store the current counts as baseline')
+    args = parser.parse_args()
+
+    ruleset = load_ruleset()
+
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f, object_pairs_hook=OrderedDict)
+    except IOError:
+        baseline = OrderedDict()
+
+    print('{:<42} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8}'.format('benchmark', 'queries', 'calls', 'ms',
+                                                              'queries', 'calls', 'ms'))
+    print('{:<42} {:^26} {:^26}'.format('', 'cold', 'warm'))
+
+    failures = []
+    for name in BENCHMARKS:
+        if args.pattern not in name:
+            continue
+        result = run(ruleset, name, args.repeat)
+        print('{:<42} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8}'.format(
+              name, *[result[kind][k] for kind in ['cold', 'warm'] for k in COUNTS + ['ms']]))
+
+        if args.update_baseline:
+            baseline[name] = OrderedDict((kind, OrderedDict((k, result[kind][k]) for k in COUNTS))
+                                         for kind in ['cold', 'warm'])
+        else:
+            failures += regressions(name, result, baseline)
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=4, separators=(',', ': '))
+            f.write('\n')
+        print('Baseline written to {}'.format(args.baseline))
+    elif failures:
+        print('\nQuery/call count regressions:\n  ' + '\n  '.join(failures))
+        return 1
+
+    return 0
+
+# }}}
+
+
+if __name__ == '__main__':
+    sys.exit(main())
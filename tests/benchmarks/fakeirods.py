@@ -0,0 +1,750 @@
+# -*- coding: utf-8 -*-
+"""In-memory stand-ins for the iRODS Python rule engine environment.
+
+This provides replacements for the 'genquery', 'session_vars' and
+'irods_types' modules and for the rule engine callback, all backed by an
+in-memory Zone. Every query and every microservice / rule call made through
+them is counted, so that benchmarks can report the number of catalog round
+trips an entry point makes.
+
+The query evaluator implements the subset of GenQuery used by the ruleset:
+'=', '!=', '<>', '<', '<=', '>', '>=', 'like', 'not like', 'in', 'not in',
+'between' and '||' conditions, ORDER/ORDER_DESC, MIN/MAX/SUM/COUNT/AVG
+aggregates, offset/limit and total row counts. Results are distinct, like
+those of the real GenQuery.
+"""
+
+__copyright__ = 'Copyright (c) 2023, Utrecht University'
+__license__   = 'GPLv3, see LICENSE'
+
+import re
+import sqlite3
+import sys
+import types
+from collections import OrderedDict
+
+try:
+    string_types = basestring
+except NameError:
+    # Python 3.
+    string_types = str
+
+AS_TUPLE = 0
+AS_DICT  = 1
+AS_LIST  = 2
+
+
+# Counters {{{
+
+class Counters(object):
+    """Counts catalog queries and callback calls."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.queries = 0
+        self.rows    = 0
+        self.calls   = 0
+        self.by_call = {}
+
+    def as_dict(self):
+        return OrderedDict([('queries', self.queries),
+                            ('rows',    self.rows),
+                            ('calls',   self.calls)])
+
+
+counters = Counters()
+
+# }}}
+# Zone model {{{
+
+
+class Zone(object):
+    """In-memory model of the catalog of a single zone.
+
+    All catalog values are stored as strings, as returned by GenQuery.
+    """
+
+    def __init__(self, name='tempZone'):
+        self.name        = name
+        self.users       = OrderedDict()  # name => {USER_* columns}
+        self.members     = {}             # user name => set of group names
+        self.colls       = OrderedDict()  # path => {COLL_* columns}
+        self.children    = {}             # path => list of subcollection paths
+        self.data        = OrderedDict()  # data id => {DATA_* columns}
+        self.data_in     = {}             # coll path => list of data ids
+        self.replicas    = {}             # data id => list of resource names
+        self.contents    = {}             # data id => file contents
+        self.resources   = OrderedDict()  # name => {RESC_* columns}
+        self.avus        = {'-d': {}, '-C': {}, '-u': {}, '-R': {}}  # type => key => [(attr, value, unit)]
+        self.acls        = {'-d': {}, '-C': {}}                      # type => key => {user name: access}
+        self.time        = 1600000000
+        self._next_id    = 10000
+
+    def next_id(self):
+        self._next_id += 1
+        return str(self._next_id)
+
+    def tick(self):
+        self.time += 1
+        return '{:011d}'.format(self.time)
+
+    # Users and groups.
+
+    def add_user(self, name, type='rodsuser'):
+        if name not in self.users:
+            self.users[name] = {'USER_ID':          self.next_id(),
+                                'USER_NAME':        name,
+                                'USER_ZONE':        self.name,
+                                'USER_TYPE':        type,
+                                'USER_INFO':        '',
+                                'USER_COMMENT':     '',
+                                'USER_CREATE_TIME': self.tick()}
+            self.members.setdefault(name, set())
+        return self.users[name]
+
+    def add_group(self, name):
+        return self.add_user(name, 'rodsgroup')
+
+    def add_member(self, group, name):
+        self.members.setdefault(name, set()).add(group)
+
+    # Collections and data objects.
+
+    def add_coll(self, path, owner='rods'):
+        if path in self.colls:
+            return self.colls[path]
+        parent = path.rsplit('/', 1)[0] or '/'
+        if path != '/':
+            self.add_coll(parent, owner)
+            self.children[parent].append(path)
+        t = self.tick()
+        self.colls[path] = {'COLL_ID':          self.next_id(),
+                            'COLL_NAME':        path,
+                            'COLL_PARENT_NAME': parent,
+                            'COLL_OWNER_NAME':  owner,
+                            'COLL_OWNER_ZONE':  self.name,
+                            'COLL_CREATE_TIME': t,
+                            'COLL_MODIFY_TIME': t,
+                            'COLL_INHERITANCE': '0'}
+        self.children[path] = []
+        self.data_in[path]  = []
+        return self.colls[path]
+
+    def add_data(self, path, size=None, contents=None, owner='rods', resources=('irodsResc',)):
+        coll, name = path.rsplit('/', 1)
+        self.add_coll(coll, owner)
+        if contents is not None:
+            size = len(contents)
+        data_id = self.next_id()
+        t = self.tick()
+        self.data[data_id] = {'DATA_ID':          data_id,
+                              'DATA_NAME':        name,
+                              'DATA_SIZE':        str(size or 0),
+                              'DATA_CREATE_TIME': t,
+                              'DATA_MODIFY_TIME': t,
+                              'DATA_CHECKSUM':    'sha2:{}'.format(data_id),
+                              'DATA_OWNER_NAME':  owner,
+                              'DATA_OWNER_ZONE':  self.name,
+                              'DATA_TYPE_NAME':   'generic',
+                              'DATA_REPL_STATUS': '1',
+                              'DATA_COLL_ID':     self.colls[coll]['COLL_ID']}
+        self.data_in[coll].append(data_id)
+        self.replicas[data_id] = list(resources)
+        self.contents[data_id] = contents or ''
+        return data_id
+
+    def data_id(self, path):
+        coll, name = path.rsplit('/', 1)
+        for data_id in self.data_in.get(coll, []):
+            if self.data[data_id]['DATA_NAME'] == name:
+                return data_id
+        return None
+
+    def remove_data(self, path):
+        data_id = self.data_id(path)
+        if data_id is None:
+            return False
+        self.data_in[path.rsplit('/', 1)[0]].remove(data_id)
+        del self.data[data_id]
+        self.avus['-d'].pop(path, None)
+        self.acls['-d'].pop(path, None)
+        return True
+
+    def add_resource(self, name):
+        if name not in self.resources:
+            self.resources[name] = {'RESC_ID':        self.next_id(),
+                                    'RESC_NAME':      name,
+                                    'RESC_TYPE_NAME': 'unixfilesystem',
+                                    'RESC_ZONE_NAME': self.name,
+                                    'RESC_PARENT':    ''}
+        return self.resources[name]
+
+    # Metadata and ACLs.
+
+    def add_avu(self, type, key, attr, value, unit=''):
+        self.avus[type].setdefault(key, []).append((attr, str(value), unit))
+
+    def set_avu(self, type, key, attr, value, unit=''):
+        self.rm_avu(type, key, attr)
+        self.add_avu(type, key, attr, value, unit)
+
+    def rm_avu(self, type, key, attr, value=None):
+        self.avus[type][key] = [x for x in self.avus[type].get(key, [])
+                                if not (x[0] == attr and (value is None or x[1] == value))]
+
+    def set_acl(self, type, key, user, access):
+        self.acls[type].setdefault(key, {})[user] = access
+
+    # Query evaluation.
+
+    def rows(self, columns, clauses):
+        """Generate joined catalog rows covering the given columns.
+
+        :param columns: Names of all columns that are selected or filtered on
+        :param clauses: Parsed query conditions, used to narrow down candidates
+
+        :returns: Generator of dicts of column name => value
+        """
+        families = set(_family(c) for c in columns)
+
+        if families & {'data', 'meta_data', 'data_access'}:
+            return self._data_rows(families, clauses)
+        elif families & {'coll', 'meta_coll', 'coll_access'}:
+            return self._coll_rows(families, clauses)
+        elif families & {'user', 'group', 'meta_user'}:
+            return self._user_rows(families)
+        elif families & {'resc', 'meta_resc'}:
+            return self._resc_rows(families)
+        return iter([])
+
+    def _candidate_colls(self, clauses):
+        # Use exact collection name or parent name conditions to avoid scanning the zone.
+        for column, alternatives in clauses:
+            if len(alternatives) == 1 and alternatives[0][0] == '=':
+                if column == 'COLL_NAME':
+                    return [p for p in [alternatives[0][1]] if p in self.colls]
+                if column == 'COLL_PARENT_NAME':
+                    return list(self.children.get(alternatives[0][1], []))
+        return self.colls.keys()
+
+    def _expand(self, row, type, key, families, meta, access):
+        rows = [row]
+        if meta in families:
+            prefix = {'-d': 'META_DATA_', '-C': 'META_COLL_', '-u': 'META_USER_', '-R': 'META_RESC_'}[type]
+            rows = [dict(r, **{prefix + 'ATTR_NAME':  a,
+                               prefix + 'ATTR_VALUE': v,
+                               prefix + 'ATTR_UNITS': u})
+                    for r in rows for a, v, u in self.avus[type].get(key, [])]
+        if access in families:
+            prefix = 'DATA_ACCESS_' if type == '-d' else 'COLL_ACCESS_'
+            expanded = []
+            for r in rows:
+                for name, level in sorted(self.acls[type].get(key, {}).items()):
+                    u = self.users.get(name, {})
+                    expanded.append(dict(r, **dict(u, **{prefix + 'NAME':    level,
+                                                         prefix + 'TYPE':    level,
+                                                         prefix + 'USER_ID': u.get('USER_ID', '')})))
+            rows = expanded
+        return rows
+
+    def _data_rows(self, families, clauses):
+        for coll in self._candidate_colls(clauses):
+            coll_row = self.colls[coll]
+            for data_id in self.data_in[coll]:
+                path = coll + '/' + self.data[data_id]['DATA_NAME']
+                base = dict(coll_row, **self.data[data_id])
+                for repl_num, resc in enumerate(self.replicas[data_id]):
+                    row = dict(base, DATA_REPL_NUM=str(repl_num), DATA_RESC_NAME=resc,
+                               DATA_RESC_HIER=resc, DATA_PATH='/var/lib/irods/Vault' + path[len(self.name) + 1:])
+                    rows = self._expand(row, '-d', path, families, 'meta_data', 'data_access')
+                    if 'meta_coll' in families:
+                        rows = [r2 for r in rows for r2 in self._expand(r, '-C', coll, families, 'meta_coll', None)]
+                    for r in rows:
+                        yield r
+
+    def _coll_rows(self, families, clauses):
+        for coll in self._candidate_colls(clauses):
+            for r in self._expand(self.colls[coll], '-C', coll, families, 'meta_coll', 'coll_access'):
+                yield r
+
+    def _user_rows(self, families):
+        for name, user in self.users.items():
+            rows = [user]
+            if 'group' in families:
+                groups = sorted(self.members.get(name, set()) | {name})
+                rows = [dict(user, USER_GROUP_NAME=g, USER_GROUP_ID=self.users[g]['USER_ID'])
+                        for g in groups if g in self.users]
+            for r in rows:
+                for r2 in self._expand(r, '-u', name, families, 'meta_user', None):
+                    yield r2
+
+    def _resc_rows(self, families):
+        for name, resc in self.resources.items():
+            for r in self._expand(resc, '-R', name, families, 'meta_resc', None):
+                yield r
+
+
+def _family(column):
+    """Determine which catalog table a column belongs to."""
+    for prefix, family in [('META_DATA_',   'meta_data'),
+                           ('META_COLL_',   'meta_coll'),
+                           ('META_USER_',   'meta_user'),
+                           ('META_RESC_',   'meta_resc'),
+                           ('DATA_ACCESS_', 'data_access'),
+                           ('COLL_ACCESS_', 'coll_access'),
+                           ('DATA_',        'data'),
+                           ('COLL_',        'coll'),
+                           ('USER_GROUP_',  'group'),
+                           ('USER_',        'user'),
+                           ('RESC_',        'resc')]:
+        if column.startswith(prefix):
+            return family
+    return None
+
+# }}}
+# GenQuery stand-in {{{
+
+
+_CLAUSE = re.compile(r"^\s*([A-Z_]+)\s+(.*?)\s*$", re.S)
+_OPERATOR = re.compile(r"^\s*(not\s+like|not\s+in|like|in|between|=|!=|<>|<=|>=|<|>)\s*(.*?)\s*$", re.S | re.I)
+_QUOTED = re.compile(r"'((?:[^']|'')*)'")
+
+
+def _split_outside_quotes(s, separator):
+    """Split a string on a separator regex, ignoring separators within single quotes."""
+    parts, start, quoted = [], 0, False
+    i = 0
+    while i < len(s):
+        if s[i] == "'":
+            quoted = not quoted
+        elif not quoted:
+            m = separator.match(s, i)
+            if m:
+                parts.append(s[start:i])
+                start = i = m.end()
+                continue
+        i += 1
+    parts.append(s[start:])
+    return parts
+
+
+_AND = re.compile(r"\s+and\s+", re.I)
+_OR  = re.compile(r"\s*\|\|\s*")
+
+
+def parse_conditions(conditions):
+    """Parse a GenQuery condition string.
+
+    :param conditions: Condition string, e.g. "COLL_NAME = 'x' AND DATA_NAME like 'y%'"
+
+    :returns: List of (column, [(operator, operand), ...]) with alternatives combined by '||'
+    """
+    clauses = []
+    if not conditions or not conditions.strip():
+        return clauses
+
+    for part in _split_outside_quotes(conditions.strip(), _AND):
+        m = _CLAUSE.match(part)
+        if m is None:
+            raise ValueError('Unsupported query condition <{}>'.format(part))
+        column, rest = m.groups()
+        alternatives = []
+        for alternative in _split_outside_quotes(rest, _OR):
+            m = _OPERATOR.match(alternative)
+            if m is None:
+                raise ValueError('Unsupported query condition <{}>'.format(part))
+            op, operand = re.sub(r'\s+', ' ', m.group(1).lower()), m.group(2)
+            values = [v.replace("''", "'") for v in _QUOTED.findall(operand)]
+            if op in ('in', 'not in', 'between'):
+                alternatives.append((op, values))
+            else:
+                alternatives.append((op, values[0] if values else operand))
+        clauses.append((column, alternatives))
+    return clauses
+
+
+def _number(x):
+    try:
+        return float(x)
+    except (TypeError, ValueError):
+        return None
+
+
+def _compare(a, b):
+    na, nb = _number(a), _number(b)
+    if na is not None and nb is not None:
+        return (na > nb) - (na < nb)
+    return (a > b) - (a < b)
+
+
+_like_cache = {}
+
+
+def _like(value, pattern):
+    if pattern not in _like_cache:
+        regex = ''.join('.*' if c == '%' else '.' if c == '_' else re.escape(c) for c in pattern)
+        _like_cache[pattern] = re.compile('^' + regex + '$', re.S)
+    return _like_cache[pattern].match(value) is not None
+
+
+def _test(value, op, operand):
+    if op == '=':
+        return value == operand
+    elif op in ('!=', '<>'):
+        return value != operand
+    elif op == 'like':
+        return _like(value, operand)
+    elif op == 'not like':
+        return not _like(value, operand)
+    elif op == 'in':
+        return value in operand
+    elif op == 'not in':
+        return value not in operand
+    elif op == 'between':
+        return _compare(value, operand[0]) >= 0 and _compare(value, operand[1]) <= 0
+    c = _compare(value, operand)
+    return {'<': c < 0, '<=': c <= 0, '>': c > 0, '>=': c >= 0}[op]
+
+
+def _match(row, clauses, case_sensitive):
+    for column, alternatives in clauses:
+        value = row.get(column, '')
+        if not case_sensitive:
+            value = value.upper()
+        if not any(_test(value, op, operand) for op, operand in alternatives):
+            return False
+    return True
+
+
+_SELECT = re.compile(r'^\s*(?:([A-Za-z_]+)\s*\(\s*([A-Z_]+)\s*\)|([A-Z_]+))\s*$')
+
+
+def _parse_column(column):
+    m = _SELECT.match(column)
+    if m is None:
+        raise ValueError('Unsupported query column <{}>'.format(column))
+    if m.group(3):
+        return None, m.group(3)
+    return m.group(1).upper(), m.group(2)
+
+
+def _sort_key(value):
+    n = _number(value)
+    return (0, n, '') if n is not None else (1, 0, value)
+
+
+def _aggregate(function, values):
+    if function == 'COUNT':
+        return str(len(values))
+    if function in ('SUM', 'AVG'):
+        total = sum(_number(v) or 0 for v in values)
+        if function == 'AVG':
+            total = total / len(values) if values else 0
+        return str(int(total)) if total == int(total) else str(total)
+    return (min if function == 'MIN' else max)(values, key=_sort_key)
+
+
+class Query(object):
+    """Stand-in for genquery.Query, evaluated against the zone of the callback."""
+
+    def __init__(self, callback, columns, conditions='', output=AS_TUPLE,
+                 offset=0, limit=None, case_sensitive=True, options=0, parent=None):
+        if isinstance(columns, string_types):
+            columns = [c.strip() for c in columns.split(',')]
+        self.callback       = callback
+        self.columns        = list(columns)
+        self.conditions     = conditions
+        self.output         = output
+        self.offset         = int(offset)
+        self.limit          = None if limit is None else int(limit)
+        self.case_sensitive = case_sensitive
+        self.options        = options
+        self._total         = None
+
+    def copy(self, columns=None, conditions=None, output=None, offset=None, limit=None,
+             case_sensitive=None, options=None):
+        return Query(self.callback,
+                     self.columns if columns is None else columns,
+                     self.conditions if conditions is None else conditions,
+                     self.output if output is None else output,
+                     self.offset if offset is None else offset,
+                     self.limit if limit is None else limit,
+                     self.case_sensitive if case_sensitive is None else case_sensitive,
+                     self.options if options is None else options)
+
+    def _execute(self):
+        """Run the query, returning all result rows (before offset/limit) as lists."""
+        counters.queries += 1
+
+        zone    = self.callback.fake_zone
+        parsed  = [_parse_column(c) for c in self.columns]
+        clauses = parse_conditions(self.conditions)
+        if not self.case_sensitive:
+            clauses = [(c, [(op, [v.upper() for v in x] if isinstance(x, list) else x.upper())
+                            for op, x in alts]) for c, alts in clauses]
+
+        names = [c for _, c in parsed] + [c for c, _ in clauses]
+        aggregated = any(f in ('MIN', 'MAX', 'SUM', 'COUNT', 'AVG') for f, _ in parsed)
+
+        groups = OrderedDict()
+        for row in zone.rows(names, clauses):
+            if not _match(row, clauses, self.case_sensitive):
+                continue
+            key = tuple(row.get(c, '') for f, c in parsed
+                        if not aggregated or f not in ('MIN', 'MAX', 'SUM', 'COUNT', 'AVG'))
+            if aggregated:
+                groups.setdefault(key, []).append(row)
+            else:
+                groups.setdefault(key, None)
+
+        if aggregated:
+            results = []
+            for rows in groups.values():
+                results.append([_aggregate(f, [r.get(c, '') for r in rows])
+                                if f in ('MIN', 'MAX', 'SUM', 'COUNT', 'AVG') else rows[0].get(c, '')
+                                for f, c in parsed])
+        else:
+            results = [list(k) for k in groups.keys()]
+
+        # Apply ORDER/ORDER_DESC columns, in reverse so that the first takes precedence.
+        for i in reversed(range(len(parsed))):
+            function = parsed[i][0]
+            if function in ('ORDER', 'ORDER_ASC', 'ORDER_DESC'):
+                results.sort(key=lambda r: _sort_key(r[i]), reverse=function == 'ORDER_DESC')
+
+        return results
+
+    def _format(self, row):
+        if self.output == AS_DICT:
+            return OrderedDict(zip(self.columns, row))
+        elif self.output == AS_LIST:
+            return row
+        return row[0] if len(row) == 1 else tuple(row)
+
+    def __iter__(self):
+        results = self._execute()
+        self._total = len(results)
+        end = None if self.limit is None else self.offset + self.limit
+        for row in results[self.offset:end]:
+            counters.rows += 1
+            yield self._format(row)
+
+    def total_rows(self):
+        if self._total is None:
+            self._total = len(self._execute())
+        return self._total
+
+    def first(self):
+        for row in self.copy(limit=1):
+            return row
+        return None
+
+
+def row_iterator(columns, conditions, row_return, callback):
+    """Stand-in for genquery.row_iterator."""
+    return Query(callback, columns, conditions, output=row_return)
+
+# }}}
+# Rule engine callback stand-in {{{
+
+
+class BytesBuf(object):
+    """Stand-in for irods_types.BytesBuf."""
+
+    def __init__(self):
+        self.buf = ''
+        self.len = 0
+
+    def get_bytes(self):
+        return self.buf[:self.len]
+
+
+class _Struct(object):
+    """Stand-in for other irods_types structures."""
+
+    def __init__(self, *args, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class Rei(object):
+    """Stand-in for the rei struct, holding the session variables of a rule call."""
+
+    def __init__(self, session):
+        self.session = session
+
+
+class PluginContext(object):
+    """Stand-in for the plugin context passed to dynamic PEPs."""
+
+    def __init__(self, **kwargs):
+        self._map = kwargs
+
+    def map(self):
+        return self._map
+
+
+def _result(*arguments):
+    return {'status': True, 'code': 0, 'arguments': list(arguments)}
+
+
+def _path_of(inp):
+    """Get the object path from a path or a 'objPath=...++++...' input string."""
+    for part in inp.split('++++'):
+        if part.startswith('objPath='):
+            return part[len('objPath='):]
+    return inp
+
+
+class Callback(object):
+    """Stand-in for the rule engine callback, backed by a Zone.
+
+    Microservices and rules that the benchmarks depend on are emulated against
+    the zone. Any other microservice or rule call succeeds without effect.
+    All calls are counted.
+    """
+
+    def __init__(self, zone):
+        self.fake_zone = zone
+        self.log       = []
+        self.stdout    = []
+        self.handles   = {}
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def call(*args):
+            counters.calls += 1
+            counters.by_call[name] = counters.by_call.get(name, 0) + 1
+            handler = getattr(self, '_call_' + name, None)
+            return handler(*args) if handler is not None else _result(*args)
+        return call
+
+    def writeLine(self, stream, message):
+        self.log.append(message)
+
+    def writeString(self, stream, message):
+        self.stdout.append(message)
+
+    def _call_msiDataObjOpen(self, inp, fd):
+        data_id = self.fake_zone.data_id(_path_of(inp))
+        if data_id is None:
+            raise RuntimeError('data object does not exist')
+        handle = len(self.handles) + 3
+        self.handles[handle] = data_id
+        return _result(inp, handle)
+
+    def _call_msiDataObjRead(self, handle, size, buf):
+        contents = self.fake_zone.contents[self.handles[handle]][:int(size)]
+        buf.buf, buf.len = contents, len(contents)
+        return _result(handle, size, buf)
+
+    def _call_msiDataObjUnlink(self, inp, status):
+        if not self.fake_zone.remove_data(_path_of(inp)):
+            raise RuntimeError('data object does not exist')
+        return _result(inp, status)
+
+    def _call_msiCollCreate(self, path, flags, status):
+        self.fake_zone.add_coll(path)
+        return _result(path, flags, status)
+
+    def _call_msiDataObjCopy(self, source, destination, options, status):
+        data_id = self.fake_zone.data_id(source)
+        if data_id is None:
+            raise RuntimeError('data object does not exist')
+        if self.fake_zone.data_id(destination) is not None:
+            if 'forceFlag=' not in options.split('++++'):
+                raise RuntimeError('OVERWRITE_WITHOUT_FORCE_FLAG')
+            self.fake_zone.remove_data(destination)
+        self.fake_zone.add_data(destination, contents=self.fake_zone.contents[data_id])
+        return _result(source, destination, options, status)
+
+    def _call_msi_add_avu(self, type, key, attr, value, unit):
+        self.fake_zone.add_avu(type, key, attr, value, unit)
+        return _result(type, key, attr, value, unit)
+
+    def _call_msi_rmw_avu(self, type, key, attr, value, unit):
+        self.fake_zone.avus[type][key] = [x for x in self.fake_zone.avus[type].get(key, [])
+                                          if not (_like(x[0], attr.replace('*', '%'))
+                                                  and _like(x[1], value.replace('*', '%')))]
+        return _result(type, key, attr, value, unit)
+
+    def _call_msiString2KeyValPair(self, s, kvp):
+        return _result(s, dict(x.split('=', 1) for x in s.split('%') if '=' in x))
+
+    def _call_msiSetKeyValuePairsToObj(self, kvp, key, type):
+        for attr, value in kvp.items():
+            self.fake_zone.set_avu(type, key, attr, value)
+        return _result(kvp, key, type)
+
+    def _call_msiAssociateKeyValuePairsToObj(self, kvp, key, type):
+        for attr, value in kvp.items():
+            self.fake_zone.add_avu(type, key, attr, value)
+        return _result(kvp, key, type)
+
+    def _call_msiRemoveKeyValuePairsFromObj(self, kvp, key, type):
+        for attr, value in kvp.items():
+            self.fake_zone.rm_avu(type, key, attr, value)
+        return _result(kvp, key, type)
+
+# }}}
+# Module installation {{{
+
+
+class _TypesModule(types.ModuleType):
+    """irods_types stand-in: any structure other than BytesBuf is a plain attribute holder."""
+
+    BytesBuf = BytesBuf
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return _Struct
+
+
+def session(user='rods', zone='tempZone', **kwargs):
+    """Create a rei struct with session variables for a rule call.
+
+    :param user:   Name of the client user
+    :param zone:   Zone of the client user
+    :param kwargs: Other session variables (e.g. 'data_object', 'collection')
+
+    :returns: Rei struct stand-in
+    """
+    variables = {'client_user': {'user_name': user, 'irods_zone': zone},
+                 'proxy_user':  {'user_name': user, 'irods_zone': zone}}
+    variables.update(kwargs)
+    return Rei(variables)
+
+
+def install():
+    """Register the stand-in modules as 'genquery', 'session_vars' and 'irods_types'.
+
+    If pysqlcipher3 (installed on Yoda servers for the token database) is not
+    available, it is replaced by the unencrypted sqlite3 module.
+    """
+    genquery = types.ModuleType('genquery')
+    genquery.AS_TUPLE     = AS_TUPLE
+    genquery.AS_DICT      = AS_DICT
+    genquery.AS_LIST      = AS_LIST
+    genquery.Query        = Query
+    genquery.row_iterator = row_iterator
+
+    session_vars = types.ModuleType('session_vars')
+    session_vars.get_map = lambda rei: rei.session
+
+    sys.modules['genquery']     = genquery
+    sys.modules['session_vars'] = session_vars
+    sys.modules['irods_types']  = _TypesModule('irods_types')
+
+    try:
+        import pysqlcipher3  # noqa: F401
+    except ImportError:
+        pysqlcipher3 = types.ModuleType('pysqlcipher3')
+        pysqlcipher3.dbapi2 = sqlite3
+        sys.modules['pysqlcipher3']        = pysqlcipher3
+        sys.modules['pysqlcipher3.dbapi2'] = sqlite3
+
+# }}}
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""Generators for in-memory benchmark zones.
+
+A generated zone resembles a Yoda zone: research groups with members,
+managers and readers, their vault and datamanager groups, a folder tree with
+data objects and AVUs per research group, metadata schemas, a revision store
+and a few resources. All sizes are configurable and generation is
+deterministic for a given seed.
+"""
+
+__copyright__ = 'Copyright (c) 2023, Utrecht University'
+__license__   = 'GPLv3, see LICENSE'
+
+import json
+import os
+import random
+
+from fakeirods import Zone
+
+SCHEMA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'schemas')
+
+DAY = 86400
+
+
+def generate(zone='tempZone',
+             groups=10,
+             members=5,
+             collections=20,
+             data_objects=10,
+             avus=3,
+             revisions=5,
+             categories=3,
+             schema='default-2',
+             seed=42):
+    """Generate a zone.
+
+    :param zone:         Zone name
+    :param groups:       Number of research groups
+    :param members:      Number of members per research group
+    :param collections:  Number of collections per research group
+    :param data_objects: Number of data objects per collection
+    :param avus:         Number of AVUs per data object
+    :param revisions:    Number of revisions per data object in the first collection of each group
+    :param categories:   Number of group categories
+    :param schema:       Name of the schema in the schemas directory used as the default metadata schema
+    :param seed:         Seed for random values (sizes, modification times)
+
+    :returns: Generated Zone
+    """
+    rng = random.Random(seed)
+    z = Zone(zone)
+    home = '/{}/home'.format(zone)
+    now = z.time
+
+    z.add_user('rods', 'rodsadmin')
+    z.add_group('rodsadmin')
+    z.add_member('rodsadmin', 'rods')
+    z.add_group('public')
+    for resc in ['irodsResc', 'replRescUU1', 'replRescUU2']:
+        z.add_resource(resc)
+    z.add_avu('-R', 'irodsResc', 'org_storage_tier', 'Standard')
+
+    # Metadata schemas, with the default schema as fallback for all categories.
+    with open(os.path.join(SCHEMA_DIR, schema, 'metadata.json')) as f:
+        metadata_schema = f.read()
+    z.add_data('/{}/yoda/schemas/default/metadata.json'.format(zone), contents=metadata_schema)
+    z.add_coll('/{}/yoda/flags'.format(zone))
+
+    for c in range(categories):
+        category = 'category{}'.format(c)
+        datamanager = 'datamanager-{}'.format(category)
+        z.add_group(datamanager)
+        z.add_avu('-u', datamanager, 'category', category)
+        z.add_user('datamanager{}@yoda.test'.format(c))
+        z.add_member(datamanager, 'datamanager{}@yoda.test'.format(c))
+        z.add_coll('{}/{}'.format(home, datamanager))
+
+    for g in range(groups):
+        name = 'g{}'.format(g)
+        research, vault, read = 'research-' + name, 'vault-' + name, 'read-' + name
+        category = 'category{}'.format(g % max(categories, 1))
+
+        for group in (research, vault, read):
+            z.add_group(group)
+        for attr, value in [('category',            category),
+                            ('subcategory',         'subcategory{}'.format(g % 2)),
+                            ('description',         'Research group {}'.format(g)),
+                            ('data_classification', 'unspecified'),
+                            ('expiration_date',     '.')]:
+            z.add_avu('-u', research, attr, value)
+
+        # Members: the first is a manager, the last is a reader.
+        for m in range(members):
+            username = 'researcher{}@yoda.test'.format((g * members + m) % (groups * members))
+            z.add_user(username)
+            if m == members - 1 and members > 1:
+                z.add_member(read, username)
+            else:
+                z.add_member(research, username)
+            if m == 0:
+                z.add_avu('-u', research, 'manager', '{}#{}'.format(username, zone))
+
+        root = '{}/{}'.format(home, research)
+        z.add_coll(root)
+        z.set_acl('-C', root, research, 'own')
+        z.add_data('{}/yoda-metadata.json'.format(root),
+                   contents=json.dumps({'links': [{'rel':  'describedby',
+                                                   'href': 'https://yoda.uu.nl/schemas/{}/metadata.json'.format(schema)}],
+                                        'Title': 'Benchmark data of {}'.format(research),
+                                        'Language': 'en - English'}))
+
+        # Folder tree: each collection is placed below a random earlier one.
+        colls = [root]
+        for c in range(collections):
+            path = '{}/folder{}'.format(rng.choice(colls), c)
+            z.add_coll(path)
+            colls.append(path)
+
+            for d in range(data_objects):
+                data_path = '{}/file{}.dat'.format(path, d)
+                z.add_data(data_path, size=rng.randint(0, 1 << 24))
+                for a in range(avus):
+                    z.add_avu('-d', data_path, 'attr{}'.format(a), 'value{}'.format(rng.randint(0, 9)))
+
+                if c == 0:
+                    # Revisions of the objects in the first folder, spread over the last months.
+                    store = '/{}/yoda/revisions/{}/{}'.format(zone, research, path[len(root) + 1:])
+                    for r in range(revisions):
+                        mtime = now - rng.randint(0, 120 * DAY)
+                        revision = '{}/file{}.dat_{}_rods'.format(store, d, mtime)
+                        z.add_data(revision, size=rng.randint(0, 1 << 20))
+                        z.add_avu('-d', revision, 'org_original_path', data_path)
+                        z.add_avu('-d', revision, 'org_original_modify_time', str(mtime))
+
+        # A vault with a single data package.
+        package = '{}/{}/package[{}]'.format(home, vault, now)
+        z.add_data('{}/yoda-metadata[{}].json'.format(package, now), size=1024)
+        z.add_avu('-C', package, 'org_vault_status', 'COMPLETE')
+
+    return z
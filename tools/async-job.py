@@ -2,6 +2,7 @@
 
 from __future__ import print_function
 import argparse
+import json
 import os
 import subprocess
 import sys
@@ -22,6 +23,8 @@ def get_args():
     parser = argparse.ArgumentParser(description='Yoda replication and revision job')
     parser.add_argument('--verbose', '-v', action='store_const', default="0", const="1",
                     help='Log more information in rodsLog for troubleshooting purposes')
+    parser.add_argument('--workers', '-w', type=int, default=1,
+                    help='Number of concurrent workers (replication only)')
     return parser.parse_args()
 
 
@@ -44,6 +47,37 @@ def lock_or_die():
     atexit.register(lambda: os.unlink(LOCKFILE_PATH))
 
 
+def irule(rule, rule_options, **kwargs):
+    """Start a rule, returns the irule process"""
+    return subprocess.Popen(['irule', '-r', 'irods_rule_engine_plugin-irods_rule_language-instance',
+        rule, rule_options, 'ruleExecOut'], **kwargs)
+
+
+def replicate_concurrently(verbose, workers):
+    """Run replication with multiple concurrent workers, and print a summary of the run"""
+    procs = [irule('uuReplicateBatchWorker(*verbose, *worker, *workers)',
+                   '*verbose={}%*worker={}%*workers={}'.format(verbose, i, workers),
+                   stdout=subprocess.PIPE)
+             for i in range(workers)]
+
+    total = {'objects': 0, 'replicated': 0, 'failed': 0, 'bytes': 0, 'seconds': 0}
+    status = 0
+    for i, proc in enumerate(procs):
+        out, _ = proc.communicate()
+        try:
+            result = json.loads(out.strip().splitlines()[-1])
+        except (ValueError, IndexError):
+            print('error: worker {} did not report a result'.format(i), file=sys.stderr)
+            status = 1
+            continue
+        for k in total:
+            total[k] = max(total[k], result[k]) if k == 'seconds' else total[k] + result[k]
+
+    total['throughput'] = total['bytes'] // total['seconds'] if total['seconds'] > 0 else 0
+    print(json.dumps(total))
+    return status
+
+
 if 'replicate' in NAME:
     rule_name = 'uuReplicateBatch(*verbose)'
 elif 'revision' in NAME:
@@ -54,6 +88,8 @@ else:
 
 args = get_args()
 lock_or_die()
+if 'replicate' in NAME and args.workers > 1:
+    exit(replicate_concurrently(args.verbose, args.workers))
+
 rule_options = "*verbose=" + args.verbose
-subprocess.call(['irule', '-r', 'irods_rule_engine_plugin-irods_rule_language-instance',
-    rule_name, rule_options, 'ruleExecOut'])
+irule(rule_name, rule_options).wait()
@@ -0,0 +1,11 @@
+# Deliver the mails in the outbox of the server this rule runs on.
+# Run periodically (e.g. every minute) when smtp_outbox is enabled.
+mail_outbox_flush
+{
+    *status = "";
+    rule_mail_outbox_flush(*status);
+    writeLine("stdout", *status);
+}
+
+input null
+output ruleExecOut
@@ -0,0 +1,2 @@
+#!/bin/bash
+irule -r irods_rule_engine_plugin-irods_rule_language-instance -F /etc/irods/yoda-ruleset/tools/mail/mail-outbox-flush.r
@@ -1,4 +1,5 @@
 # Run monthly to update storage statistics
+# Use *mode="reconcile" to recompute the storage of all groups.
 run {
 	uuGetUserType("$userNameClient#$rodsZoneClient", *usertype);
 
@@ -10,7 +11,7 @@ run {
 	msiGetIcatTime(*timestamp, "human");
 	writeLine('stdout', '[' ++ *timestamp ++ '] Gathering storage statistics');
 
-        *result = rule_resource_store_monthly_storage_statistics();
+        *result = rule_resource_store_monthly_storage_statistics(*mode);
 #	#uuStoreMonthlyStorageStatistics(*status, *statusInfo);
 
 #	writeLine('stdout', 'Status: ' ++ *status);
@@ -20,5 +21,5 @@ run {
         writeLine('stdout', *result);
 
 }
-input null
+input *mode="incremental"
 output ruleExecOut
@@ -0,0 +1,14 @@
+#!/bin/sh
+# Local stand-in for securecopy.sh, for testing publication without a public host.
+# Install in msiExecCmd_bin and set publication_secure_copy = 'local-securecopy.sh'.
+#
+# Copies to <LOCAL_PUBLIC_HOST_DIR>/<host>/<destination> instead of over SSH.
+set -e
+PHYPATH=$1
+HOST=$2
+DESTINATION=$4
+root="${LOCAL_PUBLIC_HOST_DIR:-/tmp/local-public-host}"
+
+mkdir -p "$root/$HOST$(dirname "$DESTINATION")"
+cp "$PHYPATH" "$root/$HOST$DESTINATION"
+chmod go+r "$root/$HOST$DESTINATION"
@@ -1,9 +1,9 @@
 cleanup {
         writeLine("stdout", 'START cleaning up revision store');
         *status = "";
-        rule_revisions_clean_up(*bucketcase, str(*endOfCalendarDay), *status);
+        rule_revisions_clean_up(*bucketcase, str(*endOfCalendarDay), *dryRun, *status);
         writeLine("stdout", *status);
 }
 
-input *endOfCalendarDay=0, *bucketcase="B"
+input *endOfCalendarDay=0, *bucketcase="B", *dryRun="false"
 output ruleExecOut
@@ -0,0 +1,10 @@
+# Rebuild the local search index of the server this rule runs on.
+# Run periodically (e.g. nightly) to include changes made through other servers.
+rebuild {
+        *status = "";
+        rule_search_index_rebuild(*status);
+        writeLine("stdout", *status);
+}
+
+input null
+output ruleExecOut
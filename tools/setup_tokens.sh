@@ -8,5 +8,5 @@ then
     sqlcipher $UNENCRYPTED "ATTACH DATABASE '$1' AS encrypted KEY '$2'; SELECT sqlcipher_export('encrypted'); DETACH DATABASE encrypted" && rm $UNENCRYPTED
 else
     touch $1
-    sqlcipher $1 "PRAGMA key='$2'; CREATE TABLE IF NOT EXISTS tokens (user TEXT NOT NULL, label TEXT NOT NULL, token TEXT NOT NULL, gen_time INTEGER, exp_time INTEGER, UNIQUE (user, label) ON CONFLICT ABORT)"
+    sqlcipher $1 "PRAGMA key='$2'; CREATE TABLE IF NOT EXISTS tokens (user TEXT NOT NULL, label TEXT NOT NULL, token TEXT NOT NULL, gen_time INTEGER, exp_time INTEGER, UNIQUE (user, label) ON CONFLICT ABORT); CREATE INDEX IF NOT EXISTS tokens_exp_time ON tokens (exp_time); CREATE INDEX IF NOT EXISTS tokens_user_exp_time ON tokens (user, exp_time)"
 fi
@@ -4,5 +4,7 @@ path="$2"
 physical_path="$3"
 timestamp="$4"
 
-state=$(/var/lib/irods/msiExecCmd_bin/dmattr "$physical_path")
+# The state is the last field of the 'path state' output.
+state=$(/var/lib/irods/msiExecCmd_bin/tape-archive-dmattr "$physical_path")
+state="${state##* }"
 irule -r irods_rule_engine_plugin-irods_rule_language-instance -F /etc/irods/yoda-ruleset/tools/tape_archive/admin-tape-archive-set-state.r "'$path'" "'$timestamp'" "'$state'"
@@ -0,0 +1,10 @@
+# Process the tape archive staging queue of the server this rule runs on.
+# Run periodically (e.g. every 5 minutes) on the server handling stage requests.
+stage {
+        *status = "";
+        rule_tape_archive_stage_process(*status);
+        writeLine("stdout", *status);
+}
+
+input null
+output ruleExecOut
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import argparse
+import json
+import subprocess
+import sys
+
+# usage: ./update-publications.py [--workers N] [--no-datacite] [--no-landingpage] [--no-moai]
+
+# Updates the publications of all published vault packages with multiple
+# concurrent workers, and prints a summary of the run with the status and
+# stage timings of every package.
+
+RULE_FILE = '/etc/irods/yoda-ruleset/tools/update-publications.r'
+
+
+def get_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description='Yoda publication update job')
+    parser.add_argument('--workers', '-w', type=int, default=1,
+                    help='Number of concurrent workers')
+    parser.add_argument('--no-datacite', action='store_true',
+                    help='Do not update DataCite metadata')
+    parser.add_argument('--no-landingpage', action='store_true',
+                    help='Do not update landing pages')
+    parser.add_argument('--no-moai', action='store_true',
+                    help='Do not update OAI-PMH metadata')
+    return parser.parse_args()
+
+
+def flag(skip):
+    return 'No' if skip else 'Yes'
+
+
+def irule(rule_options):
+    """Start a worker, returns the irule process"""
+    return subprocess.Popen(['irule', '-r', 'irods_rule_engine_plugin-irods_rule_language-instance',
+        '-F', RULE_FILE] + rule_options, stdout=subprocess.PIPE)
+
+
+def update_concurrently(args):
+    """Run publication updates with multiple concurrent workers, and print a summary of the run"""
+    procs = [irule(['*updateDatacite={}'.format(flag(args.no_datacite)),
+                    '*updateLandingpage={}'.format(flag(args.no_landingpage)),
+                    '*updateMOAI={}'.format(flag(args.no_moai)),
+                    '*worker={}'.format(i),
+                    '*workers={}'.format(args.workers)])
+             for i in range(args.workers)]
+
+    total = {'packages': 0, 'ok': 0, 'seconds': 0, 'results': []}
+    stages = {}
+    status = 0
+    for i, proc in enumerate(procs):
+        out, _ = proc.communicate()
+        try:
+            result = json.loads(out.strip().splitlines()[-1])
+        except (ValueError, IndexError):
+            print('error: worker {} did not report a result'.format(i), file=sys.stderr)
+            status = 1
+            continue
+        total['packages'] += result['packages']
+        total['ok'] += result['ok']
+        total['seconds'] = max(total['seconds'], result['seconds'])
+        total['results'] += result['results']
+
+        # Total time and number of skipped packages per stage.
+        for package in result['results']:
+            for stage, seconds in package['stages'].items():
+                x = stages.setdefault(stage, {'seconds': 0, 'packages': 0, 'skipped': 0})
+                if seconds == 'skipped':
+                    x['skipped'] += 1
+                else:
+                    x['packages'] += 1
+                    x['seconds'] += seconds
+
+    total['stages'] = stages
+    total['results'].sort(key=lambda x: x['package'])
+    print(json.dumps(total, indent=4))
+    return status
+
+
+exit(update_concurrently(get_args()))
@@ -1,36 +1,8 @@
-updatePublications() {
-    writeLine("stdout", "[UPDATE PUBLICATIONS] Start scan");
-
-	# Scan for published vault packages.
-	*ContInxOld = 1;
-	msiAddSelectFieldToGenQuery("COLL_NAME", "", *GenQ2Inp);
-	msiAddConditionToGenQuery("COLL_NAME", "like", "%%/home/vault-%%", *GenQ2Inp);
-	msiAddConditionToGenQuery("META_COLL_ATTR_NAME", "=", UUORGMETADATAPREFIX ++ "vault_status", *GenQ2Inp);
-	msiAddConditionToGenQuery("META_COLL_ATTR_VALUE", "=", PUBLISHED, *GenQ2Inp);
-
-	msiExecGenQuery(*GenQ2Inp, *GenQ2Out);
-	msiGetContInxFromGenQueryOut(*GenQ2Out, *ContInxNew);
-
-	while(*ContInxOld > 0) {
-		foreach(*row in *GenQ2Out) {
-			*collName = *row.COLL_NAME;
-
-			# Check if this really is a vault package
-			if (*collName like regex "/[^/]+/home/vault-.*") {
-			    *status = ''
-			    *statusInfo = '';
-			    rule_update_publication(*collName, *updateDatacite, *updateLandingpage, *updateMOAI, *status, *statusInfo);
-			    writeLine("stdout", "*collName: *status *statusInfo");
-			}
-		}
-
-		*ContInxOld = *ContInxNew;
-		if(*ContInxOld > 0) {
-			msiGetMoreRows(*GenQ2Inp, *GenQ2Out, *ContInxNew);
-		}
-	}
-	msiCloseGenQuery(*GenQ2Inp, *GenQ2Out);
-    writeLine("stdout", "[UPDATE PUBLICATIONS] Finished scan");
+# Update the publications of all published vault packages.
+# Prints a JSON summary with the status and stage timings of every package.
+# Run multiple workers concurrently with tools/update-publications.py.
+updatePublications {
+	rule_update_publications(*updateDatacite, *updateLandingpage, *updateMOAI, *worker, *workers);
 }
-input *updateDatacite="Yes", *updateLandingpage="Yes", *updateMOAI="Yes"
+input *updateDatacite="Yes", *updateLandingpage="Yes", *updateMOAI="Yes", *worker="0", *workers="1"
 output ruleExecOut
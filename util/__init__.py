@@ -28,6 +28,8 @@ import group
 import avu
 import misc
 import config
+import cache
+import search
 
 # Config items can be accessed directly as 'config.foo' by any module
 # that imports * from util.
@@ -156,7 +156,7 @@ def _api(f):
             result = f(ctx, **data)
             t = time.time() - t
 
-            log.debug(ctx, '%4dms %s' % (int(t * 1000), f.__name__))
+            log.debug(ctx, 'API call finished', rule=f.__name__, ms=int(t * 1000))
 
             if type(result) is Error:
                 raise result  # Allow api.Errors to be either raised or returned.
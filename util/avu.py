@@ -1,15 +1,17 @@
 # -*- coding: utf-8 -*-
 """Utility / convenience functions for dealing with AVUs."""
 
-__copyright__ = 'Copyright (c) 2019-2021, Utrecht University'
+__copyright__ = 'Copyright (c) 2019-2023, Utrecht University'
 __license__   = 'GPLv3, see LICENSE'
 
 import itertools
+import re
 from collections import namedtuple
 
 import genquery
 import irods_types
 
+import jsonutil
 import msi
 import pathutil
 
@@ -40,6 +42,20 @@ def of_group(ctx, group):
                                               "USER_NAME = '{}' AND USER_TYPE = 'rodsgroup'".format(group)))
 
 
+def of_resource(ctx, resource):
+    """Get (a,v,u) triplets for a given resource."""
+    return itertools.imap(lambda x: Avu(*x),
+                          genquery.Query(ctx, "META_RESC_ATTR_NAME, META_RESC_ATTR_VALUE, META_RESC_ATTR_UNITS",
+                                              "RESC_NAME = '{}'".format(resource)))
+
+
+def of_user(ctx, name):
+    """Get (a,v,u) triplets for a given user or group."""
+    return itertools.imap(lambda x: Avu(*x),
+                          genquery.Query(ctx, "META_USER_ATTR_NAME, META_USER_ATTR_VALUE, META_USER_ATTR_UNITS",
+                                              "USER_NAME = '{}'".format(name)))
+
+
 def set_on_data(ctx, path, a, v):
     """Set key/value metadata on a data object."""
     x = msi.string_2_key_val_pair(ctx, '{}={}'.format(a, v), irods_types.BytesBuf())
@@ -113,3 +129,164 @@ def rmw_from_data(ctx, obj, a, v, u=''):
 def rmw_from_group(ctx, group, a, v, u=''):
     """Remove AVU from group with wildcards."""
     msi.rmw_avu(ctx, '-u', group, a, v, u)
+
+
+# Batched AVU operations {{{
+
+# iRODS entity types for atomic metadata operations, by imeta-style object type.
+_entity_types = {'-d': 'data_object',
+                 '-C': 'collection',
+                 '-u': 'user',
+                 '-R': 'resource'}
+
+
+def _like(pattern, s):
+    """Check if a string matches a (genquery / rmw style) wildcard pattern with '%' and '_'."""
+    r = ''.join('.*' if c == '%' else '.' if c == '_' else re.escape(c) for c in pattern)
+    return re.match('^{}$'.format(r), s, re.DOTALL) is not None
+
+
+def _unique(xs):
+    """Remove duplicates from an iterable, keeping the first occurrence."""
+    seen = set()
+    for x in xs:
+        if x not in seen:
+            seen.add(x)
+            yield x
+
+
+class Batch(object):
+    """A list of AVU operations on a single object, applied in one atomic request.
+
+    Operations are collected with set(), associate(), remove() and rmw(),
+    which behave like their set_on_*, associate_to_*, rm_from_* and
+    rmw_from_* counterparts. apply() then computes the resulting AVU changes
+    and submits them with msi_atomic_apply_metadata_operations: either all
+    changes are applied, or none of them.
+
+    Note that atomic metadata operations do not trigger the static metadata
+    PEPs (acPreProcForModifyAVUMetadata and acPostProcForModifyAVUMetadata),
+    so batches must not be used for attributes with policies attached, such
+    as folder, vault package and datarequest status.
+
+    Example:
+
+        batch = avu.Batch('-d', path)
+        batch.set('org_original_path', original_path)
+        batch.set('org_original_data_id', data_id)
+        batch.apply(ctx)
+    """
+
+    def __init__(self, obj_type, name):
+        """Create an empty batch.
+
+        :param obj_type: Object type ('-d', '-C', '-u' or '-R')
+        :param name:     Object path or name
+        """
+        if str(obj_type) not in _entity_types:
+            raise ValueError('Unsupported object type <{}> for AVU batch'.format(obj_type))
+
+        self.obj_type   = str(obj_type)
+        self.name       = name
+        self.operations = []  # [(operation, Avu)]
+
+    def _add(self, op, a, v, u):
+        self.operations.append((op, Avu('{}'.format(a), '{}'.format(v), '{}'.format(u))))
+
+    def set(self, a, v, u=''):
+        """Replace all AVUs with attribute a by a single AVU."""
+        self._add('set', a, v, u)
+
+    def associate(self, a, v, u=''):
+        """Add an AVU."""
+        self._add('associate', a, v, u)
+
+    def remove(self, a, v, u=''):
+        """Remove an AVU."""
+        self._add('remove', a, v, u)
+
+    def rmw(self, a, v, u=''):
+        """Remove AVUs matching wildcards ('%' and '_')."""
+        self._add('rmw', a, v, u)
+
+    def _existing(self, ctx):
+        """Get the current AVUs of the object."""
+        if self.obj_type == '-d':
+            return of_data(ctx, self.name)
+        elif self.obj_type == '-C':
+            return of_coll(ctx, self.name)
+        elif self.obj_type == '-u':
+            return of_user(ctx, self.name)
+        else:
+            return of_resource(ctx, self.name)
+
+    def changes(self, ctx):
+        """Compute the AVUs that must be removed and added to apply this batch.
+
+        The current AVUs of the object are only queried when the batch
+        contains set or rmw operations.
+
+        :param ctx: Combined type of a callback and rei struct
+
+        :returns: Tuple of lists of AVUs to remove and AVUs to add
+        """
+        if any(op in ['set', 'rmw'] for op, _ in self.operations):
+            before = set(self._existing(ctx))
+            after  = set(before)
+
+            for op, x in self.operations:
+                if op == 'set':
+                    after = set(y for y in after if y.attr != x.attr)
+                    after.add(x)
+                elif op == 'associate':
+                    after.add(x)
+                elif op == 'remove':
+                    after.discard(x)
+                else:
+                    after = set(y for y in after
+                                if not (_like(x.attr, y.attr) and _like(x.value, y.value) and _like(x.unit, y.unit)))
+
+            # Keep the order in which AVUs were specified where possible.
+            return (sorted(before - after),
+                    [x for x in _unique(x for _, x in self.operations) if x in after - before])
+
+        # Without set/rmw operations there is nothing to look up: removals
+        # and additions are applied as specified.
+        removed = []
+        added   = []
+        for op, x in self.operations:
+            if op == 'associate':
+                if x in removed:
+                    removed.remove(x)
+                elif x not in added:
+                    added.append(x)
+            elif x in added:
+                added.remove(x)
+            elif x not in removed:
+                removed.append(x)
+        return removed, added
+
+    def apply(self, ctx):
+        """Apply all operations in this batch in one atomic request.
+
+        :param ctx: Combined type of a callback and rei struct
+
+        :raises msi.AtomicApplyMetadataOperationsError: Operations could not be applied, no changes were made
+        """
+        removed, added = self.changes(ctx)
+
+        if len(removed) == 0 and len(added) == 0:
+            return
+
+        def operation(op, x):
+            return {'operation': op, 'attribute': x.attr, 'value': x.value, 'units': x.unit}
+
+        operations = ([operation('remove', x) for x in removed]
+                      + [operation('add', x) for x in added])
+        request = {'entity_name': self.name,
+                   'entity_type': _entity_types[self.obj_type],
+                   'operations':  operations}
+
+        msi.atomic_apply_metadata_operations(ctx, jsonutil.dump(request, indent=None), '')
+
+# }}}
@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+"""Per-agent caching facilities.
+
+The Python rule engine stays loaded for the lifetime of an iRODS agent, so
+module-level state survives between rule invocations handled by the same
+agent. The Cache type below keeps values in such module-level state.
+
+Values that can be changed by other agents are guarded by a generation
+stamp: a small file in the local cache directory that is rewritten whenever
+the underlying data changes (see Cache.invalidate()). A cache notices a
+changed stamp on the next lookup and drops its contents.
+
+Durable data shared by agents, such as queues, is kept in a separate local
+state directory (see durable_database()).
+"""
+
+__copyright__ = 'Copyright (c) 2023, Utrecht University'
+__license__   = 'GPLv3, see LICENSE'
+
+import errno
+import fcntl
+import os
+import sqlite3
+import stat
+import time
+from collections import OrderedDict
+
+from config import config
+
+CACHE_DIR = config.cache_dir or os.path.join(os.path.expanduser('~'), '.cache', 'yoda-ruleset')
+"""Local directory holding generation stamps and other ruleset cache files.
+
+Defaults to a directory in the home directory of the iRODS service account.
+"""
+
+STATE_DIR = config.state_dir or os.path.join(os.path.expanduser('~'), '.local', 'share', 'yoda-ruleset')
+"""Local directory holding durable ruleset state, such as queues.
+
+Unlike the cache directory, its contents cannot be recreated and must
+survive restarts and be included in backups.
+"""
+
+_checked_dirs = set()
+
+
+def _directory(directory):
+    """Create a local ruleset directory if needed, and check that it is private.
+
+    As other agents trust its contents, the directory must be owned by and
+    only accessible to the iRODS service account.
+
+    :param directory: Path of the directory
+
+    :returns: Path of the directory
+
+    :raises OSError: If the directory could not be created or is accessible to others
+    """
+    if directory not in _checked_dirs:
+        try:
+            os.makedirs(directory, 0o700)
+        except OSError as e:
+            # Created earlier, or concurrently by another agent.
+            if e.errno != errno.EEXIST:
+                raise
+        st = os.lstat(directory)
+        if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+            raise OSError(errno.EPERM, 'Directory must be owned by and private to the service account', directory)
+        _checked_dirs.add(directory)
+    return directory
+
+
+def _open(name, flags):
+    """Open a file in the local cache directory, without following symbolic links.
+
+    :param name:  File name
+    :param flags: os.open() flags
+
+    :returns: File descriptor
+    """
+    return os.open(path(name), flags | os.O_NOFOLLOW, 0o600)
+
+
+def path(name):
+    """Return the path of a file with the given name in the local cache directory.
+
+    The cache directory is created if it does not exist yet.
+
+    :param name: File name
+
+    :returns: Absolute path of the file in the cache directory
+
+    :raises OSError: If the cache directory could not be created or is accessible to others
+    """
+    return os.path.join(_directory(CACHE_DIR), name)
+
+
+def lock(name):
+    """Try to take an exclusive lock on a file in the local cache directory.
+
+    Locks are released automatically when the agent holding them exits.
+
+    :param name: Name of the lock file
+
+    :returns: Open lock file, or None if the lock is held by another process
+    """
+    while True:
+        f = os.fdopen(_open(name, os.O_WRONLY | os.O_CREAT | os.O_APPEND), 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            f.close()
+            if e.errno in (errno.EACCES, errno.EAGAIN):
+                return None
+            raise
+
+        # The previous holder may have removed the file before we locked it
+        # (see release()), in which case the lock must be taken on a new file.
+        try:
+            current = os.lstat(path(name))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                f.close()
+                raise
+            current = None
+
+        locked = os.fstat(f.fileno())
+        if current is not None and (current.st_dev, current.st_ino) == (locked.st_dev, locked.st_ino):
+            return f
+        f.close()
+
+
+def acquire_slot(name, limit, interval=1):
+    """Wait for one of a limited number of slots with the given name.
+
+    Slots bound the number of agents on this server doing something at the
+    same time, e.g. transfers to one resource.
+
+    :param name:     Name of the slots
+    :param limit:    Number of slots
+    :param interval: Interval in seconds between attempts to acquire a slot
+
+    :returns: Slot, to be released with release()
+    """
+    while True:
+        for i in range(max(limit, 1)):
+            slot = lock('{}-{}.slot'.format(name, i))
+            if slot is not None:
+                return slot
+        time.sleep(interval)
+
+
+def release(lock, name=None):
+    """Release a lock or slot, if any.
+
+    :param lock: Lock or slot to release
+    :param name: Name of the lock file, to remove the file while still holding the lock
+                 (for locks on names that are not reused, such as per-object locks)
+    """
+    if lock is not None:
+        try:
+            if name is not None:
+                os.unlink(path(name))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        finally:
+            lock.close()
+
+
+_databases = {}
+
+
+def _database(directory, name, statements, synchronous):
+    """Open a SQLite database with the given name in a local ruleset directory, once per agent."""
+    try:
+        db_path = os.path.join(_directory(directory), name + '.db')
+        # SQLite follows symbolic links.
+        if os.path.islink(db_path):
+            raise OSError(errno.ELOOP, 'Database is a symbolic link', db_path)
+    except OSError as e:
+        raise sqlite3.OperationalError('unable to open database: {}'.format(e))
+
+    if db_path not in _databases:
+        db = sqlite3.connect(db_path, timeout=10, isolation_level=None)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous={}'.format(synchronous))
+        for statement in statements:
+            db.execute(statement)
+        _databases[db_path] = db
+    return _databases[db_path]
+
+
+def database(name, *statements):
+    """Open a SQLite database with the given name in the local cache directory.
+
+    The database is shared by all agents on this server. Connections are
+    opened once per agent, in autocommit mode.
+
+    :param name:       Database name
+    :param statements: SQL statements to create the schema (should use 'IF NOT EXISTS')
+
+    :returns: Database connection
+    """
+    return _database(CACHE_DIR, name, statements, 'NORMAL')
+
+
+def durable_database(name, *statements):
+    """Open a SQLite database with the given name in the local state directory.
+
+    Like database(), but for data that cannot be recreated, such as queues.
+    Commits are synced to disk before they return.
+
+    :param name:       Database name
+    :param statements: SQL statements to create the schema (should use 'IF NOT EXISTS')
+
+    :returns: Database connection
+    """
+    return _database(STATE_DIR, name, statements, 'FULL')
+
+
+def generation(name):
+    """Read the current generation stamp with the given name.
+
+    :param name: Name of the generation stamp
+
+    :returns: Generation stamp, or '' if the stamp was never written
+    """
+    try:
+        fd = _open(name + '.generation', os.O_RDONLY)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return ''
+        raise
+    with os.fdopen(fd) as f:
+        return f.read()
+
+
+def bump(name):
+    """Write a new generation stamp with the given name.
+
+    :param name: Name of the generation stamp
+    """
+    stamp = '{:.6f}-{}'.format(time.time(), os.getpid())
+    tmp = '{}.generation.{}'.format(name, os.getpid())
+    with os.fdopen(_open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC), 'w') as f:
+        f.write(stamp)
+    # Atomically replace the stamp, so that readers never see a partial write.
+    os.rename(path(tmp), path(name + '.generation'))
+
+
+class Cache(object):
+    """Per-agent key/value cache.
+
+    Entries are dropped when:
+    - the named generation stamp changed (only if the cache is named),
+    - the entry is older than max_age seconds (if max_age is set),
+    - the cache holds more than max_size entries (least recently used first).
+
+    Example:
+
+        _cache = cache.Cache('group_data', max_age=300)
+
+        def load(ctx):
+            return _cache.get('all', lambda: expensive_query(ctx))
+    """
+
+    def __init__(self, name=None, max_age=None, max_size=None):
+        """Create a cache.
+
+        :param name:     Name of the generation stamp guarding this cache, None for an agent-local cache
+        :param max_age:  Maximum age of entries in seconds, None for no limit
+        :param max_size: Maximum number of entries, None for no limit
+        """
+        self.name       = name
+        self.max_age    = max_age
+        self.max_size   = max_size
+        self._entries   = OrderedDict()  # key => (time, value)
+        self._gen       = None
+
+    def _check_generation(self):
+        """Drop all entries if the generation stamp changed since they were stored."""
+        if self.name is None:
+            return
+        gen = generation(self.name)
+        if gen != self._gen:
+            self._entries.clear()
+            self._gen = gen
+
+    def get(self, key, load):
+        """Get a cached value, calling load() to produce it when absent.
+
+        :param key:  Cache key
+        :param load: Function without arguments returning the value for key
+
+        :returns: Cached or freshly loaded value
+        """
+        # Read the generation before loading, so that changes made while
+        # loading are noticed at the next lookup.
+        self._check_generation()
+
+        now = time.time()
+        if key in self._entries:
+            t, value = self._entries.pop(key)
+            if self.max_age is None or now - t < self.max_age:
+                self._entries[key] = (t, value)
+                return value
+
+        value = load()
+        self._entries[key] = (now, value)
+
+        if self.max_size is not None:
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+        return value
+
+    def drop(self, key):
+        """Remove a single entry from this agent's cache, if present."""
+        self._entries.pop(key, None)
+
+    def clear(self):
+        """Remove all entries from this agent's cache."""
+        self._entries.clear()
+
+    def invalidate(self):
+        """Invalidate this cache in all agents (by bumping its generation stamp)."""
+        self.clear()
+        if self.name is not None:
+            bump(self.name)
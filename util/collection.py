@@ -1,18 +1,49 @@
 # -*- coding: utf-8 -*-
 """Utility / convenience functions for dealing with collections."""
 
-__copyright__ = 'Copyright (c) 2019-2021, Utrecht University'
+__copyright__ = 'Copyright (c) 2019-2023, Utrecht University'
 __license__   = 'GPLv3, see LICENSE'
 
 import itertools
-import sys
-if sys.version_info > (2, 7):
-    from functools import reduce
+import sqlite3
+import time
 
 import genquery
 import irods_types
 
+import cache
 import msi
+import user
+
+STATS_MAX_AGE = 3600
+"""Maximum age in seconds of indexed collection statistics.
+
+Statistics are invalidated by the policies of the server where a change takes
+place. This bounds how long changes made through other servers go unnoticed.
+"""
+
+LISTING_MAX_AGE = 120
+"""Maximum age in seconds of indexed collection listings.
+
+Listings are invalidated together with statistics and after permission
+changes, and are checked against a summary of the collection's contents in
+the catalog on every lookup. As the contents a client can see depend on its
+permissions, listings are indexed per client and kept for a shorter time,
+which bounds how long changes that the summary does not reveal (e.g. renames
+through other servers) go unnoticed.
+"""
+
+STATS_INVALIDATE_TIMEOUT = 100
+"""Time in milliseconds that invalidation waits for other writers of the index.
+
+Invalidation runs in the policies of every write. If it cannot update the
+index in time, it invalidates the index as a whole instead.
+"""
+
+LISTING_SORT = {'name':     'rank',
+                'modified': 'modify_time',
+                'size':     'size'}
+"""Columns that collection listings can be sorted on."""
 
 
 def exists(ctx, path):
@@ -43,18 +74,349 @@ def empty(ctx, path):
                     genquery.AS_LIST, ctx))) == 0)
 
 
+# Collection statistics index {{{
+
+# The recursive size, data object count and subcollection count of
+# collections are kept in a local index, shared by all agents on this server.
+#
+# Entries are never updated in place. Instead, policies call
+# invalidate_stats() for every path that is written to, removed or renamed,
+# which resets the entries of all its parent collections (and of the path
+# itself, if it is an indexed collection). The next lookup then recomputes
+# and stores them.
+#
+# Invalidation leaves an empty entry behind with the time of invalidation,
+# so that a statistic that was being computed while the collection changed
+# is never stored. Entries older than STATS_MAX_AGE are of no use and are
+# pruned when statistics are stored.
+#
+# If invalidation fails, the 'collection-stats' generation stamp is bumped
+# instead. Entries and listings stored before the stamp are not used.
+
+_STATS_COLUMNS = ['size', 'data_count', 'collection_count']
+
+_SCHEMA = ('CREATE TABLE IF NOT EXISTS stats (path TEXT PRIMARY KEY, time REAL NOT NULL,'
+           ' size INTEGER, data_count INTEGER, collection_count INTEGER)',
+           'CREATE INDEX IF NOT EXISTS stats_time ON stats (time)',
+           'CREATE TABLE IF NOT EXISTS listings (id INTEGER PRIMARY KEY AUTOINCREMENT, path TEXT NOT NULL,'
+           ' client TEXT NOT NULL, time REAL NOT NULL, fingerprint TEXT, UNIQUE (path, client))',
+           'CREATE TABLE IF NOT EXISTS entries (listing INTEGER NOT NULL, coll INTEGER NOT NULL,'
+           ' name TEXT NOT NULL, rank INTEGER NOT NULL, modify_time INTEGER NOT NULL, size INTEGER)',
+           'CREATE INDEX IF NOT EXISTS entries_listing ON entries (listing)')
+
+
+def _stats():
+    """Open the collection statistics index."""
+    return cache.database('collection-stats', *_SCHEMA)
+
+
+def _valid_after(max_age):
+    """Get the time after which index entries must have been stored to be valid.
+
+    :param max_age: Maximum age in seconds of the entries
+
+    :returns: Time in seconds since the epoch
+    """
+    stamp = cache.generation('collection-stats')
+    return max(time.time() - max_age, float(stamp.split('-')[0]) if stamp else 0)
+
+
+def _indexed(path, columns, compute):
+    """Look up statistics of a collection in the index, computing them if needed.
+
+    :param path:    Path of collection
+    :param columns: Names of the statistics to look up
+    :param compute: Function without arguments returning the values of the statistics
+
+    :returns: Tuple with the values of the statistics
+    """
+    try:
+        valid = _valid_after(STATS_MAX_AGE)
+        row = _stats().execute('SELECT {} FROM stats WHERE path = ? AND time > ?'.format(', '.join(columns)),
+                               (path, valid)).fetchone()
+        if row is not None and None not in row:
+            return tuple(row)
+    except (sqlite3.Error, OSError, ValueError):
+        # The index is only an optimization.
+        return tuple(compute())
+
+    start = time.time()
+    values = tuple(compute())
+
+    # Statistics of an expired entry that are not recomputed are dropped.
+    others = [c for c in _STATS_COLUMNS if c not in columns]
+
+    try:
+        db = _stats()
+        # Skip storing if the collection was invalidated while computing.
+        if db.execute('UPDATE stats SET time = ?, {} WHERE path = ? AND time <= ?'
+                      .format(', '.join(['{} = ?'.format(c) for c in columns]
+                                        + ['{0} = CASE WHEN time > ? THEN {0} END'.format(c) for c in others])),
+                      (start,) + values + (valid,) * len(others) + (path, start)).rowcount == 0:
+            db.execute('INSERT OR IGNORE INTO stats (path, time, {}) VALUES (?, ?, {})'
+                       .format(', '.join(columns), ', '.join('?' * len(columns))),
+                       (path, start) + values)
+        db.execute('DELETE FROM stats WHERE time < ?', (start - STATS_MAX_AGE,))
+    except sqlite3.Error:
+        pass
+
+    return values
+
+
+def _invalidate(statements):
+    """Run invalidation statements on the index.
+
+    Every statement commits on its own, so that writers of the index never
+    wait for a transaction spanning the whole invalidation. If the index
+    cannot be updated, all its entries are invalidated instead.
+
+    :param statements: List of (SQL statement, parameters) tuples
+    """
+    try:
+        db = _stats()
+        timeout = db.execute('PRAGMA busy_timeout').fetchone()[0]
+        db.execute('PRAGMA busy_timeout = {}'.format(STATS_INVALIDATE_TIMEOUT))
+        try:
+            for statement, params in statements:
+                db.execute(statement, params)
+        finally:
+            db.execute('PRAGMA busy_timeout = {}'.format(timeout))
+    except sqlite3.Error:
+        # Invalidate all entries at once, which does not need the index.
+        try:
+            cache.bump('collection-stats')
+        except OSError:
+            # The cache directory is unusable, and so is the index.
+            pass
+
+
+def invalidate_stats(path, recursive=False):
+    """Invalidate indexed statistics and listings after a change to a path.
+
+    Statistics and listings of all parent collections of the path are
+    invalidated, as well as those of the path itself if it is an indexed
+    collection.
+
+    :param path:      Path of changed collection or data object
+    :param recursive: Invalidate subcollections as well (e.g. after a collection is removed or renamed)
+    """
+    path  = path.rstrip('/')
+    parts = path.split('/')
+    paths = ['/'.join(parts[:i]) for i in range(2, len(parts))]
+    now = time.time()
+
+    statements = [('INSERT OR REPLACE INTO stats (path, time) VALUES (?, ?)', (p, now)) for p in paths]
+    statements.append(('UPDATE stats SET time = ?, size = NULL, data_count = NULL, collection_count = NULL'
+                       ' WHERE path = ?', (now, path)))
+    if recursive:
+        prefix = path + '/'
+        statements.append(('UPDATE stats SET time = ?, size = NULL, data_count = NULL, collection_count = NULL'
+                           ' WHERE substr(path, 1, ?) = ?', (now, len(prefix), prefix)))
+        # Expired listings are dropped the next time a listing is stored.
+        statements.append(('UPDATE listings SET time = 0 WHERE path = ? OR substr(path, 1, ?) = ?',
+                           (path, len(prefix), prefix)))
+    _invalidate(statements)
+
+
+def invalidate_listings(path, recursive=False):
+    """Invalidate indexed listings after a change to the permissions of a path.
+
+    The listings of the parent collection of the path are invalidated, as
+    well as those of the path itself if it is a collection.
+
+    :param path:      Path of collection or data object
+    :param recursive: Invalidate listings of subcollections as well
+    """
+    path   = path.rstrip('/')
+    prefix = path + '/'
+    if recursive:
+        _invalidate([('UPDATE listings SET time = 0 WHERE path IN (?, ?) OR substr(path, 1, ?) = ?',
+                      (path, path.rsplit('/', 1)[0], len(prefix), prefix))])
+    else:
+        _invalidate([('UPDATE listings SET time = 0 WHERE path IN (?, ?)', (path, path.rsplit('/', 1)[0]))])
+
+
+def _data_stats(ctx, path):
+    """Compute a collection's recursive size in bytes and data count."""
+    ids  = set()
+    size = 0
+    for data_id, data_size in itertools.chain(genquery.row_iterator("DATA_ID, DATA_SIZE",
+                                                                    "COLL_NAME = '{}'".format(path),
+                                                                    genquery.AS_LIST, ctx),
+                                              genquery.row_iterator("DATA_ID, DATA_SIZE",
+                                                                    "COLL_NAME like '{}/%'".format(path),
+                                                                    genquery.AS_LIST, ctx)):
+        ids.add(data_id)
+        size += int(data_size)
+    return size, len(ids)
+
+# }}}
+# Collection listing index {{{
+
+# Listings of the subcollections and data objects of a collection are kept in
+# the same index as statistics, one listing per collection and client. A
+# listing is valid as long as it is newer than the entry of its collection in
+# the statistics table, so invalidate_stats() invalidates listings as well.
+#
+# Pages are sorted and sliced from the index, so paging through or re-sorting
+# a large collection queries the catalog only once.
+
+
+def _list_contents(ctx, path):
+    """Query the subcollections and data objects of a collection.
+
+    Entries are ranked in the order of their names in the catalog, so that
+    listings sorted on name use the collation of the catalog.
+
+    :returns: Generator of (coll, name, rank, modify_time, size) tuples, coll being 1 for subcollections
+    """
+    for rank, (coll_name, modify_time) in enumerate(genquery.row_iterator("ORDER(COLL_NAME), COLL_MODIFY_TIME",
+                                                                          "COLL_PARENT_NAME = '{}'".format(path),
+                                                                          genquery.AS_LIST, ctx)):
+        yield 1, coll_name.split('/')[-1], rank, int(modify_time), None
+
+    # Aggregating groups rows by data name, which lists each data object once
+    # regardless of its number of replicas.
+    for rank, (data_name, modify_time, data_size) in enumerate(
+            genquery.row_iterator("ORDER(DATA_NAME), MAX(DATA_MODIFY_TIME), MAX(DATA_SIZE)",
+                                  "COLL_NAME = '{}'".format(path),
+                                  genquery.AS_LIST, ctx)):
+        yield 0, data_name, rank, int(modify_time), int(data_size)
+
+
+def _contents_fingerprint(ctx, path):
+    """Summarize the subcollections and data objects of a collection that the client can see.
+
+    The summary changes when entries are added, removed or modified, also
+    through other servers, and when the client's permissions on them change.
+
+    :returns: Summary as a string
+    """
+    colls = genquery.Query(ctx, "COUNT(COLL_ID), MAX(COLL_MODIFY_TIME)",
+                           "COLL_PARENT_NAME = '{}'".format(path)).first()
+    data  = genquery.Query(ctx, "COUNT(DATA_ID), MAX(DATA_MODIFY_TIME), SUM(DATA_SIZE)",
+                           "COLL_NAME = '{}'".format(path)).first()
+    return repr((colls, data))
+
+
+def _store_listing(db, path, client, start, fingerprint, entries):
+    """Store a listing in the index, replacing the previous listing and dropping expired ones.
+
+    :returns: Id of the stored listing
+    """
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        stale  = '(path = ? AND client = ?) OR time <= ?'
+        params = (path, client, start - LISTING_MAX_AGE)
+        db.execute('DELETE FROM entries WHERE listing IN (SELECT id FROM listings WHERE {})'.format(stale), params)
+        db.execute('DELETE FROM listings WHERE {}'.format(stale), params)
+        listing_id = db.execute('INSERT INTO listings (path, client, time, fingerprint) VALUES (?, ?, ?, ?)',
+                                (path, client, start, fingerprint)).lastrowid
+        db.executemany('INSERT INTO entries (listing, coll, name, rank, modify_time, size) VALUES (?, ?, ?, ?, ?, ?)',
+                       ((listing_id,) + entry for entry in entries))
+        db.execute('COMMIT')
+    except sqlite3.Error:
+        db.execute('ROLLBACK')
+        raise
+    return listing_id
+
+
+def _indexed_listing(ctx, db, path, client):
+    """Look up the listing of a collection in the index, listing the collection if needed.
+
+    :returns: Id of the listing
+    """
+    fingerprint = _contents_fingerprint(ctx, path)
+    row = db.execute('SELECT l.id FROM listings l LEFT JOIN stats s ON s.path = l.path'
+                     ' WHERE l.path = ? AND l.client = ? AND l.time > ? AND l.fingerprint = ?'
+                     ' AND (s.time IS NULL OR s.time <= l.time)',
+                     (path, client, _valid_after(LISTING_MAX_AGE), fingerprint)).fetchone()
+    if row is not None:
+        return row[0]
+
+    # A listing invalidated while querying has an older time than its invalidation,
+    # and one changed while querying has a different fingerprint.
+    start = time.time()
+    return _store_listing(db, path, client, start, fingerprint, list(_list_contents(ctx, path)))
+
+
+def _listing_page(db, listing_id, path, sort_on, sort_order, offset, limit, data, include, exclude):
+    """Get the total number of entries and a page of entries of an indexed listing."""
+    conditions = ['listing = ?']
+    params     = [listing_id]
+    prefix     = path.rstrip('/') + '/'
+
+    if not data:
+        conditions.append('coll = 1')
+    if include:
+        conditions.append('(coll = 0 OR {})'.format(' OR '.join(['(? || name) GLOB ?'] * len(include))))
+        params += [x for pattern in include for x in (prefix, pattern)]
+    for pattern in exclude or []:
+        conditions.append('(coll = 0 OR NOT (? || name) GLOB ?)')
+        params += [prefix, pattern]
+
+    where     = ' AND '.join(conditions)
+    direction = 'DESC' if sort_order == 'desc' else 'ASC'
+
+    # Read the count and the page from the same snapshot of the index.
+    db.execute('BEGIN')
+    try:
+        total = db.execute('SELECT COUNT(*) FROM entries WHERE {}'.format(where), params).fetchone()[0]
+        rows  = db.execute('SELECT coll, name, modify_time, size FROM entries WHERE {}'
+                           ' ORDER BY coll DESC, {} {}, rank {} LIMIT ? OFFSET ?'
+                           .format(where, LISTING_SORT.get(sort_on, 'rank'), direction, direction),
+                           params + [limit, offset]).fetchall()
+    finally:
+        db.execute('COMMIT')
+
+    items = []
+    for coll, name, modify_time, data_size in rows:
+        if coll:
+            items.append({'name': name, 'type': 'coll', 'modify_time': modify_time})
+        else:
+            items.append({'name': name, 'type': 'data', 'modify_time': modify_time, 'size': data_size})
+    return total, items
+
+
+def listing(ctx, path, sort_on='name', sort_order='asc', offset=0, limit=10, data=True, include=None, exclude=None):
+    """Get a page of the contents of a collection.
+
+    Subcollections are listed before data objects. Data objects are listed
+    once regardless of their number of replicas, with the most recent modify
+    time and the size of their largest replica.
+
+    :param ctx:        Combined type of a callback and rei struct
+    :param path:       Path of collection
+    :param sort_on:    Column to sort on ('name', 'modified' or 'size')
+    :param sort_order: Column sort order ('asc' or 'desc')
+    :param offset:     Offset of the first entry of the page
+    :param limit:      Maximum number of entries in the page
+    :param data:       List data objects as well as subcollections
+    :param include:    GLOB patterns of subcollection paths to list (all subcollections if not given)
+    :param exclude:    GLOB patterns of subcollection paths not to list
+
+    :returns: Tuple of the total number of entries and a list of the entries of the page (dicts with
+              'name', 'type', 'modify_time' and, for data objects, 'size')
+    """
+    client = user.full_name(ctx)
+    page   = (path, sort_on, sort_order, int(offset), int(limit), data, include, exclude)
+
+    try:
+        db = _stats()
+        return _listing_page(db, _indexed_listing(ctx, db, path, client), *page)
+    except (sqlite3.Error, OSError, ValueError):
+        # The index is only an optimization: use a private in-memory index instead.
+        db = sqlite3.connect(':memory:', isolation_level=None)
+        for statement in _SCHEMA:
+            db.execute(statement)
+        return _listing_page(db, _store_listing(db, path, client, time.time(), None, _list_contents(ctx, path)), *page)
+
+# }}}
+
+
 def size(ctx, path):
     """Get a collection's size in bytes."""
-    def func(x, row):
-        return x + int(row[1])
-
-    return reduce(func,
-                  itertools.chain(genquery.row_iterator("DATA_ID, DATA_SIZE",
-                                                        "COLL_NAME like '{}'".format(path),
-                                                        genquery.AS_LIST, ctx),
-                                  genquery.row_iterator("DATA_ID, DATA_SIZE",
-                                                        "COLL_NAME like '{}/%'".format(path),
-                                                        genquery.AS_LIST, ctx)), 0)
+    return _indexed(path, ['size', 'data_count'], lambda: _data_stats(ctx, path))[0]
 
 
 def data_count(ctx, path, recursive=True):
@@ -66,17 +428,26 @@ def data_count(ctx, path, recursive=True):
 
     :returns: Number of data objects
     """
+    if recursive:
+        return _indexed(path, ['size', 'data_count'], lambda: _data_stats(ctx, path))[1]
+
     # Generators can't be fed to len(), so here we are...
     return sum(1 for _ in data_objects(ctx, path, recursive=recursive))
 
 
 def collection_count(ctx, path, recursive=True):
     """Get a collection's collection count (the amount of collections within a collection)."""
-    return sum(1 for _ in genquery.row_iterator(
-               "COLL_ID",
-               "COLL_NAME like '{}/%'".format(path) if recursive else
-               "COLL_PARENT_NAME = '{}' AND COLL_NAME like '{}/%'".format(path, path),
-               genquery.AS_LIST, ctx))
+    def count():
+        return [sum(1 for _ in genquery.row_iterator(
+                    "COLL_ID",
+                    "COLL_NAME like '{}/%'".format(path) if recursive else
+                    "COLL_PARENT_NAME = '{}' AND COLL_NAME like '{}/%'".format(path, path),
+                    genquery.AS_LIST, ctx))]
+
+    if recursive:
+        return _indexed(path, ['collection_count'], count)[0]
+
+    return count()[0]
 
 
 def subcollections(ctx, path, recursive=False):
@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 """Yoda ruleset configuration."""
 
-__copyright__ = 'Copyright (c) 2019-2022, Utrecht University'
+__copyright__ = 'Copyright (c) 2019-2023, Utrecht University'
 __license__   = 'GPLv3, see LICENSE'
 
 
@@ -72,9 +72,11 @@ class Config(object):
 
 # Note: Must name all valid config items.
 config = Config(environment=None,
+                log_level=None,
                 resource_primary=[],
                 resource_trigger_pol=[],
                 resource_replica=[],
+                replication_resource_limits=[],
                 resource_research=None,
                 resource_vault=None,
                 notifications_enabled=False,
@@ -86,10 +88,13 @@ config = Config(environment=None,
                 smtp_password=None,
                 smtp_auth=True,
                 smtp_starttls=True,
+                smtp_outbox=False,
                 datacite_rest_api_url=None,
                 datacite_username=None,
                 datacite_password=None,
                 datacite_publisher=None,
+                publication_stage_limits=[],
+                publication_secure_copy='securecopy.sh',
                 eus_api_fqdn=None,
                 eus_api_port=None,
                 eus_api_secret=None,
@@ -100,6 +105,8 @@ config = Config(environment=None,
                 enable_data_package_reference=False,
                 enable_tokens=False,
                 enable_tape_archive=False,
+                tape_archive_dmattr='tape-archive-dmattr',
+                tape_archive_dmget='dmget',
                 token_database=None,
                 token_database_password=None,
                 token_length=0,
@@ -111,6 +118,8 @@ config = Config(environment=None,
                 epic_handle_prefix=None,
                 epic_key=None,
                 epic_certificate=None,
+                cache_dir=None,
+                state_dir=None,
                 temporary_files=[],
                 external_users_domain_filter=[])
 
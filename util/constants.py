@@ -72,6 +72,7 @@ IILOCKATTRNAME        = UUORGMETADATAPREFIX + 'lock'
 IISTATUSATTRNAME      = UUORGMETADATAPREFIX + 'status'
 IIVAULTSTATUSATTRNAME = UUORGMETADATAPREFIX + 'vault_status'
 IICOPYPARAMSNAME      = UUORGMETADATAPREFIX + 'copy_to_vault_params'
+IICOPYCHECKPOINTNAME  = UUORGMETADATAPREFIX + 'copy_to_vault_checkpoint'
 
 DATA_PACKAGE_REFERENCE = UUORGMETADATAPREFIX + 'data_package_reference'
 
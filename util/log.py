@@ -1,25 +1,118 @@
 # -*- coding: utf-8 -*-
-"""Logging facilities."""
+"""Logging facilities.
 
-__copyright__ = 'Copyright (c) 2019-2022, Utrecht University'
+Messages are filtered by level before any work is done for them: the
+calling module, the client user and the message itself are only resolved
+and formatted for messages that are actually written. The level is set with
+the 'log_level' configuration item ('debug', 'info' or 'error'). By default,
+debug messages are only written in development environments.
+
+To avoid formatting discarded messages, pass format arguments separately:
+
+    log.debug(ctx, 'check data write <{}>', path)
+
+Keyword arguments are appended to the message as key=value fields, so that
+log lines can be processed by tools:
+
+    log.write(ctx, 'Batch finished', objects=10, ms=1234)
+    # => {rods#tempZone} [replication] Batch finished objects=10 ms=1234
+"""
+
+__copyright__ = 'Copyright (c) 2019-2023, Utrecht University'
 __license__   = 'GPLv3, see LICENSE'
 
-import inspect
+import json
+import sys
 
 import rule
 import user
 from config import config
 
+try:
+    string_types = basestring
+except NameError:
+    # Python 3.
+    string_types = str
+
+LEVELS = {'debug': 10, 'info': 20, 'error': 40}
+"""Log levels. Messages written with _write() are never filtered."""
+
+_threshold = None
+
+
+def enabled(level):
+    """Check whether messages of a given level are written.
+
+    :param level: Log level name ('debug', 'info' or 'error')
+
+    :returns: Boolean indicating whether messages of this level are written
+    """
+    global _threshold
+    if _threshold is None:
+        # The configuration does not change during the lifetime of an agent.
+        default = 'debug' if config.environment == 'development' else 'info'
+        _threshold = LEVELS.get(config.log_level, LEVELS[default])
+    return LEVELS[level] >= _threshold
+
+
+def _client(ctx):
+    """Get the client user of a rule call, formatted as 'user#zone'.
+
+    Resolving the client requires the session variables, so the result is
+    kept for the lifetime of the rule call's context.
+    """
+    # Look in the instance dict: rule.Context forwards unknown attributes to the callback.
+    client = ctx.__dict__.get('_log_client')
+    if client is None:
+        client = ctx.__dict__['_log_client'] = u'{}#{}'.format(*user.user_and_zone(ctx))
+    return client
+
+
+def _format(message, args, fields):
+    """Format a message with its arguments and key=value fields."""
+    if args:
+        message = message.format(*args)
+    if fields:
+        message = u'{} {}'.format(message, u' '.join(u'{}={}'.format(k, _value(v))
+                                                     for k, v in sorted(fields.items())))
+    return message
+
+
+def _value(v):
+    """Format a field value, quoting it if needed to keep key=value pairs parseable."""
+    if isinstance(v, string_types):
+        return json.dumps(v) if (v == '' or any(c in v for c in ' "=')) else v
+    return v
+
+
+def _write_from(ctx, frame, message, args, fields):
+    """Write a message to the log, including client name and the module of the given stack frame."""
+    module = frame.f_globals.get('__name__', '')
+    _write(ctx, u'[{}] {}'.format(module.replace("rules_uu.", ""), _format(message, args, fields)))
+
 
-def write(ctx, message):
+def write(ctx, message, *args, **fields):
     """Write a message to the log, including client name and originating module.
 
     :param ctx:     Combined type of a callback and rei struct
-    :param message: Message to write to log
+    :param message: Message to write to log (a format string if args are given)
+    :param args:    Arguments to format the message with
+    :param fields:  Key/value fields to append to the message
     """
-    stack = inspect.stack()[1]
-    module = inspect.getmodule(stack[0])
-    _write(ctx, u'[{}] {}'.format(module.__name__.replace("rules_uu.", ""), message))
+    if enabled('info'):
+        _write_from(ctx, sys._getframe(1), message, args, fields)
+
+
+def error(ctx, message, *args, **fields):
+    """Write an error message to the log, including client name and originating module.
+
+    :param ctx:     Combined type of a callback and rei struct
+    :param message: Message to write to log (a format string if args are given)
+    :param args:    Arguments to format the message with
+    :param fields:  Key/value fields to append to the message
+    """
+    if enabled('error'):
+        _write_from(ctx, sys._getframe(1), u'ERROR - ' + message, args, fields)
 
 
 def _write(ctx, message):
@@ -29,16 +122,18 @@ def _write(ctx, message):
     :param message: Message to write to log
     """
     if type(ctx) is rule.Context:
-        ctx.writeLine('serverLog', u'{{{}#{}}} {}'.format(*list(user.user_and_zone(ctx)) + [message]))
+        ctx.writeLine('serverLog', u'{{{}}} {}'.format(_client(ctx), message))
     else:
         ctx.writeLine('serverLog', message)
 
 
-def debug(ctx, message):
-    """"Write a message to the log, if in a development environment.
+def debug(ctx, message, *args, **fields):
+    """"Write a message to the log, if debug messages are enabled (by default in development environments).
 
     :param ctx:     Combined type of a callback and rei struct
-    :param message: Message to write to log
+    :param message: Message to write to log (a format string if args are given)
+    :param args:    Arguments to format the message with
+    :param fields:  Key/value fields to append to the message
     """
-    if config.environment == 'development':
-        _write(ctx, 'DEBUG: {}'.format(message))
+    if enabled('debug'):
+        _write(ctx, u'DEBUG: {}'.format(_format(message, args, fields)))
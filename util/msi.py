@@ -129,4 +129,7 @@ remove_key_value_pairs_from_obj, RemoveKeyValuePairsFromObjError = \
 add_avu, AddAvuError = make('_add_avu', 'Could not add metadata to object')
 rmw_avu, RmwAvuError = make('_rmw_avu', 'Could not remove metadata to object')
 
+atomic_apply_metadata_operations, AtomicApplyMetadataOperationsError = \
+    make('_atomic_apply_metadata_operations', 'Could not apply metadata operations to object')
+
 sudo_obj_acl_set, SudoObjAclSetError = make('SudoObjAclSet', 'Could not set ACLs as admin')
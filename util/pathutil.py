@@ -7,6 +7,7 @@ __copyright__ = 'Copyright (c) 2019-2021, Utrecht University'
 __license__   = 'GPLv3, see LICENSE'
 
 import re
+from collections import namedtuple
 from enum import Enum
 
 import genquery
@@ -73,6 +74,28 @@ def chopext(path):
     return path.rsplit('.', 1)
 
 
+PathInfo = namedtuple('PathInfo', 'space zone group subpath'.split())
+"""Result of info(): the space, zone, group and subpath of a path."""
+
+# Paths in (or of) a group collection, and other paths in a zone.
+_GROUP_PATH = re.compile(r'^/([^/]+)/home/([^/]+)(?:/(.+))?$')
+_ZONE_PATH  = re.compile(r'^/([^/]+)(?:/(.+))?$')
+
+# Spaces of group collections, by group name prefix.
+_GROUP_PREFIX = re.compile(r'^(vault|research|deposit|datamanager|grp-intake|datarequests)-')
+_GROUP_SPACES = {'vault':        Space.VAULT,
+                 'research':     Space.RESEARCH,
+                 'deposit':      Space.DEPOSIT,
+                 'datamanager':  Space.DATAMANAGER,
+                 'grp-intake':   Space.INTAKE,
+                 'datarequests': Space.DATAREQUEST}
+
+# Memo of recent results: policies classify the same paths several times per
+# operation. A plain dict is used, as an LRU cache costs more than classifying.
+_info_memo = {}
+INFO_MEMO_SIZE = 1024
+
+
 def info(path):
     """Parse a path into a (Space, zone, group, subpath) tuple.
 
@@ -98,33 +121,34 @@ def info(path):
 
     :returns: Tuple with space, zone, group and subpath
     """
-    # Turn empty match groups into empty strings.
-    def f(x):
-        return '' if x is None else x
-
-    def g(m, i):
-        return '' if i > len(m.groups()) else f(m.group(i))
-
-    def result(s, m):
-        return (s, g(m, 1), g(m, 2), g(m, 3))
-
-    # Try a pattern and report success if it matches.
-    def test(r, space):
-        m = re.match(r, path)
-        return m and result(space, m)
-
-    from collections import namedtuple
-
-    return (namedtuple('PathInfo', 'space zone group subpath'.split())
-            (*test('^/([^/]+)/home/(vault-[^/]+)(?:/(.+))?$',         Space.VAULT)
-            or test('^/([^/]+)/home/(research-[^/]+)(?:/(.+))?$',     Space.RESEARCH)
-            or test('^/([^/]+)/home/(deposit-[^/]+)(?:/(.+))?$',      Space.DEPOSIT)
-            or test('^/([^/]+)/home/(datamanager-[^/]+)(?:/(.+))?$',  Space.DATAMANAGER)
-            or test('^/([^/]+)/home/(grp-intake-[^/]+)(?:/(.+))?$',   Space.INTAKE)
-            or test('^/([^/]+)/home/(datarequests-[^/]+)(?:/(.+))?$', Space.DATAREQUEST)
-            or test('^/([^/]+)/home/([^/]+)(?:/(.+))?$',              Space.OTHER)
-            or test('^/([^/]+)()(?:/(.+))?$',                         Space.OTHER)
-            or (Space.OTHER, '', '', '')))  # (matches '/' and empty paths)
+    try:
+        return _info_memo[path]
+    except KeyError:
+        pass
+
+    if len(_info_memo) >= INFO_MEMO_SIZE:
+        _info_memo.clear()
+    result = _info_memo[path] = _classify(path)
+    return result
+
+
+def _classify(path):
+    """Parse a path into a PathInfo tuple, without caching (see info())."""
+    m = _GROUP_PATH.match(path)
+    if m:
+        zone, group, subpath = m.groups()
+        prefix = _GROUP_PREFIX.match(group)
+        # The group name must continue after its prefix.
+        if prefix and len(group) > prefix.end():
+            return PathInfo(_GROUP_SPACES[prefix.group(1)], zone, group, subpath or '')
+        return PathInfo(Space.OTHER, zone, group, subpath or '')
+
+    m = _ZONE_PATH.match(path)
+    if m:
+        return PathInfo(Space.OTHER, m.group(1), '', m.group(2) or '')
+
+    # (matches '/' and empty paths)
+    return PathInfo(Space.OTHER, '', '', '')
 
 
 def object_type(ctx, path):
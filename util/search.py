@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""Local full-text index of collection and data object names and metadata.
+
+Searching the catalog for a part of a name or metadata value requires a full
+scan (LIKE '%term%'). Instead, names of collections and data objects in
+/zone/home and the values of their collection's user metadata are kept in a
+local SQLite FTS index, shared by all agents on this server.
+
+The index is kept up to date by the policies for creating, removing and
+renaming collections and data objects, and by metadata ingestion. It is
+built, and periodically rebuilt to include changes made through other
+servers, by rule_search_index_rebuild (see tools/search-index-rebuild.r).
+Until it has been built, searches are answered from the catalog.
+
+Search terms match words in names and metadata by prefix: 'exp dat' matches
+'experiment-data.csv'. Case and diacritics are ignored.
+"""
+
+__copyright__ = 'Copyright (c) 2023, Utrecht University'
+__license__   = 'GPLv3, see LICENSE'
+
+import re
+import sqlite3
+import time
+import unicodedata
+
+import cache
+
+try:
+    text_type, string_types = unicode, basestring
+except NameError:
+    # Python 3.
+    text_type, string_types = str, str
+
+_SCHEMA = ('CREATE TABLE IF NOT EXISTS entries (id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL,'
+           ' kind TEXT NOT NULL, home TEXT NOT NULL, name TEXT NOT NULL)',
+           # Words are split and normalized by _words(), the 'simple' tokenizer only needs to split on spaces.
+           'CREATE VIRTUAL TABLE IF NOT EXISTS terms USING fts4(name, metadata, tokenize=simple)',
+           'CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)')
+
+SEARCH_FIELDS = ['name', 'metadata']
+"""Indexed fields that can be searched."""
+
+
+def _index():
+    """Open the search index."""
+    return cache.database('search-index', *_SCHEMA)
+
+
+def _words(text):
+    """Split text into lowercase words without diacritics."""
+    if not isinstance(text, text_type):
+        text = text.decode('utf-8', 'replace')
+    text = u''.join(c for c in unicodedata.normalize('NFKD', text) if not unicodedata.combining(c))
+    return re.findall(r'[^\W_]+', text.lower(), re.UNICODE)
+
+
+def _home(path):
+    """Get the name of the home collection a path is in, or None if the path is not in a home collection."""
+    parts = path.split('/')
+    if len(parts) < 4 or parts[2] != 'home' or parts[3] == '':
+        return None
+    return parts[3]
+
+
+def _insert(db, path, kind, metadata=''):
+    """Insert or replace an entry in the index."""
+    home = _home(path)
+    if home is None:
+        return
+    name = path.rsplit('/', 1)[-1]
+    _delete(db, path)
+    entry_id = db.execute('INSERT INTO entries (path, kind, home, name) VALUES (?, ?, ?, ?)',
+                          (path, kind, home, name)).lastrowid
+    db.execute('INSERT INTO terms (docid, name, metadata) VALUES (?, ?, ?)',
+               (entry_id, u' '.join(_words(name)), metadata))
+
+
+def _delete(db, path, recursive=False):
+    """Delete an entry, and optionally all entries below it, from the index."""
+    where, params = 'path = ?', [path]
+    if recursive:
+        prefix = path.rstrip('/') + '/'
+        where, params = where + ' OR substr(path, 1, ?) = ?', params + [len(prefix), prefix]
+
+    db.execute('DELETE FROM terms WHERE docid IN (SELECT id FROM entries WHERE {})'.format(where), params)
+    db.execute('DELETE FROM entries WHERE {}'.format(where), params)
+
+
+def _update(change, *args):
+    """Apply a change to the index in a single transaction.
+
+    Index updates are done from policies: failures are ignored, the next
+    rebuild of the index repairs them.
+    """
+    try:
+        db = _index()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            change(db, *args)
+            db.execute('COMMIT')
+        except sqlite3.Error:
+            db.execute('ROLLBACK')
+            raise
+    except sqlite3.Error:
+        pass
+
+
+def added(path, kind):
+    """Add a new collection or data object to the index.
+
+    :param path: Path of collection or data object
+    :param kind: 'coll' or 'data'
+    """
+    if _home(path) is None:
+        return
+    try:
+        # Most calls are for entries that are indexed already (e.g. data objects that are overwritten).
+        if _index().execute('SELECT 1 FROM entries WHERE path = ? AND kind = ?', (path, kind)).fetchone() is not None:
+            return
+    except sqlite3.Error:
+        return
+    _update(_insert, path, kind)
+
+
+def removed(path):
+    """Remove a collection with everything below it, or a data object, from the index.
+
+    :param path: Path of removed collection or data object
+    """
+    _update(_delete, path, True)
+
+
+def renamed(src, dst):
+    """Move a collection with everything below it, or a data object, in the index.
+
+    :param src: Original path
+    :param dst: New path
+    """
+    def change(db):
+        prefix = src.rstrip('/') + '/'
+        rows = db.execute('SELECT e.path, e.kind, t.metadata FROM entries e JOIN terms t ON t.docid = e.id'
+                          ' WHERE e.path = ? OR substr(e.path, 1, ?) = ?', (src, len(prefix), prefix)).fetchall()
+        _delete(db, src, True)
+        for path, kind, metadata in rows:
+            _insert(db, dst + path[len(src):], kind, metadata)
+    _update(change)
+
+
+def set_metadata(coll, values):
+    """Set the indexed metadata of a collection.
+
+    :param coll:   Path of collection
+    :param values: Metadata values (strings)
+    """
+    _update(_insert, coll, 'coll', u' '.join(w for v in values for w in _words(v)))
+
+
+def metadata_values(metadata):
+    """Get all values from a (JSON) metadata structure.
+
+    :param metadata: Metadata dict, list or value
+
+    :returns: Generator of metadata values, as strings
+    """
+    if isinstance(metadata, dict):
+        for value in metadata.values():
+            for v in metadata_values(value):
+                yield v
+    elif isinstance(metadata, list):
+        for value in metadata:
+            for v in metadata_values(value):
+                yield v
+    elif isinstance(metadata, string_types):
+        yield metadata
+    elif metadata is not None:
+        yield text_type(metadata)
+
+
+def rebuild(colls, data_objects, metadata):
+    """Replace the contents of the index.
+
+    :param colls:        Iterable of collection paths
+    :param data_objects: Iterable of data object paths
+    :param metadata:     Dict of collection path => list of metadata values
+
+    :returns: Number of indexed entries
+    """
+    db = _index()
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        db.execute('DELETE FROM terms')
+        db.execute('DELETE FROM entries')
+        for path in colls:
+            _insert(db, path, 'coll', u' '.join(w for v in metadata.get(path, []) for w in _words(v)))
+        for path in data_objects:
+            _insert(db, path, 'data')
+        db.execute("INSERT OR REPLACE INTO state (key, value) VALUES ('built', ?)", (str(time.time()),))
+        count = db.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+        db.execute('COMMIT')
+    except sqlite3.Error:
+        db.execute('ROLLBACK')
+        raise
+    return count
+
+
+def search(kind, field, terms, homes, sort_order='asc', offset=0, limit=10):
+    """Search the index.
+
+    :param kind:       Kind of entries to search ('coll' or 'data')
+    :param field:      Field to search in ('name' or 'metadata')
+    :param terms:      Search terms, all of which must match (a word prefix)
+    :param homes:      Names of home collections to search in (those readable by the client)
+    :param sort_order: Sort order of paths ('asc' or 'desc')
+    :param offset:     Offset of the first result
+    :param limit:      Maximum number of results
+
+    :returns: Tuple of the total number of results and a list of result paths,
+              or None if the index has not been built
+    """
+    if field not in SEARCH_FIELDS:
+        raise ValueError('Unknown search field <{}>'.format(field))
+
+    try:
+        db = _index()
+        if db.execute("SELECT value FROM state WHERE key = 'built'").fetchone() is None:
+            return None
+
+        words = _words(terms)
+        if len(words) == 0 or len(homes) == 0:
+            return 0, []
+
+        # Words contain letters and digits only, so they cannot form FTS query operators.
+        where  = ('t.{} MATCH ? AND e.kind = ? AND instr(?, \'/\' || e.home || \'/\') > 0'.format(field))
+        params = [u' '.join(w + u'*' for w in words), kind, u'/{}/'.format(u'/'.join(homes))]
+        direction = 'DESC' if sort_order == 'desc' else 'ASC'
+
+        # Read the count and the page from the same snapshot of the index.
+        db.execute('BEGIN')
+        try:
+            total = db.execute('SELECT COUNT(*) FROM entries e JOIN terms t ON t.docid = e.id WHERE ' + where,
+                               params).fetchone()[0]
+            rows  = db.execute('SELECT e.path FROM entries e JOIN terms t ON t.docid = e.id WHERE {}'
+                               ' ORDER BY e.name {}, e.path {} LIMIT ? OFFSET ?'.format(where, direction, direction),
+                               params + [int(limit), int(offset)]).fetchall()
+        finally:
+            db.execute('COMMIT')
+    except sqlite3.Error:
+        # The index is only an optimization.
+        return None
+
+    return total, [row[0] for row in rows]
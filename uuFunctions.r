@@ -83,3 +83,14 @@ uuObjectMetadataKvp(*data_id, *prefix, *kvp) {
 uuReplicateBatch(*verbose) {
     rule_replicate_batch(*verbose);
 }
+
+# Scheduled replication batch job, as one of multiple concurrent workers.
+#
+# Each worker replicates the scheduled data objects in its own partition.
+#
+# \param[in] verbose           whether to log verbose messages for troubleshooting (1: yes, 0: no)
+# \param[in] worker            index of this worker (0 <= worker < workers)
+# \param[in] workers           number of concurrent workers
+uuReplicateBatchWorker(*verbose, *worker, *workers) {
+    rule_replicate_batch(*verbose, *worker, *workers);
+}
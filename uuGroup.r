@@ -753,6 +753,7 @@ uuGroupAdd(*groupName, *category, *subcategory, *schema_id, *expiration_date, *d
 
 	if (*status == '0') {
 		*message = "";
+		rule_group_cache_invalidate(*groupName);
 	} else {
 		# Why didn't you allow me to do that?
 		uuGroupPolicyCanGroupAdd(
@@ -821,6 +822,7 @@ uuGroupModify(*groupName, *property, *value, *status, *message) {
 	*status = str(errorcode(msiSudoObjMetaSet(*groupName, "-u", *property, *value, "", *kv)));
 	if (*status == '0') {
 		*message = "";
+		rule_group_cache_invalidate(*groupName);
 	} else {
 		uuGroupPolicyCanGroupModify(uuClientFullName, *groupName, *property, *value, *allowed, *reason);
 		if (*allowed == 0) {
@@ -842,6 +844,7 @@ uuGroupRemove(*groupName, *status, *message) {
 	*status = str(errorcode(msiSudoGroupRemove(*groupName, "")));
 	if (*status == '0') {
 		*message = "";
+		rule_group_cache_invalidate(*groupName);
 	} else {
 		uuGroupPolicyCanGroupRemove(uuClientFullName, *groupName, *allowed, *reason);
 		if (*allowed == 0) {
@@ -961,6 +964,7 @@ uuGroupUserAdd(*groupName, *user, *status, *message) {
 	*status = str(errorcode(msiSudoGroupMemberAdd(*groupName, *fullName, "")));
 	if (*status == '0') {
 		*message = "";
+		rule_group_cache_invalidate(*groupName);
 	} else {
 		uuGroupPolicyCanGroupUserAdd(uuClientFullName, *groupName, *fullName, *allowed, *reason);
 		if (*allowed == 0) {
@@ -994,6 +998,7 @@ uuGroupUserRemove(*groupName, *user, *status, *message) {
 	*status = str(errorcode(msiSudoGroupMemberRemove(*actualGroupToRemoveUserFrom, *fullName, "")));
 	if (*status == '0') {
 		*message = "";
+		rule_group_cache_invalidate(*groupName);
 	} else {
 		uuGroupPolicyCanGroupUserRemove(uuClientFullName, *groupName, *fullName, *allowed, *reason);
 		if (*allowed == 0) {
@@ -1053,12 +1058,14 @@ uuGroupUserChangeRole(*groupName, *user, *newRole, *status, *message) {
 			}
 			succeed;
 		}
+		rule_group_cache_invalidate(*groupName);
 
 		# Add the user to the group to make them a normal member.
 
 		*status = str(errorcode(msiSudoGroupMemberAdd(*groupName, *fullName, "")));
 		if (*status == '0') {
 			*message = "";
+			rule_group_cache_invalidate(*groupName);
 		} else {
 			uuGroupPolicyCanGroupUserChangeRole(uuClientFullName, *groupName, *fullName, "normal", *allowed, *reason);
 			if (*allowed == 0) {
@@ -1076,6 +1083,7 @@ uuGroupUserChangeRole(*groupName, *user, *newRole, *status, *message) {
 			}
 			succeed;
 		}
+		rule_group_cache_invalidate(*groupName);
 
 	} else if (*oldRole == "none") {
 		# For the sake of clear error reporting, we must detect the situation
@@ -1114,6 +1122,7 @@ uuGroupUserChangeRole(*groupName, *user, *newRole, *status, *message) {
 			}
 			succeed;
 		}
+		rule_group_cache_invalidate(*groupName);
 
 		# Add the user to the read group.
 
@@ -1123,6 +1132,7 @@ uuGroupUserChangeRole(*groupName, *user, *newRole, *status, *message) {
 		*status = str(errorcode(msiSudoGroupMemberAdd(*roGroup, *fullName, "")));
 		if (*status == '0') {
 			*message = "";
+			rule_group_cache_invalidate(*groupName);
 		} else {
 			uuGroupPolicyCanGroupUserChangeRole(uuClientFullName, *groupName, *fullName, *newRole, *allowed, *reason);
 			if (*allowed == 0) {
@@ -1137,6 +1147,7 @@ uuGroupUserChangeRole(*groupName, *user, *newRole, *status, *message) {
 		*status = str(errorcode(msiSudoObjMetaAdd(*groupName, "-u", *newRole, *fullName, "", "")));
 		if (*status == '0') {
 			*message = "";
+			rule_group_cache_invalidate(*groupName);
 		} else {
 			uuGroupPolicyCanGroupUserChangeRole(uuClientFullName, *groupName, *fullName, *newRole, *allowed, *reason);
 			if (*allowed == 0) {
@@ -4,7 +4,7 @@
 # \author    Paul Frederiks
 # \author    Felix Croes
 # \author    Lazlo Westerhof
-# \copyright Copyright (c) 2015-2021, Utrecht University. All rights reserved.
+# \copyright Copyright (c) 2015-2023, Utrecht University. All rights reserved.
 # \license   GPLv3, see LICENSE.
 
 # Hook into Python. {{{
@@ -16,6 +16,11 @@ acDataDeletePolicy             { cut; py_acDataDeletePolicy }
 acPreProcForObjRename(*x, *y)  { cut; py_acPreProcForObjRename(*x, *y) }
 acPreProcForExecCmd(*cmd, *args, *addr, *hint) { cut; py_acPreProcForExecCmd(*cmd, *args, *addr, *hint) }
 acPostProcForObjRename(*src, *dst) { py_acPostProcForObjRename(*src, *dst) }
+acPostProcForCollCreate        { py_acPostProcForCollCreate }
+acPostProcForRmColl            { py_acPostProcForRmColl }
+acPostProcForDelete            { py_acPostProcForDelete }
+acPostProcForModifyAccessControl(*RecursiveFlag,*AccessLevel,*UserName,*Zone,*Path)
+{ py_acPostProcForModifyAccessControl(*RecursiveFlag,*AccessLevel,*UserName,*Zone,*Path) }
 
 # Matches any imeta (or equivalent) command *except* mod and cp.
 acPreProcForModifyAVUMetadata(*Option,*ItemType,*ItemName,*AName,*AValue,*AUnit)
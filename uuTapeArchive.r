@@ -1,6 +1,6 @@
 # \file      uuTapeArchive.r
 # \author    Lazlo Westerhof
-# \copyright Copyright (c) 2021-2022, Utrecht University. All rights reserved.
+# \copyright Copyright (c) 2021-2023, Utrecht University. All rights reserved.
 # \license   GPLv3, see LICENSE.
 
 # \constant Metadata key for putting data objects offline.
@@ -181,3 +181,16 @@ uuTapeArchiveSetState(*path, *physical_path, *timestamp) {
     *argv = " *actor *path *physical_path *timestamp";
     msiExecCmd("admin-tape-archive-set-state.sh", *argv, *hostAddress, "", 0, *out);
 }
+
+
+# \brief Perform a DMF command on a batch of files.
+#
+# \param[in]  cmd  Name of the command, in msiExecCmd_bin of the tape archive host.
+# \param[in]  args Physical paths of data objects, double quoted and separated by spaces.
+# \param[out] out  Output of the command.
+#
+uuTapeArchiveExecCmd(*cmd, *args, *out) {
+    *hostAddress = ARCHIVERESOURCEHOST;
+    msiExecCmd(*cmd, *args, *hostAddress, "", "", *dmRes);
+    msiGetStdoutInExecCmdOut(*dmRes, *out);
+}
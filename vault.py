@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 """Functions to copy packages to the vault and manage permissions of vault packages."""
 
-__copyright__ = 'Copyright (c) 2019-2022, Utrecht University'
+__copyright__ = 'Copyright (c) 2019-2023, Utrecht University'
 __license__   = 'GPLv3, see LICENSE'
 
 import itertools
@@ -31,6 +31,7 @@ __all__ = ['api_vault_submit',
            'api_vault_unpreservable_files',
            'rule_vault_copy_original_metadata_to_vault',
            'rule_vault_write_license',
+           'rule_vault_copy_folder_to_vault',
            'rule_vault_process_status_transitions',
            'api_vault_system_metadata',
            'api_vault_collection_details',
@@ -778,119 +779,165 @@ def api_revoke_read_access_research_group(ctx, coll):
     return {'status': 'Success', 'statusInfo': ''}
 
 
+COPY_CHECKPOINT_INTERVAL = 100
+"""Number of data objects copied to the vault between two checkpoints."""
+
+_ACL_LEVELS = {'own': 'own', 'modify object': 'write', 'read object': 'read'}
+"""ACL names as returned by queries, mapped to their msiSetACL names."""
+
+
 def copy_folder_to_vault(ctx, folder, target):
     """Copy folder and all its contents to target in vault.
 
     The data will reside onder folder '/original' within the vault.
 
+    The folder tree is listed once, and the client is granted read access to
+    the whole tree at once. After every COPY_CHECKPOINT_INTERVAL data objects,
+    the path of the last copied data object is stored on the vault package,
+    so that copying to the same vault package again resumes after it. Data
+    objects that already exist in the vault package (e.g. copied by an
+    earlier, failed attempt) are overwritten.
+
     :param ctx:    Combined type of a callback and rei struct
     :param folder: Path of a folder in the research space
     :param target: Path of a package in the vault space
 
-    :raises Exception: Raises exception when treewalk_and_ingest did not finish correctly
+    :raises Exception: Raises exception when a collection or data object could not be copied
     """
     destination = target + '/original'
-    origin = folder
 
-    # Origin is a never changing value to be able to designate a relative path within ingest_object
-    error = 0  # Initial error state. Should stay 0.
-    if treewalk_and_ingest(ctx, folder, destination, origin, error):
-        raise Exception('copy_folder_to_vault: Error copying folder to vault')
+    checkpoint = None
+    for row in genquery.row_iterator("META_COLL_ATTR_VALUE",
+                                     "COLL_NAME = '{}' AND META_COLL_ATTR_NAME = '{}'"
+                                     .format(target, constants.IICOPYCHECKPOINTNAME),
+                                     genquery.AS_LIST, ctx):
+        checkpoint = row[0]
 
+    def tree(coll):
+        return genquery.row_iterator("COLL_NAME", "COLL_NAME = '{}' || like '{}/%'".format(coll, coll),
+                                     genquery.AS_LIST, ctx)
 
-def treewalk_and_ingest(ctx, folder, target, origin, error):
-    """Treewalk folder and ingest.
+    colls = sorted(row[0] for row in tree(folder))
+    data_objects = sorted(collection.data_objects(ctx, folder, recursive=True))
 
-    :param ctx:    Combined type of a callback and rei struct
-    :param folder: Will change every time as it represents every folder that has to be copied to vault
-    :param target: Target of ingest
-    :param origin: Origin of treewalk
-    :param error:  0/1 indicating if treewalk or ingest failed
+    if checkpoint is not None:
+        log.write(ctx, 'Resuming copy of <{}> to <{}> after <{}>', folder, target, checkpoint)
+
+    # Anything already in the destination was copied by an earlier attempt,
+    # possibly before the first checkpoint was stored.
+    existing = set(row[0] for row in tree(destination))
+    if len(existing) > 0:
+        existing.update(collection.data_objects(ctx, destination, recursive=True))
+
+    def destination_path(path):
+        return destination + path[len(folder):]
+
+    acls = grant_read_access(ctx, folder)
+    try:
+        # Parents sort before their subcollections.
+        for path in colls:
+            if destination_path(path) in existing:
+                continue
+            try:
+                msi.coll_create(ctx, destination_path(path), '1', irods_types.BytesBuf())
+            except msi.Error as e:
+                raise Exception('copy_folder_to_vault: Could not create collection <{}>: {}'.format(destination_path(path), e))
+            if path == folder:
+                # The root collection of the vault package is marked incomplete until the last step in folder_secure.
+                avu.set_on_coll(ctx, destination_path(path), constants.IIVAULTSTATUSATTRNAME,
+                                constants.vault_package_state.INCOMPLETE)
+
+        if checkpoint is not None:
+            data_objects = [path for path in data_objects if path > checkpoint]
+
+        for i, path in enumerate(data_objects):
+            # Objects copied (partially) by an earlier attempt are overwritten.
+            options = 'destRescName={}++++verifyChksum='.format(config.resource_vault)
+            if destination_path(path) in existing:
+                options += '++++forceFlag='
+            try:
+                msi.data_obj_copy(ctx, path, destination_path(path), options, irods_types.BytesBuf())
+            except msi.Error as e:
+                raise Exception('copy_folder_to_vault: Could not copy <{}>: {}'.format(path, e))
 
-    :returns: Error status (which should remain 0 for further processing in iterative manner)
+            if (i + 1) % COPY_CHECKPOINT_INTERVAL == 0:
+                avu.set_on_coll(ctx, target, constants.IICOPYCHECKPOINTNAME, path)
+    finally:
+        revoke_read_access(ctx, folder, acls)
+
+    if checkpoint is not None or len(data_objects) >= COPY_CHECKPOINT_INTERVAL:
+        avu.rmw_from_coll(ctx, target, constants.IICOPYCHECKPOINTNAME, '%')
+
+
+def grant_read_access(ctx, coll):
+    """Grant the client read access to a collection and everything in it.
+
+    Read access is granted recursively, with a single ACL change.
+
+    :param ctx:  Combined type of a callback and rei struct
+    :param coll: Path of collection
+
+    :returns: List of (path, access) tuples of ACLs the client had in the collection before
     """
-    parent_coll, coll = pathutil.chop(folder)
+    client_id = genquery.Query(ctx, "USER_ID", "USER_NAME = '{}' AND USER_ZONE = '{}'"
+                               .format(*user.user_and_zone(ctx))).first()
+    tree = "COLL_NAME = '{}' || like '{}/%'".format(coll, coll)
 
-    # 1. Process this collection itself as a collection.
-    # INGEST
-    if error == 0:
-        # INGEST COLLECTION
-        error = ingest_object(ctx, parent_coll, coll, True, target, origin)
+    acls = [(path, access) for path, access in genquery.row_iterator(
+            "COLL_NAME, COLL_ACCESS_NAME",
+            "{} AND COLL_ACCESS_USER_ID = '{}'".format(tree, client_id),
+            genquery.AS_LIST, ctx)]
+    acls += [('{}/{}'.format(path, name), access) for path, name, access in genquery.row_iterator(
+             "COLL_NAME, DATA_NAME, DATA_ACCESS_NAME",
+             "{} AND DATA_ACCESS_USER_ID = '{}'".format(tree, client_id),
+             genquery.AS_LIST, ctx)]
 
-    # 2. Process dataobjects located directly within the collection
-    if error == 0:
-        iter = genquery.row_iterator(
-            "DATA_NAME",
-            "COLL_NAME = '" + folder + "'",
-            genquery.AS_LIST, ctx
-        )
-        for row in iter:
-            # INGEST OBJECT
-            error = ingest_object(ctx, folder, row[0], False, target, origin)
-            if error:
-                break
-
-    if error == 0:
-        # 3. Process the subfolders
-        # Loop through subfolders which have folder as parent folder
-        iter = genquery.row_iterator(
-            "COLL_NAME",
-            "COLL_PARENT_NAME = '" + folder + "'",
-            genquery.AS_LIST, ctx
-        )
-        for row in iter:
-            error = treewalk_and_ingest(ctx, row[0], target, origin, error)
-            if error:
-                break
+    msi.set_acl(ctx, "recursive", "admin:read", user.full_name(ctx), coll)
+    return acls
 
-    return error
 
+def revoke_read_access(ctx, coll, acls):
+    """Revoke read access granted with grant_read_access(), restoring the ACLs the client had before.
 
-def ingest_object(ctx, parent, item, item_is_collection, destination, origin):
-    source_path = parent + "/" + item
-    read_access = msi.check_access(ctx, source_path, 'read object', irods_types.BytesBuf())['arguments'][2]
+    :param ctx:  Combined type of a callback and rei struct
+    :param coll: Path of collection
+    :param acls: ACLs returned by grant_read_access()
+    """
+    msi.set_acl(ctx, "recursive", "admin:null", user.full_name(ctx), coll)
+    for path, access in acls:
+        msi.set_acl(ctx, "default", "admin:" + _ACL_LEVELS.get(access, 'read'), user.full_name(ctx), path)
 
-    if read_access != b'\x01':
-        try:
-            msi.set_acl(ctx, "default", "admin:read", user.full_name(ctx), source_path)
-        except msi.Error:
-            return 1
-
-    dest_path = destination
-
-    if source_path != origin:
-        markIncomplete = False
-        # rewrite path to copy objects that are located underneath the toplevel collection
-        source_length = len(source_path)
-        relative_path = source_path[len(origin) + 1: source_length]
-        dest_path = destination + '/' + relative_path
-    else:
-        markIncomplete = True
 
-    if item_is_collection:
-        # CREATE COLLECTION
-        try:
-            msi.coll_create(ctx, dest_path, '', irods_types.BytesBuf())
-        except msi.Error:
-            return 1
+@rule.make(inputs=[0, 1], outputs=[2])
+def rule_vault_copy_folder_to_vault(ctx, folder, target):
+    """Copy a research folder to a vault package.
 
-        if markIncomplete:
-            avu.set_on_coll(ctx, dest_path, constants.IIVAULTSTATUSATTRNAME, constants.vault_package_state.INCOMPLETE)
-    else:
-        # CREATE COPY OF DATA OBJECT
-        try:
-            # msi.data_obj_copy(ctx, source_path, dest_path, '', irods_types.BytesBuf())
-            ctx.msiDataObjCopy(source_path, dest_path, 'verifyChksum=', 0)
-        except msi.Error:
-            return 1
+    When copying fails, the folder is marked for a retry that resumes copying
+    to the same vault package.
 
-    if read_access != b'\x01':
-        try:
-            msi.set_acl(ctx, "default", "admin:null", user.full_name(ctx), source_path)
-        except msi.Error:
-            return 1
+    :param ctx:    Combined type of a callback and rei struct
+    :param folder: Path of a folder in the research space
+    :param target: Path of a package in the vault space
+
+    :returns: '0' when no error occurred
+    """
+    try:
+        copy_folder_to_vault(ctx, folder, target)
+        return '0'
+    except Exception as e:
+        log.error(ctx, 'Could not copy <{}> to <{}>: {}', folder, target, e)
+
+    modify_access = msi.check_access(ctx, folder, 'modify object', irods_types.BytesBuf())['arguments'][2]
+    if modify_access != b'\x01':
+        msi.set_acl(ctx, "default", "admin:write", user.full_name(ctx), folder)
+
+    avu.set_on_coll(ctx, folder, constants.UUORGMETADATAPREFIX + "cronjob_copy_to_vault", constants.CRONJOB_STATE['RETRY'])
+    avu.set_on_coll(ctx, folder, constants.IICOPYPARAMSNAME, target)
+
+    if modify_access != b'\x01':
+        msi.set_acl(ctx, "default", "admin:null", user.full_name(ctx), folder)
 
-    return 0
+    return '1'
 
 
 def set_vault_permissions(ctx, group_name, folder, target):